@@ -1,11 +1,17 @@
 from ._tokenizer import Tokenizer
 from ._pre_processor import PreProcessor
+from ._compiled_template import CompiledTemplate
+from ._result_cache import CacheStatistics
+from ._batch import ExpansionOutcome, WarmWorkerPool
+from ._check import Mismatch, unified_diff
 from ._files import (
+    FileOptions,
     file_options,
     read_file,
     write_file,
     write_to_tempfile,
     run_process_with_file,
+    run_process_with_files,
 )
 
 __all__ = (
@@ -13,10 +19,22 @@ __all__ = (
     "Tokenizer",
     # ._pre_precessor
     "PreProcessor",
+    # ._compiled_template
+    "CompiledTemplate",
+    # ._result_cache
+    "CacheStatistics",
+    # ._batch
+    "ExpansionOutcome",
+    "WarmWorkerPool",
+    # ._check
+    "Mismatch",
+    "unified_diff",
     # ._files
+    "FileOptions",
     "file_options",
     "read_file",
     "write_file",
     "write_to_tempfile",
     "run_process_with_file",
+    "run_process_with_files",
 )
@@ -0,0 +1,286 @@
+import os
+import time
+import itertools
+import importlib
+import traceback
+import multiprocessing
+import concurrent.futures
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, asdict, field
+from types import TracebackType
+from typing import Optional, TYPE_CHECKING
+
+from . import _files
+from ._files import FileName, FileOptions, StatSignature
+from ._check import Mismatch
+
+if TYPE_CHECKING:  # pragma: no cover
+    from ._pre_processor import PreProcessor
+    from ._compiled_template import CompiledTemplate
+
+
+@dataclass
+class ExpansionOutcome:
+    """Outcome of the expansion of a template file to a result file, as part of
+    a batch of expansions."""
+
+    template_file: str
+    """ The expanded template """
+    result_file: str
+    """ The file the result has been written to """
+    changed: bool = False
+    """ True, if the result file has been written, because its content changed """
+    error: Optional[str] = None
+    """ The formatted exception, if the expansion failed, and None otherwise """
+    mismatch: Optional[Mismatch] = None
+    """ In check mode, the first difference, if the result file is not up to date
+    (see *PreProcessor.check_file_to_file*) """
+    seconds: float = 0.0
+    """ Wall-clock time the expansion took """
+    dependencies: dict[str, StatSignature] = field(default_factory=dict)
+    """ Resolved paths of the files the expansion has read (templates, and files
+    inserted by *insert_content*), with their stat signatures (see
+    *stat_signature*). Files that the macro code reads by its own means are not
+    included. """
+
+
+def expand_to_file_if_changed(
+    pre_processor: "PreProcessor",
+    template_file: str,
+    result_file: str,
+    check: bool = False,
+) -> ExpansionOutcome:
+    """Expand *template_file* with *pre_processor*. Write the result to
+    *result_file*, if its content differs, or, in *check* mode, only compare it
+    with the content. Report exceptions in the outcome instead of raising them."""
+    outcome = ExpansionOutcome(template_file, result_file)
+    start = time.perf_counter()
+    recording = pre_processor._global_evaluation_context.recording_dependencies()
+    try:
+        with recording as dependencies:
+            if check:
+                outcome.mismatch = pre_processor.check_file_to_file(
+                    template_file, result_file
+                )
+            else:
+                outcome.changed = pre_processor.expand_file_to_file_if_changed(
+                    template_file, result_file
+                )
+        outcome.dependencies = dependencies
+    except Exception:
+        outcome.error = traceback.format_exc()
+    outcome.seconds = time.perf_counter() - start
+    return outcome
+
+
+# The PreProcessor of a worker process. It is created once per worker, so that its
+# caches are re-used for all expansions the worker performs.
+_worker_pre_processor: Optional["PreProcessor"] = None
+
+
+def _init_worker(
+    pre_processor_factory: Callable[[], "PreProcessor"], file_options: FileOptions
+) -> None:
+    """Initialize a worker process: Take over the file options of the parent
+    process and create the PreProcessor of the worker."""
+    global _worker_pre_processor
+    for name, value in asdict(file_options).items():
+        setattr(_files.file_options, name, value)
+    _worker_pre_processor = pre_processor_factory()
+
+
+def _expand_in_worker(
+    template_file: str, result_file: str, check: bool = False
+) -> ExpansionOutcome:
+    assert _worker_pre_processor is not None
+    return expand_to_file_if_changed(
+        _worker_pre_processor, template_file, result_file, check
+    )
+
+
+def expand_many(
+    pre_processor: "PreProcessor",
+    pre_processor_factory: Callable[[], "PreProcessor"],
+    files: Iterable[tuple[FileName, FileName]],
+    jobs: Optional[int] = None,
+    check: bool = False,
+) -> list[ExpansionOutcome]:
+    """Expand the template files to the result files, see
+    *PreProcessor.expand_many*. With a single job, *pre_processor* is used
+    directly. Otherwise, each worker process creates its PreProcessor by
+    calling *pre_processor_factory*, which needs to be picklable."""
+    pairs = [
+        (os.fsdecode(template_file), os.fsdecode(result_file))
+        for template_file, result_file in files
+    ]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(pairs))
+    if jobs <= 1:
+        return [
+            expand_to_file_if_changed(pre_processor, template_file, result_file, check)
+            for template_file, result_file in pairs
+        ]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(pre_processor_factory, FileOptions(**asdict(_files.file_options))),
+    ) as executor:
+        return list(
+            executor.map(
+                _expand_in_worker,
+                [template_file for template_file, _ in pairs],
+                [result_file for _, result_file in pairs],
+                itertools.repeat(check),
+            )
+        )
+
+
+# The compiled template that a worker process renders. It is unpickled once per
+# worker, and its code is not compiled again for each rendering.
+_worker_compiled_template: Optional["CompiledTemplate"] = None
+
+
+def _init_render_worker(
+    compiled_template: "CompiledTemplate", file_options: FileOptions
+) -> None:
+    """Initialize a worker process for renderings of *compiled_template*."""
+    global _worker_compiled_template
+    for name, value in asdict(file_options).items():
+        setattr(_files.file_options, name, value)
+    _worker_compiled_template = compiled_template
+
+
+def _render_in_worker(globals_dict: Optional[dict]) -> str:
+    assert _worker_compiled_template is not None
+    return _worker_compiled_template.render(globals_dict)
+
+
+def render_many(
+    compiled_template: "CompiledTemplate",
+    globals_dicts: Iterable[Optional[dict]],
+    jobs: Optional[int] = None,
+    ordered: bool = True,
+) -> Iterator[tuple[int, str]]:
+    """Render *compiled_template* with each of the *globals_dicts*, see
+    *CompiledTemplate.render_many*."""
+    globals_list = list(globals_dicts)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(globals_list))
+    if jobs <= 1:
+        for index, globals_dict in enumerate(globals_list):
+            yield index, compiled_template.render(globals_dict)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_render_worker,
+        initargs=(compiled_template, FileOptions(**asdict(_files.file_options))),
+    ) as executor:
+        futures = {
+            executor.submit(_render_in_worker, globals_dict): index
+            for index, globals_dict in enumerate(globals_list)
+        }
+        try:
+            for future in (
+                futures if ordered else concurrent.futures.as_completed(futures)
+            ):
+                yield futures[future], future.result()
+        finally:
+            # Do not wait for renderings whose results are not taken anymore
+            for future in futures:
+                future.cancel()
+
+
+# PreProcessors of the warm worker pools of the current process, by pool number.
+# Forked workers inherit them, instead of getting them pickled.
+_warm_pre_processors = dict[int, "PreProcessor"]()
+_warm_pool_numbers = itertools.count()
+
+
+def _init_forked_worker(pool_number: int) -> None:
+    """Initialize a forked worker process: Use the warm PreProcessor of the pool,
+    inherited from the parent process."""
+    global _worker_pre_processor
+    _worker_pre_processor = _warm_pre_processors[pool_number]
+
+
+class WarmWorkerPool:
+    """
+    Pool of worker processes for template expansions, forked from a warm parent
+    process. Before the workers are forked, the prelude templates are expanded
+    (and their results discarded) and the preload modules are imported by the
+    parent. The workers inherit this state copy-on-write: the imported modules,
+    and the template scripts and compiled code the PreProcessor has cached, e.g.,
+    for the templates that the prelude templates import.
+
+    The pool requires the "fork" start method of *multiprocessing*, i.e., a
+    POSIX platform.
+
+    :param pre_processor: PreProcessor to warm up and to use in the workers.
+    :param jobs: Number of worker processes. Default: number of CPUs.
+    :param prelude_templates: Templates to expand in the parent process.
+    :param preload_modules: Names of modules to import in the parent process.
+    """
+
+    def __init__(
+        self,
+        pre_processor: "PreProcessor",
+        jobs: Optional[int] = None,
+        prelude_templates: Iterable[FileName] = (),
+        preload_modules: Iterable[str] = (),
+    ) -> None:
+        if "fork" not in multiprocessing.get_all_start_methods():  # pragma: no cover
+            raise ValueError(
+                "A warm worker pool needs the start method 'fork', "
+                "which is not available on this platform"
+            )
+        for module in preload_modules:
+            importlib.import_module(module)
+        for template_file in prelude_templates:
+            pre_processor.expand_file(template_file)
+
+        self._pool_number = next(_warm_pool_numbers)
+        _warm_pre_processors[self._pool_number] = pre_processor
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_forked_worker,
+            initargs=(self._pool_number,),
+        )
+
+    def submit(
+        self, template_file: FileName, result_file: FileName
+    ) -> "concurrent.futures.Future[ExpansionOutcome]":
+        """Expand *template_file* to *result_file* in a worker, like
+        *PreProcessor.expand_many* does for a single pair of files."""
+        return self._executor.submit(
+            _expand_in_worker, os.fsdecode(template_file), os.fsdecode(result_file)
+        )
+
+    def expand_many(
+        self, files: Iterable[tuple[FileName, FileName]]
+    ) -> list[ExpansionOutcome]:
+        """Expand the template files to the result files in the workers, like
+        *PreProcessor.expand_many* does."""
+        futures = [
+            self.submit(template_file, result_file)
+            for template_file, result_file in files
+        ]
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        """Wait for pending expansions and stop the worker processes."""
+        self._executor.shutdown()
+        _warm_pre_processors.pop(self._pool_number, None)
+
+    def __enter__(self) -> "WarmWorkerPool":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
@@ -0,0 +1,199 @@
+import os
+import re
+import difflib
+import itertools
+from collections.abc import Iterator
+from dataclasses import dataclass
+from typing import Optional
+
+from ._files import FileName, FileOptions, read_file_chunks
+
+
+@dataclass
+class Mismatch:
+    """First difference between the expansion result of a template and the
+    content of its result file, see *PreProcessor.check_file_to_file*."""
+
+    line: int
+    """ Number of the line with the difference, starting from 1 """
+    column: int
+    """ Column of the first differing character in the line, starting from 1 """
+    current_line: str
+    """ The line in the result file, without line break (empty, if the file ends
+    before) """
+    expanded_line: str
+    """ The line in the expansion result, as far as it has been produced when the
+    difference has been found (empty, if the result ends before) """
+    result_file_exists: bool = True
+    """ False, if the result file does not exist """
+    diff: Optional[str] = None
+    """ Unified diff of the file content and the expansion result, if requested """
+
+    def __str__(self) -> str:
+        if not self.result_file_exists:
+            return "result file does not exist"
+        return (
+            f"first difference in line {self.line}, column {self.column}:\n"
+            f"  current:  {self.current_line!r}\n"
+            f"  expanded: {self.expanded_line!r}"
+        )
+
+
+class MismatchFound(BaseException):
+    """Raised by a *ComparingSink* to stop the expansion at the first difference.
+    Like *ExpansionCancelled*, it is not derived from *Exception*, so that macro
+    code does not catch it by accident."""
+
+
+def _line_of_file(
+    file_name: FileName, options: Optional[FileOptions], line_no: int
+) -> str:
+    """Return line *line_no* (from 1) of the file, without line break."""
+    lines = itertools.chain.from_iterable(
+        chunk.split("\n") for chunk in _joined_lines(file_name, options)
+    )
+    return next(itertools.islice(lines, line_no - 1, None), "")
+
+
+def _joined_lines(file_name: FileName, options: Optional[FileOptions]) -> Iterator[str]:
+    """Iterate the text of the file in chunks that end with line breaks (except
+    for the last one)."""
+    carry = ""
+    for chunk in read_file_chunks(file_name, options):
+        chunk = carry + chunk
+        end = chunk.rfind("\n")
+        carry = chunk[end + 1 :]
+        if end >= 0:
+            yield chunk[:end]
+    yield carry
+
+
+class ComparingSink:
+    """
+    Sink for an expansion (see *Sink*) that compares the chunks of the result
+    with the content of a file, read chunk by chunk, while the expansion runs.
+    At the first difference, it raises *MismatchFound*, and *mismatch* describes
+    the difference. After the expansion, *finish* checks the end of the file.
+
+    :param file_name: The file to compare with.
+    :param options: Options for reading the file.
+    """
+
+    def __init__(self, file_name: FileName, options: Optional[FileOptions]) -> None:
+        self._file_name = file_name
+        self._options = options
+        self._exists = os.path.exists(file_name)
+        self._chunks: Iterator[str] = (
+            read_file_chunks(file_name, options) if self._exists else iter(())
+        )
+        self._chunk = ""
+        self._position = 0
+        # Position in the current chunk of the file, up to which it is equal
+        self._line = 1
+        self._column = 0
+        # Line and column (from 0) of the position
+        self.mismatch: Optional[Mismatch] = None
+
+    def _advance(self, text: str) -> None:
+        """Move the position in the file over the equal *text*."""
+        line_breaks = text.count("\n")
+        if line_breaks:
+            self._line += line_breaks
+            self._column = len(text) - text.rfind("\n") - 1
+        else:
+            self._column += len(text)
+
+    def _mismatch(self, expanded_rest: str) -> MismatchFound:
+        """Describe the difference at the current position, where the expansion
+        result continues with *expanded_rest*."""
+        current_line = (
+            _line_of_file(self._file_name, self._options, self._line)
+            if self._exists
+            else ""
+        )
+        self.mismatch = Mismatch(
+            self._line,
+            self._column + 1,
+            current_line,
+            current_line[: self._column] + expanded_rest.split("\n", 1)[0],
+            self._exists,
+        )
+        return MismatchFound()
+
+    def __call__(self, text: str) -> None:
+        while text:
+            if self._position == len(self._chunk):
+                self._chunk = next(self._chunks, "")
+                self._position = 0
+                if not self._chunk:
+                    # The file ends before the expansion result
+                    raise self._mismatch(text)
+            size = min(len(text), len(self._chunk) - self._position)
+            if not self._chunk.startswith(text[:size], self._position):
+                common = os.path.commonprefix(
+                    [text[:size], self._chunk[self._position : self._position + size]]
+                )
+                self._advance(common)
+                raise self._mismatch(text[len(common) :])
+            self._advance(text[:size])
+            self._position += size
+            text = text[size:]
+
+    def finish(self) -> Optional[Mismatch]:
+        """Check, after the expansion has ended, that the file ends, too, and
+        return the mismatch, or None, if the file has the expansion result as
+        content."""
+        if self.mismatch is None and (
+            not self._exists
+            or self._position < len(self._chunk)
+            or next(self._chunks, "")
+        ):
+            # The expansion result ends before the file
+            self._mismatch("")
+        return self.mismatch
+
+
+_hunk_header = re.compile(r"@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@")
+
+
+def unified_diff(
+    current: str,
+    expanded: str,
+    fromfile: str = "current content",
+    tofile: str = "expansion result",
+    context: int = 3,
+) -> str:
+    """Return the unified diff (see *difflib.unified_diff*) of the lines of
+    *current* and *expanded*, or the empty string, if they are equal. Leading
+    and trailing lines that are equal in both are skipped before the remaining
+    lines are compared, so that small changes of large texts are fast."""
+    a = current.splitlines(keepends=True)
+    b = expanded.splitlines(keepends=True)
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    start = max(0, prefix - context)
+    skipped_suffix = max(0, suffix - context)
+    lines = difflib.unified_diff(
+        a[start : len(a) - skipped_suffix],
+        b[start : len(b) - skipped_suffix],
+        fromfile,
+        tofile,
+        n=context,
+    )
+
+    def shift(match: re.Match) -> str:
+        # Line numbers of the hunks refer to the complete texts
+        return (
+            f"@@ -{int(match.group(1)) + start}{match.group(2) or ''} "
+            f"+{int(match.group(3)) + start}{match.group(4) or ''} @@"
+        )
+
+    return "".join(
+        _hunk_header.sub(shift, line, count=1) if line.startswith("@@") else line
+        for line in lines
+    )
@@ -0,0 +1,287 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+from collections.abc import Sequence
+from typing import Any, Optional, TextIO
+
+from ._files import FileOptions, stat_signature
+from ._pre_processor import PreProcessor
+from ._stamps import StampCache
+from ._batch import ExpansionOutcome
+from ._result_cache import Dependencies
+
+_template_infix = ".tpl"
+
+
+def result_file_for(template_file: str) -> str:
+    """Return the result file for *template_file*, by removing the infix ".tpl"
+    from the file name: "module.tpl.py" becomes "module.py", and "Makefile.tpl"
+    becomes "Makefile"."""
+    directory, name = os.path.split(template_file)
+    stem, extension = os.path.splitext(name)
+    if stem.endswith(_template_infix) and len(stem) > len(_template_infix):
+        return os.path.join(directory, stem[: -len(_template_infix)] + extension)
+    if extension == _template_infix and stem:
+        return os.path.join(directory, stem)
+    raise ValueError(
+        f"Template file {template_file!r} is not named like 'name.tpl.ext' or "
+        f"'name.tpl', so the name of its result file is unknown. Use a manifest."
+    )
+
+
+def _read_manifest(manifest_file: str) -> list[tuple[str, str]]:
+    """Return the pairs of template and result files of the manifest, a JSON
+    object that maps template files to result files. Relative paths are relative
+    to the directory of the manifest."""
+    with open(manifest_file, encoding="utf8") as f:
+        mapping = json.load(f)
+    if not isinstance(mapping, dict) or not all(
+        isinstance(value, str) for value in mapping.values()
+    ):
+        raise ValueError(
+            f"Manifest {manifest_file!r} is not a JSON object that maps template "
+            f"files to result files"
+        )
+    directory = os.path.dirname(manifest_file)
+    return [
+        (os.path.join(directory, template_file), os.path.join(directory, result_file))
+        for template_file, result_file in mapping.items()
+    ]
+
+
+def _collect_files(
+    patterns: Sequence[str], manifests: Sequence[str]
+) -> list[tuple[str, str]]:
+    """Return the pairs of template and result files given by the glob
+    *patterns* and the *manifests*, without duplicates."""
+    pairs = list[tuple[str, str]]()
+    for pattern in patterns:
+        template_files = sorted(glob.glob(pattern, recursive=True))
+        if not template_files:
+            raise ValueError(f"No template file matches {pattern!r}")
+        pairs.extend(
+            (template_file, result_file_for(template_file))
+            for template_file in template_files
+        )
+    for manifest_file in manifests:
+        pairs.extend(_read_manifest(manifest_file))
+    return list(dict.fromkeys(pairs))
+
+
+def _extra_dependencies(patterns: Sequence[str]) -> Dependencies:
+    """Return the files given by the glob *patterns*, as resolved paths with
+    their stat signatures."""
+    dependencies = Dependencies()
+    for pattern in patterns:
+        files = glob.glob(pattern, recursive=True)
+        if not files:
+            raise ValueError(f"No dependency file matches {pattern!r}")
+        for file in files:
+            dependencies[os.path.realpath(file)] = stat_signature(file)
+    return dict(sorted(dependencies.items()))
+
+
+def _argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m pymacros4py",
+        description=(
+            "Expand pymacros4py templates to their result files. A result file is "
+            "only written, if its content changes."
+        ),
+    )
+    parser.add_argument(
+        "templates",
+        nargs="*",
+        metavar="TEMPLATE",
+        help=(
+            "template file or glob pattern (with '**' for any subdirectories); "
+            "the result file of 'name.tpl.ext' is 'name.ext'"
+        ),
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        action="append",
+        default=[],
+        help=(
+            "JSON file with an object that maps template files to result files, "
+            "relative to the directory of the manifest (can be repeated)"
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="do not write result files, but fail, if any of them is not up to date",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="with --check, show a unified diff for each file that is not up to date",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help=(
+            "directory for persistent caches: the template scripts, and stamps of "
+            "the expansions, so that a template is skipped, if neither it, nor a "
+            "template or file it inserts or imports, nor its result file has "
+            "changed. Other files the macro code reads, e.g., Python modules it "
+            "imports, are not detected: declare them with --depends-on"
+        ),
+    )
+    parser.add_argument(
+        "--depends-on",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help=(
+            "with --cache-dir, a file or glob pattern of files that all "
+            "expansions depend on, e.g., Python modules the macro code imports "
+            "(can be repeated)"
+        ),
+    )
+    parser.add_argument(
+        "--timings",
+        metavar="FILE",
+        help="write the outcome and time of each expansion as JSON to FILE "
+        "('-': stdout)",
+    )
+    parser.add_argument("--encoding", help="encoding of templates and result files")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only report failures"
+    )
+    return parser
+
+
+def _report(
+    outcome: ExpansionOutcome,
+    pre_processor: PreProcessor,
+    diff: bool,
+    quiet: bool,
+    out: TextIO,
+) -> str:
+    """Print the *outcome* of an expansion, if needed, and return its status."""
+    error = outcome.error
+    if error is None and outcome.mismatch is not None:
+        print(f"{outcome.result_file}: {outcome.mismatch}", file=out)
+        if not diff:
+            return "out of date"
+        # The check has stopped at the first difference, but the diff needs the
+        # complete result, and the expansion might fail
+        try:
+            mismatch = pre_processor.check_file_to_file(
+                outcome.template_file, outcome.result_file, diff=True
+            )
+            if mismatch is not None and mismatch.diff:
+                print(mismatch.diff, end="", file=out)
+            return "out of date"
+        except Exception:
+            error = traceback.format_exc()
+    if error is not None:
+        print(f"{outcome.template_file}: expansion failed", file=sys.stderr)
+        print(error, file=sys.stderr)
+        return "error"
+    if outcome.changed:
+        if not quiet:
+            print(f"{outcome.result_file}: written", file=out)
+        return "written"
+    return "unchanged"
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run the command line interface with the arguments *argv* (default: those
+    of the process). Return the exit status: 0 for success, 1 if an expansion
+    failed or, with --check, a result file is not up to date, and 2 for wrong
+    arguments."""
+    start = time.perf_counter()
+    parser = _argument_parser()
+    args = parser.parse_args(argv)
+    if args.diff and not args.check:
+        parser.error("--diff requires --check")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs needs to be at least 1")
+    if args.depends_on and args.cache_dir is None:
+        parser.error("--depends-on requires --cache-dir")
+    try:
+        pairs = _collect_files(args.templates, args.manifest)
+        extra_dependencies = _extra_dependencies(args.depends_on)
+    except (OSError, ValueError) as e:
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return 2
+    if not pairs:
+        parser.error("no templates given")
+
+    file_options = None if args.encoding is None else FileOptions(args.encoding)
+    stamps = None
+    script_cache_dir = None
+    if args.cache_dir is not None:
+        # A file that starts or stops matching a pattern of --depends-on
+        # changes the configuration, and invalidates all stamps
+        stamps = StampCache(
+            os.path.join(args.cache_dir, "stamps"),
+            "\0".join([f"encoding={args.encoding}", *extra_dependencies]),
+        )
+        script_cache_dir = os.path.join(args.cache_dir, "scripts")
+    pre_processor = PreProcessor(
+        script_cache_dir=script_cache_dir, file_options=file_options
+    )
+
+    # Reports go to stderr, if the timings go to stdout
+    out = sys.stderr if args.timings == "-" else sys.stdout
+    records = {pair: ("skipped", 0.0) for pair in pairs}
+    # With --check, "unchanged" means up to date
+    to_expand = [
+        pair for pair in pairs if stamps is None or not stamps.up_to_date(*pair)
+    ]
+    failed = False
+    for outcome in pre_processor.expand_many(to_expand, args.jobs, args.check):
+        pair = (outcome.template_file, outcome.result_file)
+        status = _report(outcome, pre_processor, args.diff, args.quiet, out)
+        failed = failed or status in ("error", "out of date")
+        if stamps is not None:
+            if status in ("error", "out of date"):
+                stamps.remove(*pair)
+            else:
+                # (The signatures of the extra dependencies are those from
+                # before the expansion, so that changes during it are detected)
+                stamps.store(*pair, {**extra_dependencies, **outcome.dependencies})
+        records[pair] = (status, outcome.seconds)
+
+    if not args.quiet:
+        counts = dict[str, int]()
+        for status, _ in records.values():
+            counts[status] = counts.get(status, 0) + 1
+        print(
+            ", ".join(f"{count} {status}" for status, count in counts.items()),
+            file=out,
+        )
+    if args.timings is not None:
+        timings: dict[str, Any] = {
+            "seconds": time.perf_counter() - start,
+            "jobs": args.jobs or os.cpu_count() or 1,
+            "files": [
+                {
+                    "template": template_file,
+                    "result": result_file,
+                    "status": status,
+                    "seconds": seconds,
+                }
+                for (template_file, result_file), (status, seconds) in records.items()
+            ],
+        }
+        text = json.dumps(timings, indent=2) + "\n"
+        if args.timings == "-":
+            sys.stdout.write(text)
+        else:
+            with open(args.timings, "w", encoding="utf8") as f:
+                f.write(text)
+    return 1 if failed else 0
@@ -0,0 +1,135 @@
+import marshal
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, Optional, TYPE_CHECKING
+
+from ._files import FileName, writing_file
+from ._template_script import TemplateScript
+from ._batch import render_many
+
+if TYPE_CHECKING:  # pragma: no cover
+    from ._pre_processor import PreProcessor
+
+
+class CompiledTemplate:
+    """
+    A template, whose template script has been generated and compiled once, for
+    rendering it many times, e.g., with different globals. Created by
+    *PreProcessor.compile*.
+
+    A rendering only executes the compiled script. It uses the PreProcessor that
+    has compiled the template. A compiled template can be pickled, e.g., to send
+    it to worker processes. An unpickled compiled template uses a PreProcessor of
+    its own, configured like the original one, which it creates when it renders
+    the first time.
+
+    Compiled templates can be rendered by several threads concurrently.
+    """
+
+    def __init__(
+        self,
+        template_script: TemplateScript,
+        pre_processor: Optional["PreProcessor"],
+        pre_processor_factory: Callable[[], "PreProcessor"],
+    ) -> None:
+        self._template_script = template_script
+        self._pre_processor = pre_processor
+        self._pre_processor_factory = pre_processor_factory
+        # Creates the PreProcessor after unpickling. Needs to be picklable.
+        self._lock = threading.Lock()
+        # Serializes the creation of the PreProcessor
+
+    @property
+    def template_file(self) -> str:
+        """The file name of the template."""
+        return self._template_script.file_name
+
+    @property
+    def template_script(self) -> str:
+        """The code of the template script."""
+        return str(self._template_script)
+
+    def _get_pre_processor(self) -> "PreProcessor":
+        with self._lock:
+            if self._pre_processor is None:
+                self._pre_processor = self._pre_processor_factory()
+            return self._pre_processor
+
+    def render(self, globals_dict: Optional[dict] = None) -> str:
+        """Execute the template script and return the result.
+
+        :param globals_dict: Optionally, values to initialize the namespace of the
+            template script with, like parameter *globals* of *exec*. The
+            dictionary is copied and not changed by the rendering. So, each
+            rendering starts from the same values.
+        """
+        return self._get_pre_processor()._evaluate(
+            self._template_script, None if globals_dict is None else dict(globals_dict)
+        )
+
+    def render_to_file(
+        self, result_file: FileName, globals_dict: Optional[dict] = None
+    ) -> None:
+        """Execute the template script and save the result to *result_file*. The
+        result file is replaced only if the rendering succeeds.
+
+        :param result_file: File to store the result in.
+        :param globals_dict: See *render*.
+        """
+        pre_processor = self._get_pre_processor()
+        with writing_file(result_file, pre_processor.file_options) as f_out:
+            pre_processor._evaluate(
+                self._template_script,
+                None if globals_dict is None else dict(globals_dict),
+                f_out.write,
+            )
+
+    def render_many(
+        self,
+        globals_dicts: Iterable[Optional[dict]],
+        jobs: Optional[int] = None,
+        ordered: bool = True,
+    ) -> Iterator[tuple[int, str]]:
+        """Render the template with each of the *globals_dicts*, spread over
+        several worker processes, e.g., to generate variants of a module from
+        a single template. The compiled template is passed once to each worker,
+        which renders it with an own PreProcessor, configured like the one that
+        has compiled it. The current global *file_options* are used also in the
+        workers. An exception raised by a rendering is raised by the iteration.
+
+        :param globals_dicts: Globals for the renderings, see *render*. They
+            need to be picklable.
+        :param jobs: Number of worker processes. Default: number of CPUs. With
+            a single job, the renderings are done in the current process.
+        :param ordered: Yield the results in the order of *globals_dicts*.
+            Otherwise, yield them as they are completed.
+        :return: Iterator of pairs of the index of the globals in
+            *globals_dicts* and the result of the rendering with them. The
+            renderings run while the results are taken.
+        """
+        return render_many(self, globals_dicts, jobs, ordered)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Code objects cannot be pickled, but marshalled
+        template_script = self._template_script
+        assert template_script.code is not None
+        return {
+            "file_name": template_script.file_name,
+            "script_code": str(template_script),
+            "code": marshal.dumps(template_script.code),
+            "text_table": template_script.text_table,
+            "code_refers_to_template": template_script.code_refers_to_template,
+            "pre_processor_factory": self._pre_processor_factory,
+        }
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self._template_script = TemplateScript.from_script_code(
+            state["file_name"],
+            state["script_code"],
+            marshal.loads(state["code"]),
+            state["text_table"],
+            state["code_refers_to_template"],
+        )
+        self._pre_processor = None
+        self._pre_processor_factory = state["pre_processor_factory"]
+        self._lock = threading.Lock()
@@ -1,14 +1,23 @@
-from typing import Optional
+from collections.abc import Callable, Hashable, Iterable
+from types import CodeType
+from typing import Optional, Any
 import tempfile
+import linecache
+import weakref
+import secrets
 import os
 import sys
 import pathlib
 from dataclasses import dataclass
 
-from ._files import read_file
+from ._files import read_file_chunks, stat_signature
 from ._tokenizer import Tokenizer
 from ._global_evaluation_context import GlobalEvaluationContext
-from ._template_script import TemplateScript
+from ._result_cache import dependencies_unchanged, fingerprint
+from ._template_script import TemplateScript, text_table_name_prefix
+from ._script_cache import create_template_script, code_with_file_name
+from ._macro_output import MacroOutput
+from ._stream import Sink
 
 
 @dataclass
@@ -17,29 +26,185 @@ class Macro:
     indentation: str
     is_embedded: bool
     content_line: str
-    output: list[str]
+    output: MacroOutput
 
 
-def _separate_indentation_and_content_optionally_nl(s: str) -> tuple[str, str]:
-    """Get the whitespace characters, that the *text* starts with, and the rest of it
+def _dispatching_functions(
+    global_evaluation_context: GlobalEvaluationContext, names: Iterable[str]
+) -> dict[str, Callable[..., Any]]:
+    """For each of the *names* of the functions provided to template scripts
+    (e.g., *insert*), return a function that calls the respective function of the
+    template script that is currently evaluated. Used in namespaces that are
+    re-used after the evaluation that has filled them has ended."""
 
-    :param s: A string without newline characters except, maybe, the last character
-    """
+    def dispatching_function(name: str) -> Callable[..., Any]:
+        def dispatch(*vargs: Any, **kwargs: Any) -> Any:
+            function = global_evaluation_context.current_evaluation_function(name)
+            return function(*vargs, **kwargs)
 
-    # Separate the line and a possible trailing single newline
-    if s and s[-1] == "\n":
-        s, newline = s[:-1], s[-1]
-    else:
-        s, newline = s, ""
+        dispatch.__name__ = dispatch.__qualname__ = name
+        return dispatch
+
+    return {name: dispatching_function(name) for name in names}
+
+
+def _executable_code(
+    template_script: TemplateScript,
+    global_evaluation_context: GlobalEvaluationContext,
+) -> CodeType:
+    """Return the compiled code of *template_script*, using a virtual file name of
+    its own. When the code is used for the first time, compile it (or, if it
+    is taken from a cache, re-label it), and register the script code in
+    *linecache* under the virtual file name, as long as *template_script*
+    exists. So, tracebacks show the lines of the script, although no file is
+    written. Only if an exception occurs, the script is written to a file with
+    the virtual file name (see *_write_script_file*).
+
+    If the syntax tree of the script has been built, the code is compiled from the
+    tree instead. Then, it refers to the template file and its lines.
+
+    The first use is serialized by the lock of the template script. Later uses
+    return the code without locking. (The attributes that mark the code as final
+    are set only after it.)"""
+    code = template_script.code
+    if code is not None and (
+        template_script.code_refers_to_template
+        or template_script.code_file_name is not None
+    ):
+        return code
+
+    with template_script.compile_lock:
+        if template_script.code is None:
+            template_script.compile_tree()
+        if template_script.code_refers_to_template:
+            assert template_script.code is not None
+            return template_script.code
+
+        file_name = template_script.code_file_name
+        if file_name is not None and template_script.code is not None:
+            return template_script.code
+
+        script_code = str(template_script)
+        if file_name is None:
+            number = global_evaluation_context.next_tmp_file_number()
+            file_name = os.path.join(
+                tempfile.gettempdir(),
+                f"template_script_{number}_{secrets.token_hex(4)}.py",
+            )
+            linecache.cache[file_name] = (
+                len(script_code),
+                None,
+                script_code.splitlines(keepends=True),
+                file_name,
+            )
+            weakref.finalize(template_script, linecache.cache.pop, file_name, None)
+
+        try:
+            if template_script.code is None:
+                code = compile(script_code, file_name, mode="exec")
+            else:
+                # Already compiled (e.g., taken from a script cache)
+                code = code_with_file_name(template_script.code, file_name)
+        except BaseException:
+            # The error note refers to the virtual file name
+            template_script.code_file_name = file_name
+            raise
+        template_script.code = code
+        template_script.code_file_name = file_name
+        return code
+
+
+def _write_script_file(template_script: TemplateScript) -> str:
+    """Write the code of *template_script*, for debugging, to the file with the
+    virtual file name of its compiled code, if the file does not exist yet.
+    Return the file name."""
+    file_name = template_script.code_file_name
+    assert file_name is not None
+    try:
+        with open(file_name, "x", encoding="utf-8") as f_out:
+            f_out.write(str(template_script))
+    except FileExistsError:
+        # Already written when the script failed before
+        pass
+    return file_name
+
+
+def _script_error_note(template_script: TemplateScript) -> str:
+    """Return the note for an exception raised when compiling or executing
+    *template_script*. Save the template script to a file with the file name that
+    the traceback mentions, so that the user can "debug" the file. (Not needed,
+    if the traceback refers to the template.)"""
+    script_file_name = (
+        template_script.file_name
+        if template_script.code_refers_to_template
+        else _write_script_file(template_script)
+    )
+    return f'Error occurred when executing template script.\n File "{script_file_name}"'
+
+
+def compile_template_script(
+    template_script: TemplateScript,
+    global_evaluation_context: GlobalEvaluationContext,
+) -> None:
+    """Compile *template_script* in advance for evaluations in the
+    *global_evaluation_context*, if this has not been done yet."""
+    try:
+        _executable_code(template_script, global_evaluation_context)
+    except Exception as exc:
+        note = _script_error_note(template_script)
+        # Depending on the used Python version, one of the following will happen.
+        if hasattr(exc, "add_note"):  # pragma: no cover
+            exc.add_note(note)
+            raise
+        raise RuntimeError(note) from exc  # pragma: no cover
 
-    # Strip any whitespace (s has no NL anymore) starting from the left
-    s_stripped = s.lstrip()
-    # Extract exactly the stripped whitespaces
-    whitespace_len = len(s) - len(s_stripped)
 
-    # Return the leading whitespace if s, and the following content (optionally with
-    # the newline, we put aside at the beginning
-    return s[0:whitespace_len], s_stripped + newline
+def load_template_script(
+    template_file: str,
+    tokenizer: Tokenizer,
+    global_evaluation_context: GlobalEvaluationContext,
+    trace_parsing: bool = False,
+    trace_evaluation: bool = False,
+) -> TemplateScript:
+    """
+    Return the template script of *template_file*. If the file has already been
+    loaded in the *global_evaluation_context* and has not changed since then
+    (same modification time, size and inode), the template script, including its
+    compiled code, is re-used. Otherwise, the file is read and parsed.
+
+    :param template_file: Template to load.
+    :param tokenizer: The tokenizer to parse the template.
+    :param global_evaluation_context: Global context information for all template
+        expansions happening under a single PreProcessor.
+    :param trace_parsing: Print parsing log. This disables the re-use.
+    :param trace_evaluation: Print evaluation log.
+    """
+    signature = stat_signature(template_file)
+    template_file_resolved = os.path.realpath(template_file)
+    global_evaluation_context.record_dependency(template_file_resolved, signature)
+    key = (template_file_resolved, template_file, trace_evaluation)
+    template_scripts = global_evaluation_context.template_scripts
+    if not trace_parsing:
+        cached = template_scripts.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+    template, _ = global_evaluation_context.file_contents.read(
+        template_file, global_evaluation_context.file_options
+    )
+    template_script = create_template_script(
+        template_file,
+        template,
+        tokenizer,
+        trace_parsing,
+        trace_evaluation,
+        global_evaluation_context.text_table,
+        global_evaluation_context.optimize_scripts,
+        global_evaluation_context.build_ast,
+        global_evaluation_context.script_cache,
+    )
+    template_scripts[key] = (signature, template_script)
+    return template_script
 
 
 def evaluate_template_script(
@@ -48,6 +213,7 @@ def evaluate_template_script(
     global_evaluation_context: GlobalEvaluationContext,
     already_imported_files: set[str],
     globals_dict: Optional[dict] = None,
+    sink: Optional[Sink] = None,
 ) -> str:
     """
     Run the *template_script* and return the results. For recursive
@@ -65,12 +231,18 @@ def evaluate_template_script(
     :param globals_dict: Like parameter *globals* of the Python function
         *exec*. Note, that in order to use it, a value for key *pp* will be
         set.
+    :param sink: If given, the results are passed to it in chunks instead of
+        being returned, each chunk as soon as it is final, i.e., as soon as the
+        chunk is not part of the output of a macro that is still running. Then,
+        the empty string is returned.
     """
 
     # The following two variables are also used within the functions, that are provided
     # to the expansion script as part of the content of its global namespace:
     # List of all generated fragments of output
     output: list[str] = []
+    # Function that takes final fragments of output
+    emit = output.append if sink is None else sink
     # Subsequent output does not stem from a macro
     macro: Optional[Macro] = None
 
@@ -91,7 +263,7 @@ def evaluate_template_script(
         The first line inserted by an embedded macro remains without indentation.
         """
         nonlocal macro
-        macro = Macro(macro, indentation, embedded, content_line, list[str]())
+        macro = Macro(macro, indentation, embedded, content_line, MacroOutput())
 
     def _macro_ends(content_line: str) -> None:
         """The *macro_ends* function for macro code.
@@ -110,57 +282,19 @@ def evaluate_template_script(
 
         current_macro = macro
         macro = current_macro.outer_macro
-        current_output = macro.output if macro else output
-
-        # Handle macro output (expansion result) line by line
-        lines = "".join(current_macro.output).splitlines(keepends=True)
-
-        if not lines:
-            # Not a single line to process: finished
-            return
 
-        # First line
-        line = lines.pop(0)
-        (
-            base_indentation,
-            line_content,
-        ) = _separate_indentation_and_content_optionally_nl(line)
-        if current_macro.is_embedded:
-            # Use unindented result content
-            current_output.append(line_content)
+        # Re-indent the macro output (expansion result). It is concatenated only
+        # when it reaches the output of the template script.
+        current_macro.output.reindent(
+            current_macro.indentation,
+            current_macro.is_embedded,
+            current_macro.content_line,
+        )
+        if macro:
+            macro.output.extend(current_macro.output)
         else:
-            # Indent as defined for the macro
-            current_output.append(current_macro.indentation + line_content)
-
-        # Each subsequent line:
-        for line in lines:
-            (
-                line_indentation,
-                line_content,
-            ) = _separate_indentation_and_content_optionally_nl(line)
-            if len(line_indentation) == 0 and len(base_indentation) > 0:
-                # Zero indentation in a context with none-zero base indentation:
-                # Just take the line as it is
-                current_output.append(line)
-            elif line_indentation[0 : len(base_indentation)] == base_indentation:
-                # Line indentation string is extension of base indentation
-                # string: Compute relative indentation (including the content), and
-                # prepend macro indentation to it
-                current_output.append(
-                    current_macro.indentation + line[len(base_indentation) :]
-                )
-            else:
-                # If the line is indented, indentation (as a string)
-                # need to start with exactly the base indentation
-                raise RuntimeError(
-                    f"{current_macro.content_line}:\n"
-                    f"Output syntax error: indentation of the following line of the "
-                    f"results of the template script from the above given template "
-                    f"line is not an extension of the base indentation of these "
-                    f"results:\n"
-                    f">{line.rstrip()}<\n"
-                    f"(Start of line shown enclosed by characters '>' and '<')"
-                )
+            for chunk in current_macro.output.chunks():
+                emit(chunk)
 
     def insert(*vargs: object) -> None:
         """The *insert function* for macro code.
@@ -176,14 +310,15 @@ def evaluate_template_script(
             # Nothing to insert into expansion output
             return
 
-        current_output = macro.output if macro else output
-        # If we have been called from within macro code (this includes the case that
-        # the macro code calls a function that contains a text block that calls
-        # us): store content for bulk processing at the end of the macro
-        # If we have been called from a text block (and it is not part
-        # of a function definition within a macro): Output it as-is
-        # Both is implemented the same way.
-        current_output.append(lines_str)
+        if macro:
+            # We have been called from within macro code (this includes the case
+            # that the macro code calls a function that contains a text block that
+            # calls us): store content for bulk processing at the end of the macro
+            macro.output.write(lines_str)
+        else:
+            # We have been called from a text block (and it is not part
+            # of a function definition within a macro): Output it as-is
+            emit(lines_str)
 
     def insert_content(file: str) -> None:
         """
@@ -192,13 +327,31 @@ def evaluate_template_script(
 
         :param file: File to process.
         """
-        insert(read_file(file))
+        options = global_evaluation_context.file_options
+        stream_bytes = global_evaluation_context.stream_content_bytes
+        if stream_bytes is not None:
+            signature = stat_signature(file)
+            if signature[1] >= stream_bytes:
+                # Pass the content on chunk by chunk, without holding it
+                global_evaluation_context.record_dependency(
+                    os.path.realpath(file), signature
+                )
+                if macro:
+                    macro.output.write_file(file, options, signature)
+                else:
+                    for chunk in read_file_chunks(file, options, signature):
+                        emit(chunk)
+                return
+        content, signature = global_evaluation_context.file_contents.read(file, options)
+        global_evaluation_context.record_dependency(os.path.realpath(file), signature)
+        insert(content)
 
     def insert_from(
         template_file: str,
         globals_dict: Optional[dict] = None,
         trace_parsing: bool = False,
         trace_evaluation: bool = False,
+        cache_key: Optional[Hashable] = None,
     ) -> None:
         """
         Perform a macro expansion on the content of a file in the scope
@@ -209,10 +362,18 @@ def evaluate_template_script(
         expansion.
 
         When called a second time with an identical argument for *template_file*,
-        and *globals* is *None* in both calls, re-use the output of the previous run.
-
-        (If *globals* is not *None*, and you like to re-use results in cases of
-        equivalent content of *globals*, this has to be implemented manually.)
+        and *globals* is *None* in both calls, re-use the output of the previous run,
+        if none of the files it depends on (the template itself and all templates
+        and files inserted or imported by it, directly or indirectly) has changed
+        since then.
+
+        If *globals* is not *None*, the output is re-used only for the same
+        *cache_key*, or, if the PreProcessor caches parameterized inserts, for
+        *globals* with the same content (see parameter
+        *cache_parameterized_inserts* of *PreProcessor*), and with the same
+        templates already imported by the current expansion. Then, changes that
+        the expansion makes to *globals*, and the imports it records for the
+        current expansion, are not repeated when the output is re-used.
 
         :param template_file: Template to expand. If the first part of the path
           (see *pathlib.PurePath.parts*) is '$$', this part is removed and the
@@ -222,44 +383,114 @@ def evaluate_template_script(
           Note, that in order to use it, a value for key *macro* will be set.
         :param trace_parsing: Print parsing log to stderr.
         :param trace_evaluation: Print evaluation log to stderr.
+        :param cache_key: Optionally, a value that identifies the content of
+          *globals_dict* for the expansion of the template, e.g., a tuple of the
+          parameters it holds. Values are compared like *globals_dict* is by the
+          PreProcessor.
         """
         parts = pathlib.PurePath(template_file).parts
         if parts and parts[0] == "$$":
             template_dir = pathlib.PurePath(template_script.file_name).parent
             template_file = str(pathlib.PurePath(template_dir, *parts[1:]))
-        template = read_file(template_file)
-        template_script_to_insert_from = TemplateScript(
-            template_file, template, tokenizer, trace_parsing, trace_evaluation
-        )
 
         if globals_dict:
-            # Here, we cannot cache, because we cannot recognize identical
-            # content of the globals_dict
-            result = evaluate_template_script(
-                template_script_to_insert_from,
-                tokenizer,
-                global_evaluation_context,
-                already_imported_files,
-                globals_dict,
-            )
+            parameters = _parameters_fingerprint(globals_dict, cache_key)
+            if parameters is None:
+                # Here, we cannot cache, because we cannot recognize identical
+                # content of the globals_dict
+                insert(
+                    evaluate_template_script(
+                        load_template_script(
+                            template_file,
+                            tokenizer,
+                            global_evaluation_context,
+                            trace_parsing,
+                            trace_evaluation,
+                        ),
+                        tokenizer,
+                        global_evaluation_context,
+                        already_imported_files,
+                        globals_dict,
+                    )
+                )
+                return
+            inserted_content = global_evaluation_context.parameterized_inserted_content
         else:
-            already_inserted = global_evaluation_context.already_inserted_content
-            template_file_resolved = str(
-                pathlib.Path(template_file).resolve(strict=True)
-            )
-            if template_file_resolved in already_inserted:
-                result = already_inserted[template_file_resolved]
+            parameters = None
+            inserted_content = global_evaluation_context.already_inserted_content
+        template_file_resolved = str(pathlib.Path(template_file).resolve(strict=True))
+        if parameters is None:
+            key = template_file_resolved
+        else:
+            # The expansion runs with the imports done so far, like an uncached
+            # one, so they are part of the key
+            imports = fingerprint(tuple(sorted(already_imported_files)))
+            key = f"{template_file_resolved}\0{parameters}\0{imports}"
+        # If another thread is currently expanding the same template, wait for
+        # its result instead of expanding the template a second time
+        with global_evaluation_context.single_flight(key):
+            cached = inserted_content.get(key)
+            if cached is not None:
+                # Re-use the result. The current expansion depends on the same
+                # files.
+                result, dependencies = cached
+                global_evaluation_context.record_dependencies(dependencies)
             else:
-                result = evaluate_template_script(
-                    template_script_to_insert_from,
-                    tokenizer,
-                    global_evaluation_context,
-                    set[str](),  # no imports so far, due to new evaluation context
-                    None,  # empty globals dict -> new evaluation context
-                )
-                already_inserted[template_file_resolved] = result
+                recording = global_evaluation_context.recording_dependencies()
+                with recording as dependencies:
+                    result = evaluate_template_script(
+                        load_template_script(
+                            template_file,
+                            tokenizer,
+                            global_evaluation_context,
+                            trace_parsing,
+                            trace_evaluation,
+                        ),
+                        tokenizer,
+                        global_evaluation_context,
+                        # empty globals dict -> new evaluation context, without
+                        # imports so far
+                        already_imported_files if globals_dict else set[str](),
+                        globals_dict or None,
+                    )
+                inserted_content[key] = (result, dependencies)
         insert(result)
 
+    def _parameters_fingerprint(
+        globals_dict: dict, cache_key: Optional[Hashable]
+    ) -> Optional[str]:
+        """Return the fingerprint that identifies *globals_dict* for caching the
+        results of *insert_from*, or None, if they are not to be cached. Keys
+        given by the caller (a *cache_key* or the result of *globals_key*) and
+        the content of *globals_dict* are tagged differently, so that they
+        cannot be confused."""
+        if cache_key is not None:
+            return fingerprint(("key", cache_key))
+        if not global_evaluation_context.cache_parameterized_inserts:
+            return None
+        if global_evaluation_context.globals_key is not None:
+            return fingerprint(
+                ("key", global_evaluation_context.globals_key(globals_dict))
+            )
+        # Ignore what previous evaluations with the globals dict have left there
+        return fingerprint(
+            (
+                "globals",
+                tuple(
+                    sorted(
+                        (
+                            (key, value)
+                            for key, value in globals_dict.items()
+                            if key not in globals_to_set
+                            and key != "__builtins__"
+                            and not str(key).startswith(text_table_name_prefix)
+                        ),
+                        key=lambda item: str(item[0]),
+                    )
+                ),
+            )
+        )
+
     def import_from(
         template_file: str,
         trace_parsing: bool = False,
@@ -277,6 +508,11 @@ def evaluate_template_script(
         When called a second time with an identical argument for *template_file*,
         ignore the call.
 
+        If the PreProcessor re-uses imports, the template is executed in a namespace
+        of its own, only for the first import (and again if a file it depends on
+        changes). Then, each import copies the attributes set in this namespace
+        to the current one.
+
         :param template_file: Template to expand. If the first part of the path
           (see *pathlib.PurePath.parts*) is '$$', this part is removed and the
           subsequent parts are interpreted relative to the directory of the
@@ -292,18 +528,75 @@ def evaluate_template_script(
         template_file_resolved = str(pathlib.Path(template_file).resolve(strict=True))
         if template_file_resolved in already_imported_files:
             return
+        imported_namespaces = global_evaluation_context.imported_namespaces
         try:
-            template = read_file(template_file)
-            template_script_to_import_from = TemplateScript(
-                template_file, template, tokenizer, trace_parsing, trace_evaluation
-            )
-            _ = evaluate_template_script(
-                template_script=template_script_to_import_from,
-                tokenizer=tokenizer,
-                global_evaluation_context=global_evaluation_context,
-                already_imported_files=already_imported_files,
-                globals_dict=globals_dict,
-            )
+            if imported_namespaces is None:
+                template_script_to_import_from = load_template_script(
+                    template_file,
+                    tokenizer,
+                    global_evaluation_context,
+                    trace_parsing,
+                    trace_evaluation,
+                )
+                _ = evaluate_template_script(
+                    template_script=template_script_to_import_from,
+                    tokenizer=tokenizer,
+                    global_evaluation_context=global_evaluation_context,
+                    already_imported_files=already_imported_files,
+                    globals_dict=globals_dict,
+                )
+            else:
+                with global_evaluation_context.single_flight(
+                    "import " + template_file_resolved
+                ):
+                    cached = imported_namespaces.get(template_file_resolved)
+                    if (
+                        cached is not None
+                        and not (trace_parsing or trace_evaluation)
+                        and dependencies_unchanged(cached[1])
+                    ):
+                        namespace, dependencies = cached
+                        global_evaluation_context.record_dependencies(dependencies)
+                    else:
+                        namespace = dict()
+                        recording = global_evaluation_context.recording_dependencies()
+                        with recording as dependencies:
+                            _ = evaluate_template_script(
+                                template_script=load_template_script(
+                                    template_file,
+                                    tokenizer,
+                                    global_evaluation_context,
+                                    trace_parsing,
+                                    trace_evaluation,
+                                ),
+                                tokenizer=tokenizer,
+                                global_evaluation_context=global_evaluation_context,
+                                already_imported_files=set[str](),
+                                globals_dict=namespace,
+                            )
+                        # Functions defined in the namespace need to call the
+                        # functions of the template script they are used by
+                        namespace.update(
+                            _dispatching_functions(
+                                global_evaluation_context,
+                                (
+                                    name
+                                    for name, value in globals_to_set.items()
+                                    if callable(value)
+                                ),
+                            )
+                        )
+                        imported_namespaces[template_file_resolved] = (
+                            namespace,
+                            dependencies,
+                        )
+                # (The globals dict of the current script has been set before it runs)
+                assert globals_dict is not None
+                globals_dict.update(
+                    (key, value)
+                    for key, value in namespace.items()
+                    if key not in globals_to_set and key != "__builtins__"
+                )
             already_imported_files.add(template_file_resolved)
         except Exception as e:
             raise RuntimeError(
@@ -326,7 +619,7 @@ def evaluate_template_script(
 
     # Make these assignments, and prepare for undoing them later, is necessary
     if globals_dict is None:
-        globals_dict = globals_to_set
+        globals_dict = dict(globals_to_set)
         globals_backup = dict()
     else:
         globals_backup = {
@@ -336,51 +629,22 @@ def evaluate_template_script(
         }
         globals_dict.update(globals_to_set)
 
-    # We create an empty file, that will not (!) be removed when
-    # an exception happens. We use its path as virtual name
-    # when executing a script that is stored in a string.
-    # When the exec raises an exception, we store the template
-    # that we have already executed to the file, so that the user
-    # can "debug" the file that the exception mentions.
-    # We need individual files since macro expansion can be nested,
-    # so that we get different temporary files for each nesting level.
-    tmp_file, tmp_file_path = tempfile.mkstemp(
-        suffix=".py",
-        prefix=f"template_script_{next(global_evaluation_context.tmp_file_numbers)}",
-        dir=None,
-        text=True,
-    )
+    # Provide the table of texts the template script refers to. (It is kept in the
+    # globals, since functions defined by the script might use it later.)
+    if template_script.text_table is not None:
+        text_table_name, texts = template_script.text_table
+        globals_dict[text_table_name] = texts
 
     # Execute the template script and return what it reports using *insert*
-    template_script_code = str(template_script)
     try:
-        ast_object = compile(
-            template_script_code,
-            tmp_file_path,
-            mode="exec",
-            # flags=0, dont_inherit=False, optimize=- 1
-        )
-        exec(ast_object, globals_dict)
-
-        # Exec raised no exception, so we do not need the temporary file.
-        os.close(tmp_file)
-        os.remove(tmp_file_path)
-
+        # Tracebacks refer to the virtual file name of the compiled code
+        ast_object = _executable_code(template_script, global_evaluation_context)
+        with global_evaluation_context.evaluating(globals_to_set):
+            exec(ast_object, globals_dict)
         return "".join(output)
 
     except Exception as exc:
-        # save the template to the file and close it
-        try:
-            template_as_bytes = template_script_code.encode(
-                encoding="utf-8", errors="strict"
-            )
-            os.write(tmp_file, template_as_bytes)
-        finally:
-            os.close(tmp_file)
-        note = (
-            "Error occurred when executing template script.\n"
-            f' File "{tmp_file_path}"'
-        )
+        note = _script_error_note(template_script)
         # Depending on the used Python version, one of the following will happen.
         if hasattr(exc, "add_note"):  # pragma: no cover
             exc.add_note(note)
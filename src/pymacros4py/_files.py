@@ -1,11 +1,19 @@
+import io
 import os
+import stat
+import secrets
 import tempfile
+import functools
+import contextlib
 import subprocess
-from typing import TypeAlias, Optional
-from dataclasses import dataclass, asdict
+import concurrent.futures
+from collections.abc import Iterable, Iterator
+from typing import Any, BinaryIO, TypeAlias, Optional, TextIO
+from dataclasses import dataclass
 
 
 FileName: TypeAlias = str | bytes | os.PathLike
+StatSignature: TypeAlias = tuple[int, int, int, int]
 
 
 @dataclass
@@ -21,12 +29,29 @@ file_options = FileOptions(None, None, None)
 """ Options used for reading and writing files. See Python function *open*. """
 
 
-def read_file(in_file_name: FileName, finally_remove: bool = False) -> str:
-    """Load text from *in_file_name* using the chosen *file_options*.
+def _open_arguments(options: Optional[FileOptions]) -> dict[str, Any]:
+    """Return the keyword arguments for *open* given by the *options*, or, if
+    None, by the chosen *file_options*. (Cheaper than *asdict*.)"""
+    if options is None:
+        options = file_options
+    return {
+        "encoding": options.encoding,
+        "errors": options.errors,
+        "newline": options.newline,
+    }
+
+
+def read_file(
+    in_file_name: FileName,
+    finally_remove: bool = False,
+    options: Optional[FileOptions] = None,
+) -> str:
+    """Load text from *in_file_name* using the chosen *file_options*, or the
+    *options*, if given.
     If option *remove_on_error* is set to True and an exception occurs,
     remove the file."""
     try:
-        with open(in_file_name, **asdict(file_options)) as f_in:
+        with open(in_file_name, **_open_arguments(options)) as f_in:
             s_in = f_in.read()
     finally:
         if finally_remove:
@@ -34,10 +59,233 @@ def read_file(in_file_name: FileName, finally_remove: bool = False) -> str:
     return s_in
 
 
-def write_file(out_file_name: FileName, content: str) -> None:
-    """Write text to *out_file_name* using the chosen *file_options*."""
-    with open(out_file_name, "w", **asdict(file_options)) as f_out:
+def read_file_with_signature(
+    in_file_name: FileName, options: Optional[FileOptions] = None
+) -> tuple[str, StatSignature]:
+    """Like *read_file*, but also return the stat signature of the file that has
+    been read (see *stat_signature*)."""
+    with open(in_file_name, **_open_arguments(options)) as f_in:
+        signature = _signature(os.fstat(f_in.fileno()))
+        return f_in.read(), signature
+
+
+def read_file_chunks(
+    in_file_name: FileName,
+    options: Optional[FileOptions] = None,
+    signature: Optional[StatSignature] = None,
+    chunk_size: int = 1 << 20,
+) -> Iterator[str]:
+    """Iterate the text of *in_file_name*, read like by *read_file*, in chunks of
+    at most *chunk_size* characters. If a *signature* is given, and the file does
+    not have it, raise a RuntimeError."""
+    with open(in_file_name, **_open_arguments(options)) as f_in:
+        if signature is not None and _signature(os.fstat(f_in.fileno())) != signature:
+            raise RuntimeError(
+                f'File "{os.fsdecode(in_file_name)}" has changed during the expansion'
+            )
+        while chunk := f_in.read(chunk_size):
+            yield chunk
+
+
+def _signature(stat_result: os.stat_result) -> StatSignature:
+    return (
+        stat_result.st_mtime_ns,
+        stat_result.st_size,
+        stat_result.st_ino,
+        stat_result.st_dev,
+    )
+
+
+def stat_signature(file_name: FileName) -> StatSignature:
+    """Return modification time (in ns), size, inode and device of *file_name*.
+    If one of them differs from a previous result, the file might have
+    changed."""
+    return _signature(os.stat(file_name))
+
+
+def write_file(
+    out_file_name: FileName,
+    content: str,
+    options: Optional[FileOptions] = None,
+    only_if_changed: bool = False,
+) -> bool:
+    """Write text to *out_file_name* using the chosen *file_options*, or the
+    *options*, if given.
+
+    If *only_if_changed* is True, the file is only written, if its content
+    changes, see *writing_file_if_changed*. Then, it is replaced atomically.
+
+    Return whether the file has been written."""
+    if only_if_changed:
+        with writing_file_if_changed(out_file_name, options) as f_out:
+            f_out.write(content)
+        return f_out.changed
+    with open(out_file_name, "w", **_open_arguments(options)) as f_out:
         f_out.write(content)
+    return True
+
+
+def _create_tmp_file(path: str) -> tuple[int, str]:
+    """Create a new temporary file in the directory of *path*, for replacing the
+    file *path*. Return its file descriptor and path."""
+    directory, base_name = os.path.split(path)
+    while True:
+        tmp_file_path = os.path.join(
+            directory, f".{base_name}.{secrets.token_hex(4)}.tmp"
+        )
+        try:
+            tmp_file = os.open(
+                tmp_file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666
+            )
+            return tmp_file, tmp_file_path
+        except FileExistsError:  # pragma: no cover
+            pass
+
+
+def _replace_by_tmp_file(path: str, tmp_file_path: str) -> None:
+    """Replace the file *path* by the (closed) temporary file *tmp_file_path*."""
+    with contextlib.suppress(FileNotFoundError):
+        # Keep the permissions of an existing file
+        os.chmod(tmp_file_path, stat.S_IMODE(os.stat(path).st_mode))
+    os.replace(tmp_file_path, path)
+
+
+@contextlib.contextmanager
+def writing_file(
+    out_file_name: FileName, options: Optional[FileOptions] = None
+) -> Iterator[TextIO]:
+    """Open a temporary file in the directory of *out_file_name* for writing text,
+    using the chosen *file_options*, or the *options*, if given. When the context
+    is left without exception, replace *out_file_name* by the temporary file.
+    Otherwise, remove it, so that *out_file_name* is left unchanged."""
+    path = os.path.realpath(os.fsdecode(out_file_name))
+    tmp_file, tmp_file_path = _create_tmp_file(path)
+    try:
+        try:
+            f_out = open(tmp_file, "w", **_open_arguments(options))
+        except BaseException:
+            os.close(tmp_file)
+            raise
+        with f_out:
+            yield f_out
+        _replace_by_tmp_file(path, tmp_file_path)
+    except BaseException:
+        os.remove(tmp_file_path)
+        raise
+
+
+class ComparingWriter:
+    """
+    Writer of text for *writing_file_if_changed*. It encodes the text like a file
+    opened for writing text would, and compares the bytes with the content of
+    the existing file. Only from the first difference on, it writes a temporary
+    file: the equal part copied from the existing file, and the rest.
+    """
+
+    def __init__(self, path: str, options: Optional[FileOptions]) -> None:
+        self._path = path
+        self._buffer = io.BytesIO()
+        self._encoder = io.TextIOWrapper(
+            self._buffer, **_open_arguments(options), write_through=True
+        )
+        # Encodes the text exactly like writing a file with the options
+        try:
+            self._current: Optional[BinaryIO] = open(path, "rb")
+            self._current_size = os.fstat(self._current.fileno()).st_size
+        except FileNotFoundError:
+            self._current = None
+            self._current_size = 0
+        self._equal_bytes = 0
+        # Size of the beginning of the existing file that equals the text so far
+        self._tmp_file: Optional[BinaryIO] = None
+        self._tmp_file_path: Optional[str] = None
+        # Opened at the first difference
+        self.changed = False
+        """ True, if the content differs from the existing file. Final when the
+        context of *writing_file_if_changed* has been left. """
+
+    def write(self, text: str) -> int:
+        """Write *text*, and return the number of characters written."""
+        self._encoder.write(text)
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._write_bytes(data)
+        return len(text)
+
+    def _write_bytes(self, data: bytes) -> None:
+        if self._tmp_file is None:
+            if (
+                self._current is not None
+                # The text is not longer than the file
+                and self._equal_bytes + len(data) <= self._current_size
+                and self._current.read(len(data)) == data
+            ):
+                self._equal_bytes += len(data)
+                return
+            self._start_writing()
+        assert self._tmp_file is not None
+        self._tmp_file.write(data)
+
+    def _start_writing(self) -> None:
+        """Write the equal part of the existing file to a new temporary file."""
+        self.changed = True
+        tmp_file, self._tmp_file_path = _create_tmp_file(self._path)
+        try:
+            self._tmp_file = open(tmp_file, "wb")
+        except BaseException:  # pragma: no cover
+            os.close(tmp_file)
+            raise
+        if self._current is not None:
+            self._current.seek(0)
+            remaining = self._equal_bytes
+            while remaining:
+                data = self._current.read(min(remaining, 1 << 20))
+                self._tmp_file.write(data)
+                remaining -= len(data)
+
+    def _finish(self, success: bool) -> None:
+        """Replace the file, if the content has changed and writing has
+        succeeded. Otherwise, remove the temporary file."""
+        try:
+            if success:
+                self._encoder.flush()
+                self._write_bytes(self._buffer.getvalue())
+                if self._tmp_file is None and (
+                    self._current is None or self._equal_bytes < self._current_size
+                ):
+                    # The file does not exist, or it is longer
+                    self._start_writing()
+        finally:
+            if self._current is not None:
+                self._current.close()
+            if self._tmp_file is not None:
+                self._tmp_file.close()
+        if self._tmp_file_path is not None:
+            if success:
+                _replace_by_tmp_file(self._path, self._tmp_file_path)
+            else:
+                os.remove(self._tmp_file_path)
+
+
+@contextlib.contextmanager
+def writing_file_if_changed(
+    out_file_name: FileName, options: Optional[FileOptions] = None
+) -> Iterator[ComparingWriter]:
+    """Return a writer for text that is to be stored in *out_file_name*, using
+    the chosen *file_options*, or the *options*, if given. The existing file is
+    neither written nor touched, if the text equals its content. Otherwise, when
+    the context is left without exception, the file is replaced atomically by a
+    temporary file in its directory. The text is compared while it is written,
+    so that it is not held in memory. Attribute *changed* of the writer tells
+    whether the file has been written."""
+    writer = ComparingWriter(os.path.realpath(os.fsdecode(out_file_name)), options)
+    try:
+        yield writer
+    except BaseException:
+        writer._finish(success=False)
+        raise
+    writer._finish(success=True)
 
 
 def write_to_tempfile(content: str) -> str:
@@ -55,6 +303,40 @@ def write_to_tempfile(content: str) -> str:
     return str(tmp_file_name)
 
 
+def _run_process(args: list[str]) -> None:
+    """Run the command described by *args*, capturing both stdout and stderr, and
+    raise *subprocess.CalledProcessError*, if it fails."""
+    subprocess.run(
+        args,
+        # capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf8",
+        check=True,
+    )
+
+
+def _report_process_error(
+    path_strs: list[str], error: subprocess.CalledProcessError
+) -> None:
+    if len(path_strs) == 1:
+        print(
+            "\n"
+            "The called process raised an exception.\n"
+            "The file it operated on starts here:\n"
+            f'  File "{path_strs[0]}", line 0'
+        )
+    else:
+        print(
+            "\n"
+            "The called process raised an exception.\n"
+            "The files it operated on start here:\n"
+            + "\n".join(f'  File "{path_str}", line 0' for path_str in path_strs)
+        )
+    print("The process returned as output:")
+    print(str(error.output))
+
+
 def run_process_with_file(args: list[str], path_str: str) -> None:
     """Run the command described by *args* (compare subprocess.run)
     using *subprocess.run* and capture both stdout and stderr. If a
@@ -65,21 +347,102 @@ def run_process_with_file(args: list[str], path_str: str) -> None:
     pymacros4py.run_on_tempfile(["black", "path_to_file"], "path_to_file")
     """
     try:
-        subprocess.run(
-            args,
-            # capture_output=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            encoding="utf8",
-            check=True,
-        )
+        _run_process(args)
     except subprocess.CalledProcessError as e:
-        print(
-            "\n"
-            "The called process raised an exception.\n"
-            "The file it operated on starts here:\n"
-            f'  File "{path_str}", line 0'
-        )
-        print("The process returned as output:")
-        print(str(e.output))
+        _report_process_error([path_str], e)
         raise
+
+
+def _run_process_with_chunk(
+    args: list[str], isolate_failures: bool, path_strs: list[str]
+) -> list[tuple[list[str], subprocess.CalledProcessError]]:
+    """Run the command described by *args* once for all files *path_strs*, and
+    return the failures, each as the files of the failed run and the error. If
+    the run fails and *isolate_failures* is True, run the command again for each
+    of the files, and return the failures of these runs instead, or, if all of
+    them succeed, the failure of the run for all files."""
+    try:
+        _run_process(args + path_strs)
+        return []
+    except subprocess.CalledProcessError as e:
+        chunk_failure = (path_strs, e)
+    if not isolate_failures or len(path_strs) == 1:
+        return [chunk_failure]
+    failures = list[tuple[list[str], subprocess.CalledProcessError]]()
+    for path_str in path_strs:
+        try:
+            _run_process(args + [path_str])
+        except subprocess.CalledProcessError as e:
+            failures.append(([path_str], e))
+    # The run for all files can fail, although no file fails alone, e.g., if the
+    # error concerns several of the files
+    return failures or [chunk_failure]
+
+
+def run_process_with_files(
+    args: list[str],
+    path_strs: Iterable[str],
+    max_files_per_process: int = 64,
+    jobs: Optional[int] = None,
+    isolate_failures: bool = False,
+) -> None:
+    """Run the command described by *args* (compare *run_process_with_file*) for
+    many files, e.g., a code formatter for all generated files: The paths of the
+    files are appended to *args*, up to *max_files_per_process* paths per run
+    of the command, and up to *jobs* processes run concurrently.
+
+    For each run that fails, the captured output is printed, with an error
+    message that hints to the files of the run, like *run_process_with_file*
+    does. Afterwards, the *subprocess.CalledProcessError* of the first failed
+    run is raised.
+
+    :param args: The command, without the files.
+    :param path_strs: The paths of the files.
+    :param max_files_per_process: Maximal number of files per run.
+    :param jobs: Maximal number of concurrent runs. Default: number of CPUs.
+    :param isolate_failures: If True, and a run fails, the command is run again
+        for each of its files, to find out which of them fail, and failures are
+        reported for these files. If no file fails alone, the failure of the
+        run for all of them is reported. Use this only for commands that can
+        be run a second time for a file, e.g., checkers, but not formatters,
+        that would then process the files they have already changed again.
+
+    Example:
+    pymacros4py.run_process_with_files(["black", "-q"], ["file_1", "file_2"])
+    """
+    if max_files_per_process < 1:
+        raise ValueError(
+            f"max_files_per_process needs to be at least 1, not "
+            f"{max_files_per_process!r}"
+        )
+    if jobs is not None and jobs < 1:
+        raise ValueError(f"jobs needs to be at least 1, not {jobs!r}")
+    paths = list(path_strs)
+    if not paths:
+        return
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    # Spread the files over the jobs, but keep the runs within the limit
+    chunk_size = max(1, min(max_files_per_process, -(-len(paths) // jobs)))
+    chunks = [paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(jobs, len(chunks))
+    ) as executor:
+        failures = [
+            failure
+            for chunk_failures in executor.map(
+                functools.partial(_run_process_with_chunk, args, isolate_failures),
+                chunks,
+            )
+            for failure in chunk_failures
+        ]
+    for failed_paths, error in failures:
+        _report_process_error(failed_paths, error)
+    if failures:
+        failed_paths, error = failures[0]
+        note = "The called process failed for the files: " + ", ".join(failed_paths)
+        # Depending on the used Python version, one of the following will happen.
+        if hasattr(error, "add_note"):  # pragma: no cover
+            error.add_note(note)
+            raise error
+        raise RuntimeError(note) from error  # pragma: no cover
@@ -1,22 +1,221 @@
 import itertools
+import threading
+import contextlib
+from collections.abc import Callable, Hashable, Iterator
+from typing import Optional, Any
+
+from ._files import StatSignature, FileOptions
+from ._script_cache import ScriptCache
+from ._result_cache import Dependencies, FileContentCache, InsertedContentCache
+from ._template_script import TemplateScript
 
 
 class GlobalEvaluationContext:
     """
     Global context information for all template expansions happening under a single
-    PreProcessor.
+    PreProcessor. Expansions can run concurrently in several threads.
     """
 
-    def __init__(self) -> None:
-        self.already_inserted_content = dict[str, str]()
+    def __init__(
+        self,
+        script_cache: Optional[ScriptCache] = None,
+        inserted_content_cache: Optional[InsertedContentCache] = None,
+        file_options: Optional[FileOptions] = None,
+        reuse_imports: bool = False,
+        text_table: bool = False,
+        optimize_scripts: bool = False,
+        build_ast: bool = False,
+        parameterized_inserted_content_cache: Optional[InsertedContentCache] = None,
+        cache_parameterized_inserts: bool = False,
+        globals_key: Optional[Callable[[dict], Hashable]] = None,
+        file_content_cache: Optional[FileContentCache] = None,
+        stream_content_bytes: Optional[int] = None,
+    ) -> None:
+        self.file_options = file_options
+        # Options for reading template and content files, or None for using the
+        # global *file_options*.
+
+        self.text_table = text_table
+        # Whether template scripts take the texts of text sections from a table
+        # instead of string literals (see *TemplateScript*).
+
+        self.optimize_scripts = optimize_scripts
+        # Whether template scripts are generated with optimizations (see parameter
+        # *optimize* of *TemplateScript*).
+
+        self.build_ast = build_ast
+        # Whether template scripts are compiled from syntax trees built directly
+        # (see parameter *build_ast* of *TemplateScript*).
+
+        self.file_contents = (
+            FileContentCache() if file_content_cache is None else file_content_cache
+        )
+        # A cache of the contents of all files that have been read for template
+        # expansions: templates and files inserted by *insert_content*.
+
+        self.stream_content_bytes = stream_content_bytes
+        # Minimal size (in bytes) of the files that *insert_content* passes on
+        # chunk by chunk, instead of reading them completely, or None for never.
+
+        self.script_cache = script_cache
+        # Persistent cache of template scripts and their compiled code, or None.
+        # Used for all template expansions, including the recursive ones.
+
+        self.template_scripts = dict[
+            tuple[str, str, bool], tuple[StatSignature, TemplateScript]
+        ]()
+        # A cache of the template scripts (and their compiled code) of all template
+        # files that have already been loaded, keyed by resolved path, file name as
+        # given, and the trace_evaluation option. Entries are only valid if the
+        # stored stat signature of the file is still current.
+
+        self.already_inserted_content = (
+            InsertedContentCache()
+            if inserted_content_cache is None
+            else inserted_content_cache
+        )
         # A cache of the expansion results of all template files that have already
-        # been "inserted". Used by method *insert_from* of the evaluator to avoid
-        # unnecessary repeated expansions.
+        # been "inserted", together with the files the results depend on. Used by
+        # method *insert_from* of the evaluator to avoid unnecessary repeated
+        # expansions.
+
+        self.parameterized_inserted_content = (
+            InsertedContentCache()
+            if parameterized_inserted_content_cache is None
+            else parameterized_inserted_content_cache
+        )
+        # Like *already_inserted_content*, for the results of *insert_from* with a
+        # globals dict, keyed by the resolved path of the template and a
+        # fingerprint of the globals dict (or of an explicit cache key).
+
+        self.cache_parameterized_inserts = cache_parameterized_inserts
+        # Whether *insert_from* caches results also for globals dicts without an
+        # explicit cache key.
+
+        self.globals_key = globals_key
+        # Function that computes the cache key of a globals dict for
+        # *insert_from*, or None for fingerprinting its content.
 
-        self.tmp_file_numbers = itertools.count()
+        self.imported_namespaces: Optional[dict[str, tuple[dict, Dependencies]]] = (
+            dict() if reuse_imports else None
+        )
+        # If imports are re-used: A cache of the namespaces defined by the
+        # templates that have already been imported, together with the files they
+        # depend on. Used by method *import_from* of the evaluator. None means, that
+        # each import executes the template again.
+
+        self._insert_locks = dict[str, tuple[threading.RLock, int]]()
+        self._insert_locks_lock = threading.Lock()
+        # Per key (e.g., a template file), a lock held while it is expanded for
+        # *insert_from*, and the number of threads holding or waiting for it.
+        # Ensures that concurrent inserts of the same template expand it only once.
+
+        self._thread_local = threading.local()
+        # Per thread, attribute *dependency_recorders*: Stack of the dependencies
+        # recorded for the expansions that are currently running with recording
+        # in the thread (innermost last). And attribute *evaluation_functions*:
+        # Stack of the functions provided to the template scripts that are
+        # currently evaluated in the thread (innermost last).
+
+        self._tmp_file_numbers = itertools.count()
+        self._tmp_file_numbers_lock = threading.Lock()
         # Global counter for generated temporary files. During recursive evaluation,
         # all files 'on the stack' exist in parallel, so they are numbered.
         # Currently, an exception stops the evaluation and only the files on the
         # stack remains (for debugging), but for the future, it might be possible
         # to continue expansion with other files, and for this, be use a global
         # counter here, and not one just for files on the local evaluation stack.
+
+    def next_tmp_file_number(self) -> int:
+        """Return the next number for a generated temporary file."""
+        with self._tmp_file_numbers_lock:
+            return next(self._tmp_file_numbers)
+
+    def _dependency_recorders(self) -> list[Dependencies]:
+        try:
+            recorders: list[Dependencies] = self._thread_local.dependency_recorders
+        except AttributeError:
+            recorders = self._thread_local.dependency_recorders = []
+        return recorders
+
+    def _evaluation_functions(self) -> list[dict[str, Any]]:
+        try:
+            stack: list[dict[str, Any]] = self._thread_local.evaluation_functions
+        except AttributeError:
+            stack = self._thread_local.evaluation_functions = []
+        return stack
+
+    @contextlib.contextmanager
+    def evaluating(self, functions: dict[str, Any]) -> Iterator[None]:
+        """Register *functions* (e.g., *insert*) as the functions of the template
+        script that is evaluated in the current thread within the context."""
+        stack = self._evaluation_functions()
+        stack.append(functions)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def current_evaluation_function(self, name: str) -> Callable[..., Any]:
+        """Return the function *name* (e.g., "insert") of the innermost template
+        script that is currently evaluated in the current thread."""
+        stack = self._evaluation_functions()
+        if not stack:
+            raise RuntimeError(
+                f"Function {name} called outside of a template expansion"
+            )
+        return stack[-1][name]
+
+    @contextlib.contextmanager
+    def single_flight(self, key: str) -> Iterator[None]:
+        """Run the code within the context exclusively for *key*: Another thread
+        that enters the context for the same key waits until the first one has
+        left it, and then, typically, finds the results of the first one in a
+        cache."""
+        with self._insert_locks_lock:
+            lock, users = self._insert_locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.RLock()
+            self._insert_locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._insert_locks_lock:
+                lock, users = self._insert_locks[key]
+                if users == 1:
+                    # No other thread holds or waits for the lock: Drop it, so
+                    # that locks do not accumulate for all keys ever used
+                    del self._insert_locks[key]
+                else:
+                    self._insert_locks[key] = (lock, users - 1)
+
+    def record_dependency(self, path: str, signature: StatSignature) -> None:
+        """Record that the currently running expansion depends on the file *path*
+        with the stat signature *signature*."""
+        recorders = self._dependency_recorders()
+        if recorders:
+            recorders[-1].setdefault(path, signature)
+
+    def record_dependencies(self, dependencies: Dependencies) -> None:
+        """Record that the currently running expansion depends on all files in
+        *dependencies*, e.g., because it re-uses a result depending on them."""
+        recorders = self._dependency_recorders()
+        if recorders:
+            recorder = recorders[-1]
+            for path, signature in dependencies.items():
+                recorder.setdefault(path, signature)
+
+    @contextlib.contextmanager
+    def recording_dependencies(self) -> Iterator[Dependencies]:
+        """Record the files an expansion, running within the context, depends on,
+        and return them as value of the context. Afterwards, they are recorded
+        also as dependencies of an enclosing expansion with recording."""
+        dependencies = Dependencies()
+        recorders = self._dependency_recorders()
+        recorders.append(dependencies)
+        try:
+            yield dependencies
+        finally:
+            recorders.pop()
+            self.record_dependencies(dependencies)
@@ -0,0 +1,445 @@
+from collections.abc import Iterable, Iterator
+from typing import Optional, TypeAlias, Union
+
+from ._files import FileOptions, StatSignature, read_file_chunks
+
+Cell: TypeAlias = list[str]
+""" A mutable cell holding the leading whitespace of one or more lines """
+
+Line: TypeAlias = tuple[Cell, str]
+""" A line of macro output, given as *(cell, content)*. It stands for the string
+*cell[0] + content*. Lines of a macro output with the same leading whitespace
+share their cell, so re-indenting them needs only a single change of the cell. """
+
+Lines: TypeAlias = list[Union[Line, "Lines", "FileSegment"]]
+""" Lines in their order, where a nested list or a file segment stands for its
+lines """
+
+# Characters that *str.splitlines* treats as line boundaries
+_line_breaks = frozenset("\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029")
+
+
+def _separate_indentation_and_content_optionally_nl(s: str) -> tuple[str, str]:
+    """Get the whitespace characters, that the *text* starts with, and the rest of it
+
+    :param s: A string without newline characters except, maybe, the last character
+    """
+
+    # Separate the line and a possible trailing single newline
+    if s and s[-1] == "\n":
+        s, newline = s[:-1], s[-1]
+    else:
+        s, newline = s, ""
+
+    # Strip any whitespace (s has no NL anymore) starting from the left
+    s_stripped = s.lstrip()
+    # Extract exactly the stripped whitespaces
+    whitespace_len = len(s) - len(s_stripped)
+
+    # Return the leading whitespace if s, and the following content (optionally with
+    # the newline, we put aside at the beginning
+    return s[0:whitespace_len], s_stripped + newline
+
+
+def _split_lines(chunks: Iterable[str]) -> Iterator[list[str]]:
+    """Split the text given by *chunks* into lines, like *str.splitlines* (with
+    *keepends*) splits the whole text, and yield the lines in lists, a list per
+    chunk. (The last line of a chunk is moved to the next one.)"""
+    carry = ""
+    for chunk in chunks:
+        lines = (carry + chunk).splitlines(keepends=True)
+        carry = lines.pop()
+        if lines:
+            yield lines
+    if carry:
+        yield [carry]
+
+
+class FileSegment:
+    """
+    Complete lines of a file that are part of a macro output, but are read from
+    the file only when the output is passed on, chunk by chunk. So, the output
+    does not hold the text of the lines. Like the other lines of the output, the
+    lines of the segment share a cell per leading whitespace, see *Line*.
+
+    :param file_name: The file.
+    :param options: Options for reading the file.
+    :param signature: Stat signature of the file. If it changes, reading the
+        segment fails.
+    :param first_line: Index of the first line of the segment in the file.
+    :param count: Number of lines in the segment.
+    :param cells: The cells of the lines, by their leading whitespace.
+    """
+
+    def __init__(
+        self,
+        file_name: str,
+        options: Optional[FileOptions],
+        signature: StatSignature,
+        first_line: int,
+        count: int,
+        cells: dict[str, Cell],
+    ) -> None:
+        self._file_name = file_name
+        self._options = options
+        self._signature = signature
+        self._first_line = first_line
+        self._count = count
+        self._cells = cells
+
+    def _line_lists(self) -> Iterator[list[str]]:
+        """Iterate the lines of the segment, as they are in the file, in lists."""
+        skipped = self._first_line
+        remaining = self._count
+        for lines in _split_lines(
+            read_file_chunks(self._file_name, self._options, self._signature)
+        ):
+            if skipped:
+                if skipped >= len(lines):
+                    skipped -= len(lines)
+                    continue
+                lines = lines[skipped:]
+                skipped = 0
+            if len(lines) >= remaining:
+                yield lines[:remaining]
+                return
+            remaining -= len(lines)
+            yield lines
+
+    def __iter__(self) -> Iterator[Line]:
+        for lines in self._line_lists():
+            for line in lines:
+                whitespace, content = _separate_indentation_and_content_optionally_nl(
+                    line
+                )
+                yield self._cells[whitespace], content
+
+    def chunks(self) -> Iterator[str]:
+        """Iterate the text of the lines, as re-indented, in chunks."""
+        if all(cell[0] == whitespace for whitespace, cell in self._cells.items()):
+            # Nothing has been re-indented: pass the lines through
+            for lines in self._line_lists():
+                yield "".join(lines)
+            return
+        for lines in self._line_lists():
+            strings = list[str]()
+            for line in lines:
+                whitespace, content = _separate_indentation_and_content_optionally_nl(
+                    line
+                )
+                strings.append(self._cells[whitespace][0])
+                strings.append(content)
+            yield "".join(strings)
+
+
+def _iter_lines(lines: Lines) -> Iterator[Line]:
+    """Iterate the lines of *lines*, including those of nested lists, in order."""
+    stack = [iter(lines)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, tuple):
+                yield item
+            else:
+                stack.append(iter(item))
+                break
+        else:
+            stack.pop()
+
+
+def _line_strings(lines: Lines) -> Iterator[str]:
+    """Iterate the strings the lines of *lines* consist of, in order."""
+    for cell, content in _iter_lines(lines):
+        yield cell[0]
+        yield content
+
+
+def _chunks(lines: Lines) -> Iterator[str]:
+    """Iterate the text of *lines* in chunks: Consecutive lines held in memory are
+    joined, and file segments are read chunk by chunk."""
+    strings = list[str]()
+    stack = [iter(lines)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, tuple):
+                strings.append(item[0][0])
+                strings.append(item[1])
+            elif isinstance(item, FileSegment):
+                if strings:
+                    yield "".join(strings)
+                    strings.clear()
+                yield from item.chunks()
+            else:
+                stack.append(iter(item))
+                break
+        else:
+            stack.pop()
+    if strings:
+        yield "".join(strings)
+
+
+class MacroOutput:
+    """
+    Output of a macro: The text inserted by the macro code, and the re-indented
+    outputs of the macros nested in it.
+
+    The text is stored as lines, separated into leading whitespace and content.
+    When the macro ends, *reindent* changes only the (shared) leading whitespace
+    of the lines, and *extend* takes over the lines of the nested macro as a
+    whole, instead of copying them. The output is concatenated only once, by
+    *materialize*, when it reaches the output of the template script. Thus, the
+    costs of nested macros do not grow with the nesting depth times the output
+    size.
+
+    In the rare cases, where re-indentation can change how the output splits
+    into lines (a line that ends with a single carriage return, a line that
+    consists of whitespace and a line break other than newline, or a macro
+    indentation that contains a line break), the output is passed on to the
+    enclosing macro as text, and it is split there again.
+    """
+
+    def __init__(self) -> None:
+        self._first: Optional[Line] = None
+        # First complete line. Its cell is not shared with other lines.
+        self._lines: Lines = []
+        # Subsequent complete lines
+        self._cells = list[Cell]()
+        # Cells of the subsequent lines, including those of nested lists
+        self._cells_by_whitespace = dict[str, Cell]()
+        self._partial = list[str]()
+        # Text of a line that is not complete yet (or ends with "\r")
+        self._tail = ""
+        # Text following the lines, after re-indentation
+        self._split_again = False
+        # True if the enclosing macro needs to split the output again
+        self._file_segments = False
+        # True if lines are held by file segments
+
+    def _add_line(self, line: str) -> None:
+        """Add *line*, which ends with a line break, as complete line."""
+        whitespace, content = _separate_indentation_and_content_optionally_nl(line)
+        if line[-1] == "\r" or not content:
+            # After re-indentation, a following line could start with "\n", or
+            # the line break, as part of the leading whitespace, could be removed.
+            # Then, lines would join.
+            self._split_again = True
+        if self._first is None:
+            self._first = ([whitespace], content)
+            return
+        cell = self._cells_by_whitespace.get(whitespace)
+        if cell is None:
+            cell = self._cells_by_whitespace[whitespace] = [whitespace]
+            self._cells.append(cell)
+        self._lines.append((cell, content))
+
+    def _complete_partial_line(self) -> None:
+        self._add_line("".join(self._partial))
+        self._partial.clear()
+
+    def write(self, text: str) -> None:
+        """Append *text* to the output."""
+        if not text:
+            return
+        if self._partial and self._partial[-1][-1] == "\r":
+            # The partial line is complete, except for a "\n" following the "\r"
+            if text[0] == "\n":
+                self._partial.append("\n")
+                text = text[1:]
+            self._complete_partial_line()
+            if not text:
+                return
+        *lines, last_line = text.splitlines(keepends=True)
+        for line in lines:
+            if self._partial:
+                self._partial.append(line)
+                self._complete_partial_line()
+            else:
+                self._add_line(line)
+        self._partial.append(last_line)
+        if last_line[-1] in _line_breaks and last_line[-1] != "\r":
+            self._complete_partial_line()
+
+    def write_file(
+        self,
+        file_name: str,
+        options: Optional[FileOptions],
+        signature: StatSignature,
+    ) -> None:
+        """Append the text of the file *file_name*, read with the *options*, like
+        *write* would do. But lines in the middle of the file are not held in
+        memory. Instead, a *FileSegment* refers to them.
+
+        :param file_name: The file.
+        :param options: Options for reading the file.
+        :param signature: Stat signature of the file. If the file does not have
+            it, reading the file fails.
+        """
+        segment_start: Optional[int] = None
+        cells = dict[str, Cell]()
+        pending: Optional[str] = None
+        # The line read last. The last line of the file is written, since it
+        # might continue.
+        line_no = -1
+        for lines in _split_lines(read_file_chunks(file_name, options, signature)):
+            for line in lines:
+                if pending is not None:
+                    if segment_start is None and (self._first is None or self._partial):
+                        # The line completes the first line or a partial line
+                        self.write(pending)
+                    else:
+                        if segment_start is None:
+                            segment_start = line_no
+                        whitespace, content = (
+                            _separate_indentation_and_content_optionally_nl(pending)
+                        )
+                        if pending[-1] == "\r" or not content:
+                            self._split_again = True
+                        cell = self._cells_by_whitespace.get(whitespace)
+                        if cell is None:
+                            cell = self._cells_by_whitespace[whitespace] = [whitespace]
+                            self._cells.append(cell)
+                        cells[whitespace] = cell
+                pending = line
+                line_no += 1
+        if segment_start is not None:
+            self._lines.append(
+                FileSegment(
+                    file_name,
+                    options,
+                    signature,
+                    segment_start,
+                    line_no - segment_start,
+                    cells,
+                )
+            )
+            self._file_segments = True
+        if pending is not None:
+            self.write(pending)
+
+    def extend(self, nested: "MacroOutput") -> None:
+        """Append the re-indented output of the *nested* macro. Afterwards,
+        *nested* must not be used anymore."""
+        if nested._first is None:
+            self.write(nested._tail)
+            return
+        if self._partial:
+            # The first line of the nested output continues our partial line
+            cell, content = nested._first
+            self.write(cell[0] + content)
+            if self._partial:
+                self.write("".join(_line_strings(nested._lines)) + nested._tail)
+                return
+        elif self._first is None:
+            self._first = nested._first
+        else:
+            self._lines.append(nested._first)
+            self._cells.append(nested._first[0])
+        if nested._lines:
+            self._lines.append(nested._lines)
+            self._cells.extend(nested._cells)
+            self._file_segments |= nested._file_segments
+        self.write(nested._tail)
+
+    def materialize(self) -> str:
+        """Return the output as string."""
+        if self._first is None:
+            return "".join(self._partial) + self._tail
+        first_cell, first_content = self._first
+        return "".join(
+            [
+                first_cell[0],
+                first_content,
+                *_line_strings(self._lines),
+                *self._partial,
+                self._tail,
+            ]
+        )
+
+    def chunks(self) -> Iterator[str]:
+        """Iterate the output in chunks. Lines held by file segments are read
+        from the files."""
+        if not self._file_segments or self._first is None:
+            yield self.materialize()
+            return
+        first_cell, first_content = self._first
+        yield first_cell[0] + first_content
+        yield from _chunks(self._lines)
+        yield "".join(self._partial) + self._tail
+
+    def reindent(self, indentation: str, is_embedded: bool, content_line: str) -> None:
+        """Re-indent the output at the end of the macro: The leading whitespace of
+        the first line is the base indentation of the output. It is replaced by
+        *indentation* (or removed, if the macro *is_embedded*). In each subsequent
+        line, the base indentation is replaced by *indentation*. Lines without
+        indentation are taken as they are.
+
+        :param indentation: The indentation of the macro.
+        :param is_embedded: True, if the macro is embedded in a line of text.
+        :param content_line: Description of the template line of the macro, for
+            error messages.
+        """
+        last_line = "".join(self._partial)
+        self._partial.clear()
+        first_indentation = "" if is_embedded else indentation
+
+        if self._first is None:
+            if last_line:
+                # Only a single line, and it is not complete
+                _, content = _separate_indentation_and_content_optionally_nl(last_line)
+                self._tail = first_indentation + content
+            return
+
+        first_cell = self._first[0]
+        base_indentation = first_cell[0]
+
+        def keep(whitespace: str) -> bool:
+            # Zero indentation in a context with none-zero base indentation:
+            # Just take the line as it is
+            return len(whitespace) == 0 and len(base_indentation) > 0
+
+        def is_valid(whitespace: str) -> bool:
+            # If the line is indented, indentation (as a string)
+            # need to start with exactly the base indentation
+            return (
+                keep(whitespace)
+                or whitespace[0 : len(base_indentation)] == base_indentation
+            )
+
+        # Check the indentation of the lines, and report the first invalid one
+        if not all(is_valid(cell[0]) for cell in self._cells):
+            for cell, content in _iter_lines(self._lines):
+                if not is_valid(cell[0]):
+                    self._raise_syntax_error(content_line, cell[0] + content)
+        last_line_whitespace, _ = _separate_indentation_and_content_optionally_nl(
+            last_line
+        )
+        if last_line and not is_valid(last_line_whitespace):
+            self._raise_syntax_error(content_line, last_line)
+
+        # Replace the base indentation by the macro indentation
+        first_cell[0] = first_indentation
+        if base_indentation or indentation:
+            for cell in self._cells:
+                if not keep(cell[0]):
+                    cell[0] = indentation + cell[0][len(base_indentation) :]
+            if last_line and not keep(last_line_whitespace):
+                last_line = indentation + last_line[len(base_indentation) :]
+        self._tail = last_line
+
+        if self._split_again or any(c in _line_breaks for c in indentation):
+            self._tail = self.materialize()
+            self._first = None
+            self._lines = []
+            self._cells = []
+            self._file_segments = False
+
+    @staticmethod
+    def _raise_syntax_error(content_line: str, line: str) -> None:
+        raise RuntimeError(
+            f"{content_line}:\n"
+            f"Output syntax error: indentation of the following line of the "
+            f"results of the template script from the above given template "
+            f"line is not an extension of the base indentation of these "
+            f"results:\n"
+            f">{line.rstrip()}<\n"
+            f"(Start of line shown enclosed by characters '>' and '<')"
+        )
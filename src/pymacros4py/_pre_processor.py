@@ -1,11 +1,30 @@
+import os
 import difflib
+import functools
+from collections.abc import Callable, Generator, Hashable, Iterable, Iterator
 from typing import Optional
 
 from ._tokenizer import Tokenizer
-from ._template_script import TemplateScript
-from ._files import read_file, write_file, FileName
+from ._script_cache import ScriptCache
+from ._result_cache import FileContentCache, InsertedContentCache, CacheStatistics
+from ._files import (
+    read_file,
+    writing_file,
+    writing_file_if_changed,
+    FileName,
+    FileOptions,
+)
 from ._global_evaluation_context import GlobalEvaluationContext
-from ._evaluator import evaluate_template_script
+from ._evaluator import (
+    compile_template_script,
+    evaluate_template_script,
+    load_template_script,
+)
+from ._template_script import TemplateScript
+from ._compiled_template import CompiledTemplate
+from ._batch import ExpansionOutcome, WarmWorkerPool, expand_many
+from ._stream import Sink, iterate_chunks
+from ._check import ComparingSink, Mismatch, MismatchFound, unified_diff
 
 
 class PreProcessor:
@@ -15,19 +34,149 @@ class PreProcessor:
 
     Results are cached / reused within the PreProcessor.
 
+    A PreProcessor can be used by several threads concurrently.
+
     :param tokenizer: Optionally, you can provide a non-standard tokenizer,
         e.g., one with a customized syntax.
+    :param script_cache_dir: Optionally, a directory for a persistent cache of
+        template scripts and their compiled code. Then, unchanged templates are
+        neither parsed nor compiled again, also across runs of the PreProcessor.
+    :param max_inserted_content_bytes: Optionally, a memory budget for the cached
+        results of *insert_from*. If it is exceeded, the least recently used
+        results are evicted.
+    :param spill_inserted_content: If True, evicted results of *insert_from* are
+        stored in a temporary directory and re-used from there, instead of being
+        dropped.
+    :param file_options: Optionally, options for reading and writing files that
+        are used by this PreProcessor instead of the global *file_options*.
+    :param reuse_imports: If True, a template imported by *import_from* is
+        executed only once (and again, if a file it depends on changes), in a
+        namespace of its own, and each import copies the attributes defined there.
+        Then, the imported template cannot use attributes of the importing
+        template, and mutable values are shared by all importers. If False, each
+        import executes the template in the namespace of the importing template.
+    :param text_table: If True, the template scripts do not contain the texts of
+        the text sections as string literals, but take them by index from a table
+        that is passed to the script. This keeps the scripts small and fast to
+        compile, for templates with large text sections. The template scripts
+        returned by *template_script* show the references to the table then.
+    :param optimize_scripts: If True, the template scripts are generated with
+        optimizations that do not change the results: Texts that follow each
+        other directly are inserted by a single call, and macros that cannot
+        insert anything (imports, function definitions and assignments of
+        constants) do without the bookkeeping for re-indenting their output.
+    :param build_ast: If True, the syntax trees of the template scripts are built
+        directly while parsing the templates, and compiled instead of the code of
+        the scripts. The line numbers in the trees are those of the templates, so
+        that tracebacks of exceptions in macro code show the template lines.
+        (Templates with syntax errors or with compound statements in unusual
+        forms, and the tracing of evaluations, fall back to compiling the code.)
+        Building the trees takes longer than parsing the code would, but, with a
+        script cache, only for templates that are not in the cache.
+    :param cache_parameterized_inserts: If True, *insert_from* re-uses its
+        results also for calls with a globals dict, if the template has been
+        inserted before with a globals dict of the same content. The content is
+        compared by a fingerprint: values of the built-in constant types (and
+        tuples of them) by their representation, other values by their pickle
+        bytes, i.e., functions and classes by their names. Globals dicts with
+        values that cannot be pickled are not cached. (An explicit *cache_key*
+        given to *insert_from* enables caching for the call also without this
+        option.)
+    :param globals_key: Optionally, a function that returns the cache key for
+        a globals dict of *insert_from*, which is fingerprinted instead of the
+        globals dict. Used if parameterized inserts are cached. It needs to be
+        picklable for *expand_many*.
+    :param max_file_content_bytes: The memory budget for the cached contents of
+        the files read by this PreProcessor (templates and files inserted by
+        *insert_content*), 64 MiB by default. Each file is read only once, and
+        again, if it changes (see *stat_signature*). If the budget is exceeded,
+        the least recently used contents are evicted. 0 disables the cache, and
+        None lifts the limit.
+    :param stream_content_bytes: Optionally, a file size (in bytes) from which
+        on *insert_content* does not read a file completely (and does not cache
+        its content). Instead, the lines in the middle of the file are read again
+        when the output of the outermost macro is passed on, chunk by chunk,
+        and re-indented chunk by chunk, if needed. If the result of the
+        expansion goes to a sink or a file, the content of the file is never
+        held in memory as a whole.
     """
 
-    def __init__(self, tokenizer: Optional[Tokenizer] = None) -> None:
+    def __init__(
+        self,
+        tokenizer: Optional[Tokenizer] = None,
+        script_cache_dir: Optional[FileName] = None,
+        max_inserted_content_bytes: Optional[int] = None,
+        spill_inserted_content: bool = False,
+        file_options: Optional[FileOptions] = None,
+        reuse_imports: bool = False,
+        text_table: bool = False,
+        optimize_scripts: bool = False,
+        build_ast: bool = False,
+        cache_parameterized_inserts: bool = False,
+        globals_key: Optional[Callable[[dict], Hashable]] = None,
+        max_file_content_bytes: Optional[int] = FileContentCache.default_max_bytes,
+        stream_content_bytes: Optional[int] = None,
+    ) -> None:
         self._tokenizer = Tokenizer() if tokenizer is None else tokenizer
         # Tokenizer to be used by the PreProcessor. Currently, the same is
         # used for all files and for recursive evaluations the might start.
         # But this might change in the future.
-        self._global_evaluation_context = GlobalEvaluationContext()
+        self._worker_factory: Callable[[], PreProcessor] = functools.partial(
+            PreProcessor,
+            self._tokenizer,
+            script_cache_dir=script_cache_dir,
+            max_inserted_content_bytes=max_inserted_content_bytes,
+            spill_inserted_content=spill_inserted_content,
+            file_options=file_options,
+            reuse_imports=reuse_imports,
+            text_table=text_table,
+            optimize_scripts=optimize_scripts,
+            build_ast=build_ast,
+            cache_parameterized_inserts=cache_parameterized_inserts,
+            globals_key=globals_key,
+            max_file_content_bytes=max_file_content_bytes,
+            stream_content_bytes=stream_content_bytes,
+        )
+        # Creates PreProcessors with the same configuration in worker processes
+        self._global_evaluation_context = GlobalEvaluationContext(
+            None if script_cache_dir is None else ScriptCache(script_cache_dir),
+            InsertedContentCache(max_inserted_content_bytes, spill_inserted_content),
+            file_options,
+            reuse_imports,
+            text_table,
+            optimize_scripts,
+            build_ast,
+            InsertedContentCache(max_inserted_content_bytes, spill_inserted_content),
+            cache_parameterized_inserts,
+            globals_key,
+            FileContentCache(max_file_content_bytes),
+            stream_content_bytes,
+        )
         # Context information for all template expansions happening under the
         # current PreProcessor.
 
+    @property
+    def file_options(self) -> Optional[FileOptions]:
+        """The file options of this PreProcessor, or None, if it uses the global
+        *file_options*."""
+        return self._global_evaluation_context.file_options
+
+    @property
+    def inserted_content_statistics(self) -> CacheStatistics:
+        """Hits, misses and evictions of the cache of *insert_from* results."""
+        return self._global_evaluation_context.already_inserted_content.statistics
+
+    @property
+    def parameterized_insert_statistics(self) -> CacheStatistics:
+        """Hits, misses and evictions of the cache of *insert_from* results for
+        calls with a globals dict."""
+        return self._global_evaluation_context.parameterized_inserted_content.statistics
+
+    @property
+    def file_content_statistics(self) -> CacheStatistics:
+        """Hits, misses and evictions of the cache of file contents."""
+        return self._global_evaluation_context.file_contents.statistics
+
     @staticmethod
     def diff(str1: str, str2: str, fromfile_txt: str, tofile_txt: str) -> str:
         """Compare two multi-line strings. If they are equal, return the empty string.
@@ -54,9 +203,11 @@ class PreProcessor:
         :param template_file: Template to expand.
         :param trace_parsing: Print parsing log to stderr.
         """
-        template = read_file(template_file)
-        template_script = TemplateScript(
-            str(template_file), template, self._tokenizer, trace_parsing
+        template_script = load_template_script(
+            os.fsdecode(template_file),
+            self._tokenizer,
+            self._global_evaluation_context,
+            trace_parsing,
         )
         return str(template_script)
 
@@ -78,27 +229,55 @@ class PreProcessor:
         :param trace_parsing: Print parsing log to stderr.
         :param trace_evaluation: Print evaluation log to stderr.
         """
-        template = read_file(template_file)
-        template_script = TemplateScript(
-            str(template_file),
-            template,
+        result = self._expand(template_file, trace_parsing, trace_evaluation)
+        if diffs_to_template:
+            template, _ = self._global_evaluation_context.file_contents.read(
+                template_file, self.file_options
+            )
+            return self.diff(template, result, "template", "expansion result")
+        return result
+
+    def _expand(
+        self,
+        template_file: FileName,
+        trace_parsing: bool,
+        trace_evaluation: bool,
+        sink: Optional[Sink] = None,
+    ) -> str:
+        """Expand the template file. Return the result, or, if a *sink* is given,
+        pass the result to the sink and return the empty string."""
+        template_script = load_template_script(
+            os.fsdecode(template_file),
             self._tokenizer,
+            self._global_evaluation_context,
             trace_parsing,
             trace_evaluation,
         )
+        return self._evaluate(template_script, None, sink)
 
+    def _evaluate(
+        self,
+        template_script: TemplateScript,
+        globals_dict: Optional[dict],
+        sink: Optional[Sink] = None,
+    ) -> str:
+        """Evaluate the *template_script* of a template, as top-level expansion,
+        with the *globals_dict* (or a new one, if None). Return the result, or,
+        if a *sink* is given, pass the result to the sink and return the empty
+        string."""
         try:
-            result = evaluate_template_script(
+            return evaluate_template_script(
                 template_script=template_script,
                 tokenizer=self._tokenizer,
                 global_evaluation_context=self._global_evaluation_context,
                 already_imported_files=set[str](),
-                globals_dict=None,
+                globals_dict=globals_dict,
+                sink=sink,
             )
         except Exception as exc:
             note = (
                 f"Error occurred when expanding the following template: "
-                f"  {str(template_file)}"
+                f"  {template_script.file_name}"
             )
             # Depending on the used Python version, one of the following will happen.
             if hasattr(exc, "add_note"):  # pragma: no cover
@@ -106,10 +285,52 @@ class PreProcessor:
                 raise
             raise RuntimeError(note) from exc  # pragma: no cover
 
-        return (
-            self.diff(template, result, "template", "expansion result")
-            if diffs_to_template
-            else result
+    def expand_file_to_sink(
+        self,
+        template_file: FileName,
+        sink: Sink,
+        trace_parsing: bool = False,
+        trace_evaluation: bool = False,
+    ) -> None:
+        """
+        Load a template, expand it, and pass the result in chunks to *sink*, e.g.,
+        to the *write* method of a file or a socket, or to a function updating
+        a hash. Each chunk is passed as soon as it is final, i.e., as soon as it
+        is not part of the output of a macro that is still running. So, the
+        result as a whole is never held in memory.
+
+        If the expansion fails, the chunks passed to the sink so far remain
+        passed.
+
+        :param template_file: Template to expand.
+        :param sink: Callable that is called with each chunk of the result.
+        :param trace_parsing: Print parsing log to stderr.
+        :param trace_evaluation: Print evaluation log to stderr.
+        """
+        self._expand(template_file, trace_parsing, trace_evaluation, sink)
+
+    def expand_iter(
+        self,
+        template_file: FileName,
+        trace_parsing: bool = False,
+        trace_evaluation: bool = False,
+    ) -> Generator[str, None, None]:
+        """
+        Load a template, expand it, and yield the result in chunks, each chunk as
+        soon as it is final (see *expand_file_to_sink*).
+
+        The expansion runs in a separate thread. It pauses, while chunks it has
+        produced are waiting to be taken by the iteration. If the iteration is
+        stopped early, e.g., by closing the iterator, the expansion is cancelled.
+
+        :param template_file: Template to expand.
+        :param trace_parsing: Print parsing log to stderr.
+        :param trace_evaluation: Print evaluation log to stderr.
+        """
+        return iterate_chunks(
+            lambda sink: self._expand(
+                template_file, trace_parsing, trace_evaluation, sink
+            )
         )
 
     def expand_file_to_file(
@@ -131,14 +352,180 @@ class PreProcessor:
         :param trace_parsing: Print parsing log to stderr.
         :param trace_evaluation: Print evaluation log to stderr.
         """
-        result = self.expand_file(
-            template_file,
-            trace_parsing=trace_parsing,
-            trace_evaluation=trace_evaluation,
-        )
         if diffs_to_result_file:
-            content = read_file(result_file)
+            result = self.expand_file(
+                template_file,
+                trace_parsing=trace_parsing,
+                trace_evaluation=trace_evaluation,
+            )
+            content = read_file(result_file, options=self.file_options)
             return self.diff(content, result, "current content", "expansion result")
-        else:
-            write_file(result_file, result)
-            return ""
+        # Stream the result into a temporary file, that replaces the result file
+        # only if the expansion succeeds
+        with writing_file(result_file, self.file_options) as f_out:
+            self.expand_file_to_sink(
+                template_file, f_out.write, trace_parsing, trace_evaluation
+            )
+        return ""
+
+    def expand_file_to_file_if_changed(
+        self,
+        template_file: FileName,
+        result_file: FileName,
+        trace_parsing: bool = False,
+        trace_evaluation: bool = False,
+    ) -> bool:
+        """Load a template file, expand it, and save the result to a file, but
+        only if its content changes. Then, the file is replaced atomically, and
+        only if the expansion succeeds. Otherwise, it is not touched, e.g., its
+        modification time stays the same. The result is compared with the
+        content of the file while the expansion runs. (See
+        *writing_file_if_changed*.)
+
+        :param template_file: Template to expand.
+        :param result_file: File to store the results in.
+        :param trace_parsing: Print parsing log to stderr.
+        :param trace_evaluation: Print evaluation log to stderr.
+        :return: True, if the result file has been written.
+        """
+        with writing_file_if_changed(result_file, self.file_options) as f_out:
+            self.expand_file_to_sink(
+                template_file, f_out.write, trace_parsing, trace_evaluation
+            )
+        return f_out.changed
+
+    def check_file_to_file(
+        self,
+        template_file: FileName,
+        result_file: FileName,
+        diff: bool = False,
+        trace_parsing: bool = False,
+        trace_evaluation: bool = False,
+    ) -> Optional[Mismatch]:
+        """Check whether the result file is up to date, i.e., has the expansion
+        result of the template file as content. The result is compared with the
+        content of the file while the expansion runs, and the expansion stops
+        at the first difference.
+
+        :param template_file: Template to expand.
+        :param result_file: File to check.
+        :param diff: If True, and the file is not up to date, the template is
+            expanded completely, and a unified diff (see *unified_diff*) is
+            added to the returned mismatch.
+        :param trace_parsing: Print parsing log to stderr.
+        :param trace_evaluation: Print evaluation log to stderr.
+        :return: None, if the file is up to date, and the first difference
+            otherwise.
+        """
+        sink = ComparingSink(result_file, self.file_options)
+        try:
+            self.expand_file_to_sink(
+                template_file, sink, trace_parsing, trace_evaluation
+            )
+        except MismatchFound:
+            pass
+        mismatch = sink.finish()
+        if mismatch is not None and diff:
+            mismatch.diff = unified_diff(
+                (
+                    read_file(result_file, options=self.file_options)
+                    if mismatch.result_file_exists
+                    else ""
+                ),
+                self.expand_file(template_file),
+            )
+        return mismatch
+
+    def compile(
+        self, template_file: FileName, trace_evaluation: bool = False
+    ) -> CompiledTemplate:
+        """
+        Load a template and compile its template script, for rendering it many
+        times, e.g., with different globals, by the returned *CompiledTemplate*.
+        Each rendering only executes the compiled script; the template is not
+        read, parsed or compiled again (also not, if it changes).
+
+        The renderings use this PreProcessor, e.g., its caches for *insert_from*
+        and *import_from*.
+
+        :param template_file: Template to compile.
+        :param trace_evaluation: Print evaluation log to stderr, when rendering.
+        """
+        template_script = load_template_script(
+            os.fsdecode(template_file),
+            self._tokenizer,
+            self._global_evaluation_context,
+            trace_evaluation=trace_evaluation,
+        )
+        compile_template_script(template_script, self._global_evaluation_context)
+        return CompiledTemplate(template_script, self, self._worker_factory)
+
+    def render_many(
+        self,
+        template_file: FileName,
+        globals_dicts: Iterable[Optional[dict]],
+        jobs: Optional[int] = None,
+        ordered: bool = True,
+    ) -> Iterator[tuple[int, str]]:
+        """Compile a template once and render it with each of the
+        *globals_dicts*, spread over several worker processes. See
+        *compile* and *CompiledTemplate.render_many*.
+
+        :param template_file: Template to render.
+        :param globals_dicts: Globals for the renderings. They need to be
+            picklable.
+        :param jobs: Number of worker processes. Default: number of CPUs.
+        :param ordered: Yield the results in the order of *globals_dicts*.
+            Otherwise, yield them as they are completed.
+        :return: Iterator of pairs of the index of the globals in
+            *globals_dicts* and the result of the rendering with them.
+        """
+        return self.compile(template_file).render_many(globals_dicts, jobs, ordered)
+
+    def expand_many(
+        self,
+        files: Iterable[tuple[FileName, FileName]],
+        jobs: Optional[int] = None,
+        check: bool = False,
+    ) -> list[ExpansionOutcome]:
+        """Expand many template files, each to its result file, spread over
+        several worker processes. A result file is only written, if its content
+        changes. An exception does not stop the batch, but is reported in the
+        outcome of the respective file. The outcomes also report the time each
+        expansion took and the files it has read.
+
+        Each worker process expands its templates with an own PreProcessor,
+        configured like this one. The current global *file_options* are used
+        also in the workers. If a *script_cache_dir* is configured, the workers
+        share the template scripts cached there.
+
+        :param files: Pairs of a template file and the result file for it.
+        :param jobs: Number of worker processes. Default: number of CPUs. With
+            a single job, the templates are expanded in the current process by
+            this PreProcessor.
+        :param check: If True, no result file is written. Instead, each result
+            file is checked to be up to date (see *check_file_to_file*), and the
+            outcome reports the first difference.
+        :return: The outcomes of the expansions, in the order of *files*.
+        """
+        return expand_many(self, self._worker_factory, files, jobs, check)
+
+    def warm_worker_pool(
+        self,
+        jobs: Optional[int] = None,
+        prelude_templates: Iterable[FileName] = (),
+        preload_modules: Iterable[str] = (),
+    ) -> WarmWorkerPool:
+        """Expand the *prelude_templates* and import the *preload_modules* in the
+        current process, and then return a pool of worker processes that are forked
+        from it and expand templates with this PreProcessor. See *WarmWorkerPool*.
+
+        Use this instead of *expand_many*, if many expansions share costly
+        preparations, like common templates that are imported by all
+        templates, or the import of large modules by the macro code.
+
+        :param jobs: Number of worker processes. Default: number of CPUs.
+        :param prelude_templates: Templates to expand in the current process.
+        :param preload_modules: Names of modules to import in the current process.
+        """
+        return WarmWorkerPool(self, jobs, prelude_templates, preload_modules)
@@ -0,0 +1,252 @@
+import os
+import sys
+import pickle
+import hashlib
+import marshal
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from . import _files
+from ._files import (
+    FileName,
+    FileOptions,
+    StatSignature,
+    read_file_with_signature,
+    stat_signature,
+)
+
+Dependencies = dict[str, StatSignature]
+""" Resolved paths of files an expansion result depends on, with their stat
+signatures at the time they have been read """
+
+InsertedContent = tuple[str, Dependencies]
+""" An expansion result together with the files it depends on """
+
+
+def dependencies_unchanged(dependencies: Dependencies) -> bool:
+    """Return whether all files in *dependencies* still exist and have their
+    recorded stat signatures."""
+    try:
+        return all(
+            stat_signature(path) == signature
+            for path, signature in dependencies.items()
+        )
+    except OSError:
+        return False
+
+
+# Types of values whose representation identifies them
+_plain_types = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _is_plain(value: object) -> bool:
+    if type(value) is tuple:
+        return all(_is_plain(item) for item in value)
+    return type(value) in _plain_types
+
+
+def fingerprint(value: object) -> Optional[str]:
+    """Return a fingerprint of the content of *value*, or None, if none can be
+    computed. Values consisting of constants of the built-in types (and tuples of
+    them) are identified by their representation, other values by their pickle
+    bytes. (So, functions and classes, e.g., are identified by their names only.)
+    Equal values can have different fingerprints, e.g., sets with a different
+    order of their elements, but values with the same fingerprint are equal."""
+    if _is_plain(value):
+        data = b"r" + repr(value).encode("utf-8", errors="surrogatepass")
+    else:
+        try:
+            data = b"p" + pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return None
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@dataclass
+class CacheStatistics:
+    """Counters describing the use of a cache."""
+
+    hits: int = 0
+    """ Lookups that found a valid entry """
+    misses: int = 0
+    """ Lookups that found no entry, or only an outdated one """
+    evictions: int = 0
+    """ Entries removed from memory to stay within the size budget """
+
+
+class InsertedContentCache:
+    """
+    Cache of the expansion results of templates that have already been "inserted",
+    keyed by the resolved path of the template. An entry is only returned, if
+    none of the files the result depends on has changed since the expansion.
+    The cache can be used by several threads concurrently.
+
+    :param max_bytes: If given, the least recently used entries are evicted from
+        memory as soon as the results in the cache need more memory than this.
+    :param spill_to_disk: If True, evicted entries are written to a temporary
+        directory and taken back from there when they are used again, instead of
+        being dropped.
+    """
+
+    def __init__(
+        self, max_bytes: Optional[int] = None, spill_to_disk: bool = False
+    ) -> None:
+        self._max_bytes = max_bytes
+        self._spill_to_disk = spill_to_disk
+        self._entries = OrderedDict[str, InsertedContent]()
+        self._total_bytes = 0
+        self._spilled = dict[str, str]()
+        # Paths of the spill files of the evicted entries
+        self._spill_dir: Optional[tempfile.TemporaryDirectory] = None
+        # Created when the first entry is spilled, removed with the cache
+        self.statistics = CacheStatistics()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _size(entry: InsertedContent) -> int:
+        return sys.getsizeof(entry[0])
+
+    def get(self, key: str) -> Optional[InsertedContent]:
+        """Return the entry for *key*, if there is one and all its dependencies
+        are unchanged, and None otherwise."""
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[InsertedContent]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif key in self._spilled:
+            entry = self._unspill(key)
+        if entry is None or not dependencies_unchanged(entry[1]):
+            self.statistics.misses += 1
+            return None
+        self.statistics.hits += 1
+        return entry
+
+    def __setitem__(self, key: str, entry: InsertedContent) -> None:
+        with self._lock:
+            self.discard(key)
+            self._entries[key] = entry
+            self._total_bytes += self._size(entry)
+            self._evict()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries) + len(self._spilled)
+
+    def discard(self, key: str) -> None:
+        """Remove the entry for *key*, if there is one."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= self._size(entry)
+            spill_path = self._spilled.pop(key, None)
+            if spill_path is not None:
+                os.remove(spill_path)
+
+    def _evict(self) -> None:
+        """Evict least recently used entries until the budget is met."""
+        if self._max_bytes is None:
+            return
+        while self._total_bytes > self._max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._total_bytes -= self._size(entry)
+            self.statistics.evictions += 1
+            if self._spill_to_disk:
+                self._spill(key, entry)
+
+    def _spill(self, key: str, entry: InsertedContent) -> None:
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.TemporaryDirectory(prefix="pymacros4py_")
+        spill_path = os.path.join(
+            self._spill_dir.name,
+            hashlib.sha256(key.encode("utf-8", errors="surrogatepass")).hexdigest(),
+        )
+        with open(spill_path, "wb") as f_out:
+            marshal.dump(entry, f_out)
+        self._spilled[key] = spill_path
+
+    def _unspill(self, key: str) -> InsertedContent:
+        spill_path = self._spilled.pop(key)
+        with open(spill_path, "rb") as f_in:
+            entry: InsertedContent = marshal.load(f_in)
+        os.remove(spill_path)
+        self[key] = entry
+        return entry
+
+
+class FileContentCache:
+    """
+    Cache of the contents of the files read by a PreProcessor, e.g., templates
+    and files inserted by *insert_content*, keyed by resolved path and the
+    options used for reading. An entry is only returned, if the file still has
+    the stat signature it had when it was read. The cache can be used by several
+    threads concurrently.
+
+    :param max_bytes: The least recently used entries are evicted as soon as
+        the contents in the cache need more memory than this (default: 64 MiB).
+        Files whose content alone needs more are not cached. 0 disables the
+        cache, and None lifts the limit.
+    """
+
+    default_max_bytes = 64 * 2**20
+
+    def __init__(self, max_bytes: Optional[int] = default_max_bytes) -> None:
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict[
+            tuple[str, Optional[str], Optional[str], Optional[str]],
+            tuple[StatSignature, str],
+        ]()
+        self._total_bytes = 0
+        self.statistics = CacheStatistics()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def read(
+        self, file_name: FileName, options: Optional[FileOptions] = None
+    ) -> tuple[str, StatSignature]:
+        """Return the content of *file_name*, read with the *options* (or the
+        chosen *file_options*, if None), and its stat signature. Read the file
+        only if the cache has no current entry for it."""
+        if self._max_bytes == 0:
+            return read_file_with_signature(file_name, options)
+        if options is None:
+            # A copy, since the global file options can change
+            options = FileOptions(**vars(_files.file_options))
+        path = os.path.realpath(os.fsdecode(file_name))
+        key = (path, options.encoding, options.errors, options.newline)
+        signature = stat_signature(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.statistics.hits += 1
+                return entry[1], signature
+            self.statistics.misses += 1
+        content, signature = read_file_with_signature(path, options)
+        size = sys.getsizeof(content)
+        if self._max_bytes is None or size <= self._max_bytes:
+            with self._lock:
+                old_entry = self._entries.pop(key, None)
+                if old_entry is not None:
+                    self._total_bytes -= sys.getsizeof(old_entry[1])
+                self._entries[key] = (signature, content)
+                self._total_bytes += size
+                self._evict()
+        return content, signature
+
+    def _evict(self) -> None:
+        """Evict least recently used entries until the budget is met."""
+        if self._max_bytes is None:
+            return
+        while self._total_bytes > self._max_bytes and self._entries:
+            _, (_, content) = self._entries.popitem(last=False)
+            self._total_bytes -= sys.getsizeof(content)
+            self.statistics.evictions += 1
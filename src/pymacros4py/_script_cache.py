@@ -0,0 +1,220 @@
+import os
+import sys
+import hashlib
+import marshal
+import tempfile
+import importlib.util
+import importlib.metadata
+from types import CodeType
+from typing import Optional
+
+from ._files import FileName
+from ._tokenizer import Tokenizer
+from ._template_script import TemplateScript, TextTable
+
+
+def _package_version() -> str:
+    """Return the installed version of pymacros4py, or "unknown" if the package
+    is used without being installed."""
+    try:
+        return importlib.metadata.version("pymacros4py")
+    except importlib.metadata.PackageNotFoundError:  # pragma: no cover
+        return "unknown"
+
+
+def code_with_file_name(code: CodeType, file_name: str) -> CodeType:
+    """Return a copy of *code*, where *file_name* is used as file name of the code
+    and of all code objects nested in it (e.g., of functions defined in the code)."""
+    consts = tuple(
+        code_with_file_name(const, file_name) if isinstance(const, CodeType) else const
+        for const in code.co_consts
+    )
+    return code.replace(co_filename=file_name, co_consts=consts)
+
+
+class ScriptCache:
+    """
+    Persistent on-disk cache of template scripts and their compiled code, similar
+    to a *__pycache__* directory for Python modules. An entry is keyed by the
+    content and file name of the template, the configuration of the tokenizer,
+    the generation options of the script, the version of pymacros4py and the
+    Python bytecode format.
+
+    :param directory: Directory for the cache files. It is created if necessary.
+    """
+
+    _file_suffix = ".marshal"
+
+    def __init__(self, directory: FileName) -> None:
+        self._directory = os.fsdecode(directory)
+        os.makedirs(self._directory, exist_ok=True)
+        # Parts of the key that are the same for all entries
+        self._key_prefix = "\0".join(
+            [
+                _package_version(),
+                sys.implementation.cache_tag or sys.implementation.name,
+                importlib.util.MAGIC_NUMBER.hex(),
+            ]
+        )
+
+    def _key(
+        self,
+        file_name: str,
+        template: str,
+        tokenizer: Tokenizer,
+        trace_evaluation: bool,
+        text_table: bool,
+        optimize: bool,
+        build_ast: bool,
+    ) -> str:
+        """Return the key of the cache entry for the given template script."""
+        key_data = "\0".join(
+            [
+                self._key_prefix,
+                type(tokenizer).__qualname__,
+                *tokenizer.configuration,
+                str(trace_evaluation),
+                str(text_table),
+                str(optimize),
+                str(build_ast),
+                file_name,
+                template,
+            ]
+        )
+        return hashlib.sha256(
+            key_data.encode("utf-8", errors="surrogatepass")
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key + self._file_suffix)
+
+    def _load(
+        self, key: str
+    ) -> Optional[tuple[str, CodeType, Optional[TextTable], bool]]:
+        """Return script code, compiled code, text table, and whether the code
+        has been compiled from the syntax tree, stored for *key*, or None"""
+        try:
+            with open(self._path(key), "rb") as f_in:
+                script_code, code, text_table, from_tree = marshal.load(f_in)
+        except (OSError, EOFError, ValueError, TypeError):
+            # Missing, unreadable or corrupt entry: handle like a cache miss
+            return None
+        if not isinstance(script_code, str) or not isinstance(code, CodeType):
+            return None
+        return script_code, code, text_table, bool(from_tree)
+
+    def _store(
+        self,
+        key: str,
+        script_code: str,
+        code: CodeType,
+        text_table: Optional[TextTable],
+        from_tree: bool,
+    ) -> None:
+        """Store script code, compiled code, text table, and whether the code has
+        been compiled from the syntax tree, for *key*. The file is
+        written under a temporary name and then renamed, so concurrent readers
+        never see a partially written entry. A failure to write is ignored."""
+        try:
+            tmp_file, tmp_file_path = tempfile.mkstemp(
+                suffix=".tmp", dir=self._directory
+            )
+        except OSError:  # pragma: no cover
+            return
+        try:
+            with os.fdopen(tmp_file, "wb") as f_out:
+                marshal.dump((script_code, code, text_table, from_tree), f_out)
+            os.replace(tmp_file_path, self._path(key))
+        except OSError:  # pragma: no cover
+            os.remove(tmp_file_path)
+
+    def template_script(
+        self,
+        file_name: str,
+        template: str,
+        tokenizer: Tokenizer,
+        trace_evaluation: bool = False,
+        text_table: bool = False,
+        optimize: bool = False,
+        build_ast: bool = False,
+    ) -> TemplateScript:
+        """Return the template script for *template*, together with its compiled
+        code. Take both from the cache, if possible. Otherwise, create them
+        and store them in the cache. Parameters: See *TemplateScript*."""
+        key = self._key(
+            file_name,
+            template,
+            tokenizer,
+            trace_evaluation,
+            text_table,
+            optimize,
+            build_ast,
+        )
+        cached = self._load(key)
+        if cached is not None:
+            script_code, code, table, from_tree = cached
+            return TemplateScript.from_script_code(
+                file_name, script_code, code, table, from_tree
+            )
+
+        template_script = TemplateScript(
+            file_name,
+            template,
+            tokenizer,
+            trace_evaluation=trace_evaluation,
+            text_table=text_table,
+            optimize=optimize,
+            build_ast=build_ast,
+        )
+        script_code = str(template_script)
+        if not template_script.compile_tree():
+            try:
+                template_script.code = compile(script_code, file_name, mode="exec")
+            except SyntaxError:
+                # Do not cache; the evaluation reports the error
+                return template_script
+        assert template_script.code is not None
+        self._store(
+            key,
+            script_code,
+            template_script.code,
+            template_script.text_table,
+            template_script.code_refers_to_template,
+        )
+        return template_script
+
+
+def create_template_script(
+    file_name: str,
+    template: str,
+    tokenizer: Tokenizer,
+    trace_parsing: bool,
+    trace_evaluation: bool,
+    text_table: bool,
+    optimize: bool,
+    build_ast: bool,
+    script_cache: Optional[ScriptCache],
+) -> TemplateScript:
+    """Create the template script for *template*. Use *script_cache*, if it is
+    given and no parsing log is requested. Other parameters: See *TemplateScript*.
+    """
+    if script_cache is None or trace_parsing:
+        return TemplateScript(
+            file_name,
+            template,
+            tokenizer,
+            trace_parsing,
+            trace_evaluation,
+            text_table,
+            optimize,
+            build_ast,
+        )
+    return script_cache.template_script(
+        file_name,
+        template,
+        tokenizer,
+        trace_evaluation,
+        text_table,
+        optimize,
+        build_ast,
+    )
@@ -0,0 +1,317 @@
+import ast
+import re
+from typing import Optional, TypeVar, Union
+
+# Name of the statement that marks, in parsed macro code, the position of the suite
+# that continues in subsequent sections
+_suite_placeholder = "_pymacros4py_suite_"
+
+# Code preceding a clause that continues a compound statement of previous sections,
+# to parse the clause
+_clause_wrappers = {
+    "elif": "if 0:\n    pass\n",
+    "else": "if 0:\n    pass\n",
+    "except": "try:\n    pass\n",
+    "finally": "try:\n    pass\n",
+}
+
+
+class UnsupportedMacroCode(Exception):
+    """Raised by *ScriptTree* for macro code that it cannot splice into the
+    syntax tree. Then, the template script is compiled from its code instead."""
+
+
+def _is_placeholder(statement: ast.stmt) -> bool:
+    return (
+        isinstance(statement, ast.Expr)
+        and isinstance(statement.value, ast.Name)
+        and statement.value.id == _suite_placeholder
+    )
+
+
+def _take_suite(tree: ast.AST) -> tuple[ast.AST, list[ast.stmt]]:
+    """Find the suite in *tree* that ends with the suite placeholder. Remove the
+    placeholder and return the node holding the suite, and the suite."""
+    for node in ast.walk(tree):
+        for _, value in ast.iter_fields(node):
+            if isinstance(value, list) and value and _is_placeholder(value[-1]):
+                value.pop()
+                return node, value
+    raise UnsupportedMacroCode()  # pragma: no cover
+
+
+_Node = TypeVar("_Node", bound=Union[ast.expr, ast.stmt, ast.keyword])
+
+
+def _at_line(node: _Node, line_no: int) -> _Node:
+    """Set the location of the generated *node* to the start of template line
+    *line_no*, and return the node."""
+    node.lineno = node.end_lineno = line_no
+    node.col_offset = node.end_col_offset = 0
+    return node
+
+
+def _relocate(
+    tree: ast.AST, first_line_no: int, line_no: int, column_shifts: list[int]
+) -> None:
+    """Move the nodes of *tree*, which is parsed code, to the template: Line
+    *first_line_no* of the code is template line *line_no*, and so on. The
+    column offsets in the line with index *i* (relative to *first_line_no*) are
+    shifted by *column_shifts[i]*."""
+    line_offset = line_no - first_line_no
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        for field in node._fields:
+            value = getattr(node, field)
+            if isinstance(value, ast.AST):
+                nodes.append(value)
+            elif isinstance(value, list):
+                nodes.extend(item for item in value if isinstance(item, ast.AST))
+        if getattr(node, "lineno", None) is None:
+            # E.g., a module or an expression context
+            continue
+        for line_attribute, column_attribute in (
+            ("lineno", "col_offset"),
+            ("end_lineno", "end_col_offset"),
+        ):
+            node_line_no = getattr(node, line_attribute)
+            if node_line_no is None:
+                continue
+            setattr(node, line_attribute, node_line_no + line_offset)
+            index = node_line_no - first_line_no
+            if 0 <= index < len(column_shifts):
+                column = getattr(node, column_attribute)
+                setattr(node, column_attribute, column + column_shifts[index])
+
+
+class ScriptTree:
+    """
+    Syntax tree of a template script, built while the template is parsed, as
+    alternative to generating the code of the script. Its line numbers (and
+    column offsets) refer to the template, so that tracebacks show the lines of
+    the template.
+
+    The tree follows the code generation by *TemplateScript* step by step:
+    Calls generated for text sections and for the handling of macros are built
+    directly. The code of each macro section is parsed, as code of the generated
+    script, i.e., with its script indentation, at its nesting level, and its
+    statements are added to the suite that is currently open.
+    """
+
+    def __init__(self) -> None:
+        self.module = ast.Module(body=[], type_ignores=[])
+        self._suites: list[tuple[Optional[ast.stmt], list[ast.stmt]]] = [
+            (None, self.module.body)
+        ]
+        # The open suites, the innermost last, with the compound statements they
+        # belong to. Statements are added to the innermost one.
+        self._text_table_names = list[ast.Name]()
+        # References to the text table, which get its name when it is known
+
+    def add_call(
+        self,
+        line_no: int,
+        function: str,
+        *args: Union[str, ast.expr],
+        **keywords: Union[str, bool],
+    ) -> ast.stmt:
+        """Add a call of *function* with *args* (expressions or strings) and
+        constant *keywords*, as statement for template line *line_no*, and return
+        the statement."""
+        statement = _at_line(
+            ast.Expr(
+                _at_line(
+                    ast.Call(
+                        _at_line(ast.Name(function, ast.Load()), line_no),
+                        [
+                            (
+                                _at_line(ast.Constant(arg), line_no)
+                                if isinstance(arg, str)
+                                else arg
+                            )
+                            for arg in args
+                        ],
+                        [
+                            _at_line(
+                                ast.keyword(
+                                    name, _at_line(ast.Constant(value), line_no)
+                                ),
+                                line_no,
+                            )
+                            for name, value in keywords.items()
+                        ],
+                    ),
+                    line_no,
+                )
+            ),
+            line_no,
+        )
+        self._suites[-1][1].append(statement)
+        return statement
+
+    def add_text(self, line_no: int, text: str) -> ast.stmt:
+        """Add the insertion of the *text*, and return the statement."""
+        return self.add_call(line_no, "insert", text)
+
+    def add_table_text(self, line_no: int, text_no: int) -> ast.stmt:
+        """Add the insertion of the text with index *text_no* in the text table,
+        and return the statement."""
+        name = _at_line(ast.Name("", ast.Load()), line_no)
+        self._text_table_names.append(name)
+        index = _at_line(ast.Constant(text_no), line_no)
+        return self.add_call(
+            line_no, "insert", _at_line(ast.Subscript(name, index, ast.Load()), line_no)
+        )
+
+    def set_text_table_name(self, table_name: str) -> None:
+        for name in self._text_table_names:
+            name.id = table_name
+
+    def remove(self, statement: ast.stmt) -> None:
+        """Remove the *statement* from the innermost open suite."""
+        suite = self._suites[-1][1]
+        del suite[max(i for i, s in enumerate(suite) if s is statement)]
+
+    def end_suite(self) -> None:
+        """Close the innermost open suite."""
+        self._suites.pop()
+
+    def add_code(
+        self,
+        code_lines: list[str],
+        level: int,
+        line_no: int,
+        column_shifts: list[int],
+        starts_suite: bool,
+        continues_compound: bool,
+    ) -> None:
+        """Parse the code of a macro section and add its statements.
+
+        :param code_lines: The lines of the code, as they appear in the generated
+            script, i.e., with script indentation.
+        :param level: The nesting level of the code in the script.
+        :param line_no: Template line number of the first line.
+        :param column_shifts: Per line, the difference between the column
+            offsets (in UTF-8 bytes) in the template and in the script.
+        :param starts_suite: The code ends with the header of a compound
+            statement, and the suite continues in subsequent sections.
+        :param continues_compound: The code is a clause (e.g., "else:") of the
+            compound statement of the innermost open suite, which it closes.
+        """
+        # Wrap the code in dummy compound statements, up to its nesting level
+        prefix_lines = [" " * 4 * i + "if 1:\n" for i in range(level)]
+        if continues_compound:
+            match = re.match(r"\s*(\w+)", code_lines[0])
+            clause = match.group(1) if match else ""
+            wrapper = _clause_wrappers.get(clause)
+            if wrapper is None or not starts_suite or len(self._suites) < 2:
+                raise UnsupportedMacroCode()
+            # The clause is parsed as part of a dummy compound statement
+            prefix_lines.extend(
+                " " * 4 * level + line for line in wrapper.splitlines(keepends=True)
+            )
+        suffix = (
+            " " * 4 * (level + 1) + _suite_placeholder + "\n" if starts_suite else ""
+        )
+        code = "".join(prefix_lines + code_lines) + suffix
+        dummy_finally = False
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            if not starts_suite:
+                # Compiling the code of the script reports the error
+                raise UnsupportedMacroCode()
+            # A try statement is incomplete without its clauses, which follow in
+            # subsequent sections. Complete it with a dummy finally clause.
+            try:
+                tree = ast.parse(
+                    code
+                    + " " * 4 * level
+                    + "finally:\n"
+                    + suffix.replace(_suite_placeholder, "pass")
+                )
+            except SyntaxError:
+                raise UnsupportedMacroCode()
+            dummy_finally = True
+        statements = tree.body
+        for _ in range(level):
+            (nested,) = statements
+            assert isinstance(nested, ast.If)
+            statements = nested.body
+        if dummy_finally:
+            if not isinstance(statements[-1], ast.Try):
+                raise UnsupportedMacroCode()
+            statements[-1].finalbody = []
+
+        # Map the locations to the template
+        _relocate(tree, len(prefix_lines) + 1, line_no, column_shifts)
+
+        if continues_compound:
+            self._add_clause(clause, statements[0])
+        else:
+            self._suites[-1][1].extend(statements)
+            if starts_suite:
+                self._open_suite(statements[-1])
+
+    def _open_suite(self, statement: ast.stmt) -> None:
+        """Open the suite that ends with the placeholder, in *statement*. It
+        needs to be a suite of the statement itself (or of one of its clauses),
+        like in the code of the script, where subsequent sections are indented
+        by one level."""
+        owner, suite = _take_suite(statement)
+        compound = statement
+        # Follow the chain of "elif" clauses
+        while (
+            owner is not compound
+            and isinstance(compound, ast.If)
+            and len(compound.orelse) == 1
+            and isinstance(compound.orelse[0], ast.If)
+        ):
+            compound = compound.orelse[0]
+        if owner is not compound and not (
+            isinstance(compound, ast.Try) and owner in compound.handlers
+        ):
+            raise UnsupportedMacroCode()
+        self._suites.append((compound, suite))
+
+    def _add_clause(self, clause: str, wrapper: ast.stmt) -> None:
+        """Add the *clause* parsed as part of the dummy compound statement
+        *wrapper* to the compound statement of the innermost open suite, and
+        open the suite of the clause."""
+        compound, suite = self._suites.pop()
+        if clause == "elif":
+            assert isinstance(wrapper, ast.If)
+            if not isinstance(compound, ast.If) or suite is not compound.body:
+                raise UnsupportedMacroCode()
+            (elif_statement,) = wrapper.orelse
+            assert isinstance(elif_statement, ast.If)
+            compound.orelse = [elif_statement]
+            _, suite = _take_suite(elif_statement)
+            self._suites.append((elif_statement, suite))
+            return
+        if clause == "except":
+            if (
+                not isinstance(wrapper, ast.Try)
+                or not isinstance(compound, ast.Try)
+                or compound.orelse
+                or compound.finalbody
+            ):
+                raise UnsupportedMacroCode()
+            (handler,) = wrapper.handlers
+            compound.handlers.append(handler)
+            _, suite = _take_suite(handler)
+            self._suites.append((compound, suite))
+            return
+        # "else" or "finally"
+        field = "orelse" if clause == "else" else "finalbody"
+        if (
+            compound is None
+            or getattr(compound, field, None) != []
+            or suite is getattr(compound, field)
+            or (field == "orelse" and getattr(compound, "finalbody", None))
+        ):
+            raise UnsupportedMacroCode()
+        _, suite = _take_suite(wrapper)
+        setattr(compound, field, suite)
+        self._suites.append((compound, suite))
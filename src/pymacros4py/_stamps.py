@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import tempfile
+from typing import Optional
+
+from ._files import FileName, StatSignature, stat_signature
+from ._result_cache import Dependencies, dependencies_unchanged
+from ._script_cache import _package_version
+
+
+class StampCache:
+    """
+    Persistent on-disk record of the expansions that have produced their result
+    files, for skipping them in later runs, similar to the stamp files of a build
+    tool. A stamp of a template and a result file holds the stat signature (see
+    *stat_signature*) the result file had after the expansion, and those of the
+    files the expansion has read (see *ExpansionOutcome.dependencies*). As long
+    as none of these files changes, the result file is up to date. (Files that
+    macro code reads by its own means, e.g., Python modules it imports, are not
+    among the files the expansion has read. They need to be added to the
+    dependencies of the stamp explicitly.)
+
+    Stamps are keyed by the resolved paths of the template and the result file,
+    the version of pymacros4py and a *configuration* string, which should
+    describe all other settings that influence the expansion results.
+
+    :param directory: Directory for the stamp files. It is created if necessary.
+    :param configuration: Description of the settings of the expansions.
+    """
+
+    _file_suffix = ".stamp"
+
+    def __init__(self, directory: FileName, configuration: str = "") -> None:
+        self._directory = os.fsdecode(directory)
+        os.makedirs(self._directory, exist_ok=True)
+        self._key_prefix = "\0".join([_package_version(), configuration])
+
+    def _path(self, template_file: FileName, result_file: FileName) -> str:
+        key_data = "\0".join(
+            [
+                self._key_prefix,
+                os.path.realpath(os.fsdecode(template_file)),
+                os.path.realpath(os.fsdecode(result_file)),
+            ]
+        )
+        key = hashlib.sha256(
+            key_data.encode("utf-8", errors="surrogatepass")
+        ).hexdigest()
+        return os.path.join(self._directory, key + self._file_suffix)
+
+    def _load(
+        self, template_file: FileName, result_file: FileName
+    ) -> Optional[tuple[StatSignature, Dependencies]]:
+        """Return the stat signature of the result file and the dependencies
+        stored for the pair of files, or None"""
+        try:
+            with open(self._path(template_file, result_file), encoding="utf8") as f:
+                stamp = json.load(f)
+            result_signature = tuple(stamp["result"])
+            dependencies = {
+                path: tuple(signature)
+                for path, signature in stamp["dependencies"].items()
+            }
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            # Missing, unreadable or corrupt stamp: handle like a missing one
+            return None
+        return result_signature, dependencies  # type: ignore[return-value]
+
+    def up_to_date(self, template_file: FileName, result_file: FileName) -> bool:
+        """Return whether there is a stamp for the pair of files, and neither the
+        result file nor any of the files the expansion has read has changed
+        since it has been stored."""
+        stamp = self._load(template_file, result_file)
+        if stamp is None:
+            return False
+        result_signature, dependencies = stamp
+        try:
+            if stat_signature(result_file) != result_signature:
+                return False
+        except OSError:
+            return False
+        return dependencies_unchanged(dependencies)
+
+    def store(
+        self,
+        template_file: FileName,
+        result_file: FileName,
+        dependencies: Dependencies,
+    ) -> None:
+        """Store a stamp for the pair of files, recording the current stat
+        signature of the result file and the *dependencies*. The file is
+        written under a temporary name and then renamed, so concurrent readers
+        never see a partially written stamp. A failure to write is ignored."""
+        try:
+            stamp = {
+                "result": stat_signature(result_file),
+                "dependencies": dependencies,
+            }
+            tmp_file, tmp_file_path = tempfile.mkstemp(
+                suffix=".tmp", dir=self._directory
+            )
+        except OSError:  # pragma: no cover
+            return
+        try:
+            with os.fdopen(tmp_file, "w", encoding="utf8") as f_out:
+                json.dump(stamp, f_out)
+            os.replace(tmp_file_path, self._path(template_file, result_file))
+        except OSError:  # pragma: no cover
+            os.remove(tmp_file_path)
+
+    def remove(self, template_file: FileName, result_file: FileName) -> None:
+        """Remove the stamp for the pair of files, if there is one."""
+        try:
+            os.remove(self._path(template_file, result_file))
+        except OSError:
+            pass
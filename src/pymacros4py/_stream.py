@@ -0,0 +1,70 @@
+import queue
+import threading
+from collections.abc import Callable, Generator
+from typing import Optional
+
+Sink = Callable[[str], object]
+""" Callable that gets the output of an expansion, chunk by chunk, e.g., the
+*write* method of a text file """
+
+
+class ExpansionCancelled(BaseException):
+    """Raised by the sink of an expansion that runs for *iterate_chunks*, when the
+    iteration has been stopped. Like *GeneratorExit*, it is not derived from
+    *Exception*, so that macro code does not catch it by accident."""
+
+
+def iterate_chunks(
+    produce: Callable[[Sink], object], max_pending_chunks: int = 16
+) -> Generator[str, None, None]:
+    """Run *produce* in a separate thread, and yield the chunks it passes to the
+    sink it gets as argument. If *max_pending_chunks* chunks have not been
+    taken by the iteration yet, the sink waits. If the iteration stops before
+    *produce* has finished, the next call of the sink raises
+    *ExpansionCancelled*. An exception raised by *produce* is raised by the
+    iteration."""
+    chunks = queue.Queue[tuple[str, bool]](max_pending_chunks)
+    # Chunks and whether they are the last one
+    cancelled = threading.Event()
+    error: Optional[BaseException] = None
+
+    def put(chunk: str, last: bool) -> None:
+        while True:
+            if cancelled.is_set():
+                raise ExpansionCancelled()
+            try:
+                chunks.put((chunk, last), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def sink(chunk: str) -> None:
+        if chunk:
+            put(chunk, False)
+
+    def run() -> None:
+        nonlocal error
+        try:
+            produce(sink)
+        except ExpansionCancelled:
+            return
+        except BaseException as e:
+            error = e
+        try:
+            put("", True)
+        except ExpansionCancelled:
+            pass
+
+    thread = threading.Thread(target=run, name="pymacros4py-expansion", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk, last = chunks.get()
+            if last:
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+        thread.join()
+    if error is not None:
+        raise error
@@ -1,7 +1,33 @@
+import ast
 import itertools
+import hashlib
 import re
+import threading
+from types import CodeType
+from typing import Optional, TypeAlias
 
-from ._tokenizer import Tokenizer
+from ._tokenizer import Tokenizer, LineIndex
+from ._script_tree import ScriptTree, UnsupportedMacroCode
+
+TextTable: TypeAlias = tuple[str, tuple[str, ...]]
+""" Name of the global variable, under which a template script expects the texts
+of its text sections, and the texts """
+
+
+text_table_name_prefix = "_template_texts_"
+""" Prefix of the names of the global variables holding text tables """
+
+
+def _text_table_name(texts: list[str]) -> str:
+    """Return a name for the global variable holding the table of *texts*. The
+    name is derived from the texts, so that template scripts sharing their
+    globals (see *import_from*) use different variables, if their texts differ.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for text in texts:
+        digest.update(len(text).to_bytes(8, "little"))
+        digest.update(text.encode("utf-8", errors="surrogatepass"))
+    return f"{text_table_name_prefix}{digest.hexdigest()}"
 
 
 class TemplateScriptIndentation:
@@ -12,12 +38,16 @@ class TemplateScriptIndentation:
     def __init__(self, steps: int) -> None:
         self._indentation_level = 0
         self._indentation_steps = steps
+        self._indentation = ""
+        # The indentation as string, updated on each change of the level
 
     def indent(self) -> None:
         self._indentation_level += 1
+        self._indentation = " " * self._indentation_level * self._indentation_steps
 
     def dedent(self, content_line: str, content: str) -> None:
         self._indentation_level -= 1
+        self._indentation = " " * self._indentation_level * self._indentation_steps
         if self._indentation_level < 0:
             raise RuntimeError(
                 f"--- {content_line}: "
@@ -27,36 +57,27 @@ class TemplateScriptIndentation:
             )
 
     def __str__(self) -> str:
-        return " " * self._indentation_level * self._indentation_steps
+        return self._indentation
+
+    @property
+    def level(self) -> int:
+        return self._indentation_level
 
     def __bool__(self) -> bool:
         return self._indentation_level != 0
 
 
-def _extract_prefix(template: str, pos: int) -> str:
+def _extract_prefix(template: str, line_index: LineIndex, pos: int) -> str:
     """Find the start of the line in *template* where *pos* is.
     Return the characters from the start of the line till the one
     before *pos*.
 
     :param template: A template. Needs to follow Unix-style end of line convention.
+    :param line_index: The line index of the template.
     :param pos: A position (number of characters) in the template
     """
-    # Find position of previous newline character and skip it.
-    # If we do not find one, we are at the first line of the text, get
-    # position -1, and the '+1' brings us to the first character of the file.
-    nl_pos = template.rfind("\n", 0, pos) + 1
     # characters from line start (inclusively) to pos (exclusively)
-    return template[nl_pos:pos]
-
-
-def _line_no(template: str, pos: int) -> int:
-    """Return the line in *template* where *pos* is, counted from 1"""
-    return template[:pos].count("\n") + 1
-
-
-# def _col_no(template: str, pos: int) -> int:
-#     """ Return the column in *template* where *pos* is, counted from 1 """
-#     return pos - template[:pos].rfind("\n") + 1
+    return template[line_index.line_start(pos) : pos]
 
 
 def _separate_indentation_and_content(text: str) -> tuple[str, str]:
@@ -71,6 +92,101 @@ def _separate_indentation_and_content(text: str) -> tuple[str, str]:
     return text[0:whitespace_len], text_stripped
 
 
+# Expressions whose evaluation cannot run code of the template (e.g., no calls and
+# no operators, which could call special methods)
+_inert_expression_types = (
+    ast.Constant,
+    ast.Name,
+    ast.Tuple,
+    ast.List,
+    ast.Lambda,
+)
+
+
+def _is_inert_expression(expression: Optional[ast.expr]) -> bool:
+    if expression is None or isinstance(expression, (ast.Constant, ast.Name)):
+        return True
+    if isinstance(expression, ast.Lambda):
+        # The body is not evaluated here, but the default values are
+        return all(
+            _is_inert_expression(default)
+            for default in expression.args.defaults + expression.args.kw_defaults
+        )
+    if isinstance(expression, ast.Set):
+        # Hashing and comparing the elements could call special methods, unless
+        # they are constants
+        return all(isinstance(element, ast.Constant) for element in expression.elts)
+    if isinstance(expression, ast.Dict):
+        # The same holds for the keys, and for unpacking a mapping (key None)
+        return all(isinstance(key, ast.Constant) for key in expression.keys) and all(
+            _is_inert_expression(value) for value in expression.values
+        )
+    return isinstance(expression, _inert_expression_types) and all(
+        _is_inert_expression(child)
+        for child in ast.iter_child_nodes(expression)
+        if isinstance(child, ast.expr)
+    )
+
+
+def _is_inert_statement(statement: ast.stmt) -> bool:
+    """Return True, if executing *statement* cannot insert anything into the
+    results, because it runs no code of the template and of its functions."""
+    if isinstance(
+        statement, (ast.Import, ast.ImportFrom, ast.Pass, ast.Global, ast.Nonlocal)
+    ):
+        return True
+    if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        # The body is not executed, but decorators, default values and
+        # annotations are evaluated
+        arguments = statement.args
+        return not statement.decorator_list and all(
+            _is_inert_expression(expression)
+            for expression in [
+                *arguments.defaults,
+                *arguments.kw_defaults,
+                statement.returns,
+                *(
+                    argument.annotation
+                    for argument in [
+                        *arguments.posonlyargs,
+                        *arguments.args,
+                        arguments.vararg,
+                        *arguments.kwonlyargs,
+                        arguments.kwarg,
+                    ]
+                    if argument is not None
+                ),
+            ]
+        )
+    if isinstance(statement, ast.Assign):
+        # Assignments to attributes or items, and unpacking, could run code
+        return all(
+            isinstance(target, ast.Name) for target in statement.targets
+        ) and _is_inert_expression(statement.value)
+    if isinstance(statement, ast.AnnAssign):
+        return (
+            isinstance(statement.target, ast.Name)
+            and _is_inert_expression(statement.annotation)
+            and _is_inert_expression(statement.value)
+        )
+    if isinstance(statement, ast.Expr):
+        # E.g., a docstring
+        return isinstance(statement.value, ast.Constant)
+    return False
+
+
+def _cannot_insert(macro_code: str) -> bool:
+    """Return True, if the *macro_code* consists of statements, that cannot
+    insert anything into the results (e.g., imports, function definitions and
+    assignments of constants)."""
+    try:
+        module = ast.parse(macro_code)
+    except SyntaxError:
+        # Leave the error to the compilation of the script
+        return False
+    return all(_is_inert_statement(statement) for statement in module.body)
+
+
 class TemplateScript:
     """
     Template script for *template*, created using *tokenizer*.
@@ -83,6 +199,21 @@ class TemplateScript:
     :param tokenizer: Tokenizer to use.
     :param trace_parsing: Print parsing log.
     :param trace_evaluation: Print evaluation log.
+    :param text_table: If True, the texts of the text sections are not part of
+       the script code as string literals, but the script takes them by index
+       from a table (see attribute *text_table*). Then, the size of the script
+       code and its compile time do not depend on the size of the texts.
+    :param optimize: If True, generate less code for the same results: Macros
+       that cannot insert anything (e.g., imports, function definitions and
+       assignments of constants) do not inform the evaluation about their start
+       and end, and texts that are separated only by such macros are inserted
+       by a single call after them.
+    :param build_ast: If True, build the syntax tree of the script, too (see
+       attribute *tree*), with the line numbers of the template, and compile it
+       instead of the code. Then, tracebacks show the lines of the template. For
+       a template that contains compound statements in an unusual form (e.g., a
+       *match* statement spanning several sections), or syntax errors, no tree is
+       built. This option is ignored if *trace_evaluation* is True.
     """
 
     # Given the current functionality and use cases, the class could be replaced by a
@@ -96,8 +227,47 @@ class TemplateScript:
         tokenizer: Tokenizer,
         trace_parsing: bool = False,
         trace_evaluation: bool = False,
+        text_table: bool = False,
+        optimize: bool = False,
+        build_ast: bool = False,
     ) -> None:
         self.file_name = file_name
+        self.code: Optional[CodeType] = None
+        # The compiled template script, if it is already available (e.g., from a
+        # cache). Otherwise, it is compiled when the script is evaluated.
+        self.code_file_name: Optional[str] = None
+        # The virtual file name that *code* uses, once the script is evaluated
+        self.text_table: Optional[TextTable] = None
+        # The table of texts the script code refers to, if any. The script
+        # expects it in the global variable with the given name.
+        self.tree: Optional[ast.Module] = None
+        # The syntax tree of the script, if it has been built and is not
+        # compiled yet
+        self.code_refers_to_template = False
+        # True, if *code* has been compiled from the syntax tree, so that it uses
+        # the file name and the line numbers of the template
+        self.compile_lock = threading.Lock()
+        # Serializes the first compilation of the script (see *_executable_code*
+        # of the evaluator)
+
+        # Builder of the syntax tree, as long as all macro code can be handled
+        tree: Optional[ScriptTree] = (
+            ScriptTree() if build_ast and not trace_evaluation else None
+        )
+        text_statement: Optional[ast.stmt] = None
+
+        # Texts of the text sections for the text table, and the positions of the
+        # script strings that insert them
+        texts: Optional[list[str]] = [] if text_table else None
+        text_insertions = list[tuple[int, str]]()
+
+        # If the last strings insert a text, followed only by macros that cannot
+        # insert anything, the number of strings and the script indentation after
+        # them, the text, and the number of the string inserting it. Then, a
+        # following text can be inserted together with it, if optimizing.
+        text_merge_position: Optional[tuple[int, str]] = None
+        merge_text = ""
+        merge_string_no = 0
 
         # Token texts that have already been regarded in the generation of the
         # token expansion code. Used to give the template script access to them.
@@ -109,6 +279,10 @@ class TemplateScript:
         # List of the strings produced by the expansion of the found tokens
         template_script_strings = []
 
+        # Start positions of the lines of the template, for looking up line numbers
+        # and line prefixes of tokens without re-scanning the template
+        line_index = LineIndex(template)
+
         # Parse tokens and generate template expansion code, string by string
         for token_no, token in zip(itertools.count(), tokenizer.tokenize(template)):
             (
@@ -118,8 +292,9 @@ class TemplateScript:
                 start_marker_pos,
                 content_pos,
             ) = token
+            content_line_no = line_index.line_no(content_pos)
 
-            content_line = f'File "{file_name}", line {_line_no(template, content_pos)}'
+            content_line = f'File "{file_name}", line {content_line_no}'
 
             if trace_parsing:
                 print(f"--- {content_line}: {token_type}:\n>{content}<\n\n", flush=True)
@@ -141,16 +316,47 @@ class TemplateScript:
                 )
 
             elif token_type == "text":
-                s = f"{str(script_indentation)}insert({repr(content)})\n"
-                template_script_strings.append(s)
+                indentation = str(script_indentation)
+                if optimize and text_merge_position == (
+                    len(template_script_strings),
+                    indentation,
+                ):
+                    # Replace the insertion of the previous text by an insertion
+                    # of both texts (after the macros in between)
+                    content = merge_text + content
+                    del template_script_strings[merge_string_no]
+                    if texts is not None:
+                        text_insertions.pop()
+                        texts.pop()
+                    if tree is not None and text_statement is not None:
+                        tree.remove(text_statement)
+                merge_string_no = len(template_script_strings)
+                if texts is None:
+                    s = f"{indentation}insert({repr(content)})\n"
+                    template_script_strings.append(s)
+                    if tree is not None:
+                        text_statement = tree.add_text(content_line_no, content)
+                else:
+                    # The name of the table is known when all texts are known
+                    text_insertions.append((len(template_script_strings), indentation))
+                    template_script_strings.append("")
+                    texts.append(content)
+                    if tree is not None:
+                        text_statement = tree.add_table_text(
+                            content_line_no, len(texts) - 1
+                        )
+                text_merge_position = (len(template_script_strings), indentation)
+                merge_text = content
 
             elif token_type in ["embedded_macro", "line_block_macro"]:
                 # Section indentation
-                start_marker_prefix = _extract_prefix(template, start_marker_pos)
+                start_marker_prefix = _extract_prefix(
+                    template, line_index, start_marker_pos
+                )
                 start_marker_indentation = re.sub(r"\S", " ", start_marker_prefix)
 
                 # Base indentation
-                code_start_prefix = _extract_prefix(template, content_pos)
+                code_start_prefix = _extract_prefix(template, line_index, content_pos)
                 base_indentation = re.sub(r"\S", " ", code_start_prefix)
 
                 # If the last character of macro code is a colon,
@@ -168,6 +374,15 @@ class TemplateScript:
                     # Inform the global_evaluation_context of the template script that a
                     # new macro starts here, what indention its output need to have, and
                     # whether it is an embedded macro.
+                    macro_starts_position = len(template_script_strings)
+                    if tree is not None:
+                        macro_starts_statement = tree.add_call(
+                            content_line_no,
+                            "_macro_starts",
+                            indentation=start_marker_indentation,
+                            embedded=token_type == "embedded_macro",
+                            content_line=content_line,
+                        )
                     template_script_strings.append(
                         str(script_indentation)
                         + "_macro_starts("
@@ -185,6 +400,8 @@ class TemplateScript:
                 if multi_section_suite_ends:
                     # Handle suite (of a compound statement) ending in this macro
                     script_indentation.dedent(content_line, content)
+                    if tree is not None:
+                        tree.end_suite()
                     # Note: A macro that ends a suite (of a compound statement)
                     # has no _macro_end (and no _macro_start).
                     continue
@@ -196,7 +413,10 @@ class TemplateScript:
                 #     content = "insert(" + content[1:].lstrip() + ")"
 
                 # Case of a statement ending a suite and re-starting a new one
-                if re.match(r"(elif|else|except|finally|case).*:", content):
+                continues_compound = bool(
+                    re.match(r"(elif|else|except|finally|case).*:", content)
+                )
+                if continues_compound:
                     script_indentation.dedent(content_line, content)
 
                 # iterator of numbered lines
@@ -206,7 +426,16 @@ class TemplateScript:
                 # Special-case first line of macro code: It already comes without
                 # indentation
                 number, line = next(numbers_and_lines)
+                code_start_position = len(template_script_strings)
                 template_script_strings.append(str(script_indentation) + line + "\n")
+                # The macro code without script indentation
+                code_lines = [line + "\n"]
+                # Per line, column offset in the template minus column offset in
+                # the script, for the syntax tree
+                column_shifts = [
+                    len(code_start_prefix.encode("utf-8", errors="surrogatepass"))
+                    - len(str(script_indentation))
+                ]
 
                 # All lines subsequent lines of output: De-indent line relative to
                 # the base indentation, indent it for the results and insert it to
@@ -217,6 +446,8 @@ class TemplateScript:
                         # Zero indentation in a context with none-zero base indentation:
                         # Just take the line as it is
                         template_script_strings.append(line + "\n")
+                        code_lines.append(line + "\n")
+                        column_shifts.append(0)
                     elif (
                         line_indentation[0 : len(base_indentation)] == base_indentation
                     ):
@@ -228,6 +459,10 @@ class TemplateScript:
                             + line[len(base_indentation) :]
                             + "\n"
                         )
+                        code_lines.append(line[len(base_indentation) :] + "\n")
+                        column_shifts.append(
+                            len(base_indentation) - len(str(script_indentation))
+                        )
                     else:
                         # If the macro code is indented, indentation (as a string)
                         # need to start with exactly the base indentation
@@ -237,17 +472,55 @@ class TemplateScript:
                             f"macro code is not an extension of the base indentation."
                         )
 
+                if tree is not None:
+                    try:
+                        tree.add_code(
+                            template_script_strings[code_start_position:],
+                            script_indentation.level,
+                            content_line_no,
+                            column_shifts,
+                            bool(multi_section_suite_starts),
+                            continues_compound,
+                        )
+                    except UnsupportedMacroCode:
+                        tree = None
+
                 if multi_section_suite_starts:
                     # Handle compound statement with a suite beginning in this macro
                     # section and spanning subsequent sections
                     script_indentation.indent()
 
-                if not multi_section_suite_starts:
+                if (
+                    not multi_section_suite_starts
+                    and optimize
+                    and _cannot_insert("".join(code_lines))
+                ):
+                    # The macro has no output to re-indent
+                    del template_script_strings[macro_starts_position]
+                    if tree is not None:
+                        tree.remove(macro_starts_statement)
+                    if text_merge_position == (
+                        macro_starts_position,
+                        str(script_indentation),
+                    ):
+                        # The macro directly follows a text: A text following
+                        # it can still be merged with that text
+                        text_merge_position = (
+                            len(template_script_strings),
+                            str(script_indentation),
+                        )
+                elif not multi_section_suite_starts:
                     # Inform the global_evaluation_context of the template script that
                     # the macro ends here
                     template_script_strings.append(
                         str(script_indentation) + f"_macro_ends({repr(content_line)})\n"
                     )
+                    if tree is not None:
+                        tree.add_call(
+                            content_line_no + len(lines) - 1,
+                            "_macro_ends",
+                            content_line,
+                        )
 
             else:  # pragma: no cover
                 raise RuntimeError(
@@ -263,9 +536,66 @@ class TemplateScript:
                 "is :end somewhere missing?"
             )
 
+        if texts is not None:
+            table_name = _text_table_name(texts)
+            for text_no, (string_no, indentation) in enumerate(text_insertions):
+                template_script_strings[string_no] = (
+                    f"{indentation}insert({table_name}[{text_no}])\n"
+                )
+            self.text_table = (table_name, tuple(texts))
+            if tree is not None:
+                tree.set_text_table_name(table_name)
+
+        if tree is not None:
+            self.tree = tree.module
+
         # Concatenate the template strings to the template script
         self._template_script = "".join(template_script_strings)
 
+    @classmethod
+    def from_script_code(
+        cls,
+        file_name: str,
+        script_code: str,
+        code: Optional[CodeType] = None,
+        text_table: Optional[TextTable] = None,
+        code_refers_to_template: bool = False,
+    ) -> "TemplateScript":
+        """Create a template script from already generated *script_code* and,
+        optionally, its compiled *code*, without parsing the template again.
+
+        :param file_name: Name of the file of the template.
+        :param script_code: Code of the template script.
+        :param code: The compiled *script_code*.
+        :param text_table: The table of texts the *script_code* refers to, if any.
+        :param code_refers_to_template: True, if *code* has been compiled from the
+            syntax tree of the script.
+        """
+        template_script = cls.__new__(cls)
+        template_script.file_name = file_name
+        template_script.code = code
+        template_script.code_file_name = None
+        template_script.text_table = text_table
+        template_script.tree = None
+        template_script.code_refers_to_template = code_refers_to_template
+        template_script.compile_lock = threading.Lock()
+        template_script._template_script = script_code
+        return template_script
+
+    def compile_tree(self) -> bool:
+        """If the syntax tree of the script has been built, compile it to *code*,
+        and drop the tree. Return True, if *code* is compiled from the tree."""
+        if self.tree is not None:
+            tree, self.tree = self.tree, None
+            try:
+                self.code = compile(tree, self.file_name, mode="exec")
+                self.code_refers_to_template = True
+            except (SyntaxError, ValueError, TypeError):
+                # E.g., a suite without statements. Compiling the code reports
+                # the error.
+                pass
+        return self.code_refers_to_template
+
     def __str__(self) -> str:
         """Return the code of the template script."""
         return self._template_script
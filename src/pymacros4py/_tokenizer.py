@@ -1,4 +1,5 @@
 import re
+import bisect
 from collections.abc import Iterator, Iterable
 from typing import NamedTuple
 
@@ -21,6 +22,33 @@ class Token(NamedTuple):
 TokenStream = Iterator[Token]
 
 
+class LineIndex:
+    """Start positions of the lines of *text*. Used to look up line numbers,
+    columns and line starts of positions in the text by binary search, instead
+    of re-scanning the text for each lookup, e.g., for the *content_pos* of the
+    tokens of the text.
+
+    :param text: A text. Needs to follow Unix-style end of line convention.
+    """
+
+    def __init__(self, text: str) -> None:
+        self._line_starts = [0]
+        self._line_starts.extend(match.end() for match in re.finditer("\n", text))
+
+    def line_no(self, pos: int) -> int:
+        """Return the line where *pos* is, counted from 1"""
+        return bisect.bisect_right(self._line_starts, pos)
+
+    def line_start(self, pos: int) -> int:
+        """Return the position of the first character of the line where *pos* is"""
+        return self._line_starts[bisect.bisect_right(self._line_starts, pos) - 1]
+
+    def line_and_column(self, pos: int) -> tuple[int, int]:
+        """Return line and column where *pos* is, both counted from 1"""
+        line_no = bisect.bisect_right(self._line_starts, pos)
+        return line_no, pos - self._line_starts[line_no - 1] + 1
+
+
 class Tokenizer:
     """Text tokenizer for macro expansion. It extracts macro sections and
     remaining text sections and recognizes if a macro section is started but not ended.
@@ -38,6 +66,11 @@ class Tokenizer:
         *string_literal_end* can refer to *string_literal_start_group*
         to express, that the literal needs to end like it started.
     :param line_comment_start: Pattern for the start of a macro string in a comment.
+    :param engine: Tokenizer engine. With "regex", the template is split by a
+        single regular expression that covers the whole grammar. With "marker",
+        candidate positions of macro markers are located first, and the macro
+        grammar is only applied there. Both engines produce the same tokens, but
+        "marker" runs in linear time for large text sections and long lines.
     """
 
     def __init__(
@@ -47,7 +80,19 @@ class Tokenizer:
         string_literal_start_group: str = "pm4p_quotes",
         string_literal_end: str = r"(?P=pm4p_quotes)",
         line_comment_start: str = r"#(( |\t)*)",
+        engine: str = "regex",
     ) -> None:
+        if engine not in ("regex", "marker"):
+            raise ValueError(f"Unknown tokenizer engine {engine!r}")
+        self._engine = engine
+        self._configuration = (
+            macro_marker,
+            string_literal_start,
+            string_literal_start_group,
+            string_literal_end,
+            line_comment_start,
+        )
+
         # Prefixes used for distinguishing the named match groups of the tokenizer
         # from others that might be used in the patterns chosen by the application
         self._token_group_prefix = token_group_prefix = "pm4p_grp_"
@@ -139,6 +184,15 @@ class Tokenizer:
                 + end_of_line_optionally_nl
             )
 
+        # Regular expression for the start of a macro section, as it is used by the
+        # text block to stop in front of it (see below)
+        re_macro_start = re_or_bracketed_elements(
+            [
+                re_in_brackets(string_literal_start) + macro_marker,
+                re_in_brackets(line_comment_start) + macro_marker,
+            ]
+        )
+
         # Regular expression for a text block
         # ("as long as it does not look like a line block macro or the start
         # of a non-line-block macro section". The first is necessary, because
@@ -154,8 +208,7 @@ class Tokenizer:
                             re_macro_line_block_instance(
                                 token_other_group_prefix + "ahead_line_block"
                             ),
-                            re_in_brackets(string_literal_start) + macro_marker,
-                            re_in_brackets(line_comment_start) + macro_marker,
+                            re_macro_start,
                         ]
                     )
                 )
@@ -184,8 +237,93 @@ class Tokenizer:
         # raise RuntimeError("tmp")
         self._tokenizer_pattern = re.compile(re_tokens, re.MULTILINE)
 
+        # Separate patterns for the marker engine: The grammar of the two kinds of
+        # macro sections, and the start of a macro section (candidate position).
+        self._line_block_macro_pattern = re.compile(
+            re_macro_line_block_instance("line_block_macro"), re.MULTILINE
+        )
+        self._embedded_macro_pattern = re.compile(
+            re_macro_instance("embedded_macro"), re.MULTILINE
+        )
+        self._macro_start_pattern = re.compile(re_macro_start, re.MULTILINE)
+
+    @property
+    def configuration(self) -> tuple[str, ...]:
+        """The patterns that define the syntax recognized by the tokenizer. (The
+        engine is not part of it, since all engines return the same tokens.)"""
+        return self._configuration
+
     def tokenize(self, text: str) -> TokenStream:
         """Iterate and unpack oll tokens in *text*."""
+        if self._engine == "marker":
+            return self._tokenize_by_markers(text)
+        return self._tokenize_by_regex(text)
+
+    def _tokenize_by_markers(self, text: str) -> TokenStream:
+        """Iterate and unpack all tokens in *text*. Same result as
+        *_tokenize_by_regex*, but the text sections are not matched character by
+        character. Instead, the next candidate start of a macro section is searched,
+        and the macro grammar is only tried there."""
+        token_group_prefix = self._token_group_prefix
+        line_block_group = token_group_prefix + "line_block_macro"
+        embedded_group = token_group_prefix + "embedded_macro"
+        line_block_pattern = self._line_block_macro_pattern
+        embedded_pattern = self._embedded_macro_pattern
+        macro_start_pattern = self._macro_start_pattern
+
+        pos, text_len = 0, len(text)
+        while pos < text_len:
+            # A line block macro can only start at the start of a line
+            if pos == 0 or text[pos - 1] == "\n":
+                match = line_block_pattern.match(text, pos)
+                if match:
+                    yield Token(
+                        "line_block_macro",
+                        match.group(line_block_group),
+                        pos,
+                        match.start(self._token_pos_group_prefix + "line_block_macro"),
+                        match.start(line_block_group),
+                    )
+                    pos = match.end()
+                    continue
+
+            # An embedded macro starts with a macro start. If there is a macro start,
+            # but no valid macro, the rest of the text is a syntax error.
+            if macro_start_pattern.match(text, pos):
+                match = embedded_pattern.match(text, pos)
+                if match:
+                    yield Token(
+                        "embedded_macro",
+                        match.group(embedded_group),
+                        pos,
+                        pos,
+                        match.start(embedded_group),
+                    )
+                    pos = match.end()
+                    continue
+                yield Token("error", text[pos:], pos, pos, pos)
+                return
+
+            # Text section: It ends before the next macro start, or, if this macro
+            # start is preceded only by spaces and tabs in its line and there a line
+            # block macro matches, before the start of this line.
+            match = macro_start_pattern.search(text, pos + 1)
+            if match is None:
+                end = text_len
+            else:
+                end = match.start()
+                line_start = text.rfind("\n", pos, end) + 1
+                if (
+                    line_start > pos
+                    and not text[line_start:end].strip(" \t")
+                    and line_block_pattern.match(text, line_start)
+                ):
+                    end = line_start
+            yield Token("text", text[pos:end], pos, pos, pos)
+            pos = end
+
+    def _tokenize_by_regex(self, text: str) -> TokenStream:
+        """Iterate and unpack all tokens in *text* by a single regular expression."""
 
         # A token is a match of a named group with a name started by
         # *token_group_prefix*.
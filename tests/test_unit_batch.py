@@ -0,0 +1,61 @@
+import unittest
+import unittest.mock
+import multiprocessing
+import pathlib
+import tempfile
+import pymacros4py
+
+
+class ExpandManyTest(unittest.TestCase):
+    def test_expand_many(self) -> None:
+        """Batch expansion in worker processes gives the same results as
+        expand_file, writes only changed files, and reports errors per file."""
+        templates = sorted(pathlib.Path("tests/data/").glob("doc_*.tpl.py"))[:4]
+        templates.append(
+            pathlib.Path("tests/data/testcase_tracing_evaluation_and_exception.tpl.py")
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = [
+                (str(template), str(pathlib.Path(tmp_dir, template.name)))
+                for template in templates
+            ]
+            for jobs, expect_changed in [(2, True), (1, False)]:
+                with self.subTest(jobs=jobs):
+                    pp = pymacros4py.PreProcessor()
+                    outcomes = pp.expand_many(files, jobs=jobs)
+                    self.assertEqual(
+                        [(o.template_file, o.result_file) for o in outcomes], files
+                    )
+                    for outcome in outcomes[:-1]:
+                        self.assertIsNone(outcome.error)
+                        self.assertEqual(outcome.changed, expect_changed)
+                        self.assertEqual(
+                            pymacros4py.read_file(outcome.result_file),
+                            pp.expand_file(outcome.template_file),
+                        )
+                    self.assertFalse(outcomes[-1].changed)
+                    self.assertRegex(str(outcomes[-1].error), "unknown_variable")
+
+
+@unittest.skipUnless(
+    "fork" in multiprocessing.get_all_start_methods(), "needs start method fork"
+)
+class WarmWorkerPoolTest(unittest.TestCase):
+    def test_workers_inherit_warm_state(self) -> None:
+        """Templates expanded as prelude in the parent process are not parsed
+        again by the forked workers."""
+        template = "tests/data/testcase_import_from_a_second_time.tpl.py"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_file = str(pathlib.Path(tmp_dir, "result.py"))
+            pp = pymacros4py.PreProcessor()
+            with pp.warm_worker_pool(
+                jobs=2, prelude_templates=[template], preload_modules=["json"]
+            ) as pool:
+                with unittest.mock.patch.object(
+                    pymacros4py.Tokenizer, "tokenize", side_effect=AssertionError
+                ):
+                    outcomes = pool.expand_many([(template, result_file)])
+            self.assertIsNone(outcomes[0].error)
+            self.assertTrue(outcomes[0].changed)
+            lines = pymacros4py.read_file(result_file).splitlines()
+            self.assertEqual(lines[0], lines[1])
@@ -0,0 +1,361 @@
+import os
+import unittest
+import unittest.mock
+import pathlib
+import tempfile
+import traceback
+import pymacros4py
+
+
+class ScriptCacheTest(unittest.TestCase):
+    def test_warm_run_skips_parsing(self) -> None:
+        """A PreProcessor with a script cache directory filled by a previous
+        PreProcessor produces the same results without tokenizing again."""
+        templates = list(pathlib.Path("tests/data/").glob("doc_*.tpl.py"))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            pp = pymacros4py.PreProcessor(script_cache_dir=cache_dir)
+            cold_results = [pp.template_script(str(t)) for t in templates]
+            pp = pymacros4py.PreProcessor(script_cache_dir=cache_dir)
+            with unittest.mock.patch.object(
+                pymacros4py.Tokenizer, "tokenize", side_effect=AssertionError
+            ):
+                warm_results = [pp.template_script(str(t)) for t in templates]
+                pp.expand_file("tests/data/doc_templ_and_templ_exp.tpl.py")
+        self.assertEqual(cold_results, warm_results)
+
+    def test_exception_in_cached_script(self) -> None:
+        """An exception raised by a template script taken from the cache
+        refers to the script in a temporary file, like without cache."""
+        template_path = "tests/data/testcase_tracing_evaluation_and_exception.tpl.py"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                pp = pymacros4py.PreProcessor(script_cache_dir=cache_dir)
+                try:
+                    pp.expand_file(template_path)
+                except Exception as e:
+                    # Depending on the Python version, the NameError is chained
+                    while e.__cause__ is not None:
+                        e = e.__cause__  # type: ignore
+                    traceback = e.__traceback__
+                while traceback is not None and traceback.tb_next is not None:
+                    traceback = traceback.tb_next
+                assert traceback is not None
+                self.assertIn("template_script_", traceback.tb_frame.f_code.co_filename)
+
+
+class ScriptFileTest(unittest.TestCase):
+    def test_script_file_written_on_error_only(self) -> None:
+        """Template scripts are written to files only if they raise an
+        exception. Tracebacks show the lines of the scripts in both cases."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.object(tempfile, "tempdir", tmp_dir):
+                pp = pymacros4py.PreProcessor()
+                pp.expand_file("tests/data/doc_templ_and_templ_exp.tpl.py")
+                self.assertEqual(os.listdir(tmp_dir), [])
+
+                try:
+                    pp.expand_file(
+                        "tests/data/testcase_tracing_evaluation_and_exception.tpl.py"
+                    )
+                except Exception:
+                    formatted = traceback.format_exc()
+                (script_file,) = os.listdir(tmp_dir)
+                self.assertTrue(script_file.startswith("template_script_"))
+                self.assertIn(os.path.join(tmp_dir, script_file), formatted)
+                self.assertIn("insert(unknown_variable)", formatted)
+
+
+class TemplateScriptReuseTest(unittest.TestCase):
+    def test_unchanged_template_is_parsed_once(self) -> None:
+        """A PreProcessor re-uses the template script of a template file as long as
+        the file does not change."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            pymacros4py.write_file(template_path, "x = '$$ insert(1) $$'\n")
+            pp = pymacros4py.PreProcessor()
+            self.assertEqual(pp.expand_file(template_path), "x = 1\n")
+            with unittest.mock.patch.object(
+                pymacros4py.Tokenizer, "tokenize", side_effect=AssertionError
+            ):
+                self.assertEqual(pp.expand_file(template_path), "x = 1\n")
+
+            pymacros4py.write_file(template_path, "x = '$$ insert(22) $$'\n")
+            self.assertEqual(pp.expand_file(template_path), "x = 22\n")
+
+
+class InsertedContentInvalidationTest(unittest.TestCase):
+    def test_result_depends_on_nested_files(self) -> None:
+        """A re-used result of *insert_from* is invalidated when a file changes
+        that has been imported or inserted indirectly, but not when unrelated
+        files change."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            def path(name: str) -> str:
+                return str(pathlib.Path(tmp_dir, name))
+
+            template = path("top.tpl.py")
+            pymacros4py.write_file(
+                template, f"# $$ insert_from({path('nested.tpl.py')!r})\n"
+            )
+            pymacros4py.write_file(
+                path("nested.tpl.py"),
+                "# $$ import_from('$$/lib.tpl.py')\n# $$ insert_content(data_file)\n",
+            )
+            pymacros4py.write_file(
+                path("lib.tpl.py"), f"# $$ data_file = {path('data.txt')!r}\n"
+            )
+            pymacros4py.write_file(path("data.txt"), "data 1\n")
+            pymacros4py.write_file(path("other.txt"), "other\n")
+
+            pp = pymacros4py.PreProcessor()
+            self.assertEqual(pp.expand_file(template), "data 1\n")
+
+            pymacros4py.write_file(path("other.txt"), "other, changed\n")
+            with unittest.mock.patch.object(
+                pymacros4py.Tokenizer, "tokenize", side_effect=AssertionError
+            ):
+                self.assertEqual(pp.expand_file(template), "data 1\n")
+
+            pymacros4py.write_file(path("data.txt"), "data 22\n")
+            self.assertEqual(pp.expand_file(template), "data 22\n")
+
+            pymacros4py.write_file(
+                path("lib.tpl.py"), f"# $$ data_file = {path('other.txt')!r}\n"
+            )
+            self.assertEqual(pp.expand_file(template), "other, changed\n")
+
+
+class InsertedContentCacheTest(unittest.TestCase):
+    def test_eviction_and_spilling(self) -> None:
+        """Results exceeding the memory budget are evicted, and, if spilling is
+        enabled, re-used from disk."""
+        template_path = "tests/data/testcase_insert_from_with_caching.tpl.py"
+        for spill in [False, True]:
+            with self.subTest(spill=spill):
+                pp = pymacros4py.PreProcessor(
+                    max_inserted_content_bytes=0, spill_inserted_content=spill
+                )
+                result = pp.expand_file(template_path).splitlines()
+                statistics = pp.inserted_content_statistics
+                self.assertEqual(statistics.evictions, 2)
+                if spill:
+                    self.assertEqual(result[0], result[1])
+                    self.assertEqual((statistics.hits, statistics.misses), (1, 1))
+                else:
+                    self.assertNotEqual(result[0], result[1])
+                    self.assertEqual((statistics.hits, statistics.misses), (0, 2))
+
+
+class ParameterizedInsertCacheTest(unittest.TestCase):
+    def test_identical_globals_are_cached(self) -> None:
+        """With cached parameterized inserts, inserts with globals dicts of the same
+        content re-use the result, and with different content, they do not."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            part = str(pathlib.Path(tmp_dir, "part.tpl.py"))
+            pymacros4py.write_file(part, "x = '$$ insert(value) $$'\n")
+            template = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            pymacros4py.write_file(
+                template,
+                "# $$ g = dict(value=(1, 'a'))\n"
+                f"# $$ insert_from({part!r}, g)\n"
+                f"# $$ insert_from({part!r}, g)\n"
+                f"# $$ insert_from({part!r}, dict(value=[1, 'a']))\n"
+                f"# $$ insert_from({part!r}, dict(value=[1, 'a']))\n"
+                f"# $$ insert_from({part!r}, dict(value=2))\n"
+                f"# $$ insert_from({part!r}, dict(value=3), cache_key=2)\n"
+                # A cache key that looks like the content of a globals dict
+                f"# $$ insert_from({part!r}, dict(value=4), "
+                f"cache_key=(('value', 2),))\n",
+            )
+            expected = (
+                "x = (1, 'a')\n" * 2
+                + "x = [1, 'a']\n" * 2
+                + "x = 2\n"
+                + "x = 3\n"
+                + "x = 4\n"
+            )
+            for cache, hits_and_misses in [(False, (0, 2)), (True, (2, 5))]:
+                with self.subTest(cache=cache):
+                    pp = pymacros4py.PreProcessor(cache_parameterized_inserts=cache)
+                    self.assertEqual(pp.expand_file(template), expected)
+                    statistics = pp.parameterized_insert_statistics
+                    self.assertEqual(
+                        (statistics.hits, statistics.misses), hits_and_misses
+                    )
+
+            pp = pymacros4py.PreProcessor(
+                cache_parameterized_inserts=True, globals_key=len
+            )
+            self.assertEqual(
+                pp.expand_file(template), "x = (1, 'a')\n" * 5 + "x = 3\nx = 4\n"
+            )
+
+            # A changed template is expanded again
+            pp = pymacros4py.PreProcessor(cache_parameterized_inserts=True)
+            self.assertEqual(pp.expand_file(template), expected)
+            pymacros4py.write_file(part, "y = '$$ insert(value) $$'\n")
+            self.assertEqual(pp.expand_file(template), expected.replace("x", "y"))
+
+    def test_imports_of_caller(self) -> None:
+        """Cached parameterized inserts regard the templates the caller has
+        already imported, like uncached ones."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, content in [
+                ("lib.tpl.py", "# $$ counter += 1\n"),
+                (
+                    "part.tpl.py",
+                    "# $$ import_from('$$/lib.tpl.py')\nx = '$$ insert(counter) $$'\n",
+                ),
+                (
+                    "t.tpl.py",
+                    "# $$ counter = 0\n"
+                    "# $$ insert_from('$$/part.tpl.py', dict(counter=10))\n"
+                    "# $$ import_from('$$/lib.tpl.py')\n"
+                    "# $$ insert_from('$$/part.tpl.py', dict(counter=10))\n"
+                    "# $$ insert_from('$$/part.tpl.py', dict(counter=10))\n",
+                ),
+            ]:
+                pymacros4py.write_file(str(pathlib.Path(tmp_dir, name)), content)
+            template = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            expected = "x = 11\nx = 10\nx = 10\n"
+            for cache, hits_and_misses in [(False, (0, 0)), (True, (1, 2))]:
+                with self.subTest(cache=cache):
+                    pp = pymacros4py.PreProcessor(cache_parameterized_inserts=cache)
+                    self.assertEqual(pp.expand_file(template), expected)
+                    statistics = pp.parameterized_insert_statistics
+                    self.assertEqual(
+                        (statistics.hits, statistics.misses), hits_and_misses
+                    )
+
+
+class FileContentCacheTest(unittest.TestCase):
+    def test_files_are_read_once(self) -> None:
+        """A file inserted by several templates is read only once, and again when
+        it changes. Contents exceeding the memory budget are not cached."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            header = str(pathlib.Path(tmp_dir, "header.txt"))
+            pymacros4py.write_file(header, "# header\n")
+            templates = [str(pathlib.Path(tmp_dir, f"t{i}.tpl.py")) for i in range(3)]
+            for i, template in enumerate(templates):
+                pymacros4py.write_file(
+                    template, f"# $$ insert_content({header!r})\nx = {i}\n"
+                )
+            pp = pymacros4py.PreProcessor()
+            for i, template in enumerate(templates):
+                self.assertEqual(pp.expand_file(template), f"# header\nx = {i}\n")
+            statistics = pp.file_content_statistics
+            self.assertEqual((statistics.hits, statistics.misses), (2, 4))
+
+            pymacros4py.write_file(header, "# changed header\n")
+            self.assertEqual(pp.expand_file(templates[0]), "# changed header\nx = 0\n")
+            self.assertEqual((statistics.hits, statistics.misses), (2, 5))
+
+            for max_bytes in [0, 1]:
+                pp = pymacros4py.PreProcessor(max_file_content_bytes=max_bytes)
+                for template in templates:
+                    pp.expand_file(template)
+                self.assertEqual(pp.file_content_statistics.hits, 0)
+            pp = pymacros4py.PreProcessor(max_file_content_bytes=None)
+            for template in templates:
+                pp.expand_file(template)
+            self.assertEqual(pp.file_content_statistics.hits, 2)
+
+
+class ImportReuseTest(unittest.TestCase):
+    def test_imported_names(self) -> None:
+        """Imports overwrite globals of the importing template, and only the
+        functions provided to template scripts are dispatched to the importer."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lib_path = pathlib.Path(tmp_dir, "lib.tpl.py")
+            lib_path.write_text(
+                "'''$$\n"
+                "import sys\n"
+                "x = 2\n"
+                "def g():\n"
+                "    insert(f'{stderr is sys.stderr}\\n')\n"
+                "$$'''\n"
+            )
+            template_path = pathlib.Path(tmp_dir, "a.tpl.py")
+            template_path.write_text(
+                "# $$ x = 1\n"
+                "# $$ import_from('$$/lib.tpl.py')\n"
+                "x = '$$ insert(x) $$'\n"
+                "# $$ g()\n"
+            )
+            for reuse_imports in [False, True]:
+                with self.subTest(reuse_imports=reuse_imports):
+                    pp = pymacros4py.PreProcessor(reuse_imports=reuse_imports)
+                    self.assertEqual(
+                        pp.expand_file(str(template_path)), "x = 2\nTrue\n"
+                    )
+
+    def test_imports_are_executed_once(self) -> None:
+        """With re-used imports, an imported template is executed only once for
+        all expansions, and its functions insert into the importing expansion."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            def path(name: str) -> str:
+                return str(pathlib.Path(tmp_dir, name))
+
+            pymacros4py.write_file(
+                path("lib.tpl.py"),
+                "'''$$\n"
+                "import random\n"
+                "v = random.randrange(1000000)\n"
+                "def f(x):\n"
+                "    insert(f'{x} {v}\\n')\n"
+                "$$'''\n",
+            )
+            pymacros4py.write_file(
+                path("a.tpl.py"),
+                "# $$ import_from('$$/lib.tpl.py')\n" "x = 1\n" "# $$ f('a')\n",
+            )
+            for reuse_imports in [True, False]:
+                with self.subTest(reuse_imports=reuse_imports):
+                    pp = pymacros4py.PreProcessor(reuse_imports=reuse_imports)
+                    results = [pp.expand_file(path("a.tpl.py")) for _ in range(2)]
+                    self.assertRegex(results[0], r"^x = 1\na \d+\n$")
+                    self.assertEqual(results[0] == results[1], reuse_imports)
+
+    def test_readme_examples_with_reused_imports(self) -> None:
+        """Re-using imports does not change the results of the README examples."""
+        for template_path in pathlib.Path("tests/data/").glob("doc_*import*.tpl.py"):
+            with self.subTest(template=str(template_path)):
+                pp = pymacros4py.PreProcessor(reuse_imports=True)
+                result_file_path = template_path.with_suffix("").with_suffix(".py")
+                self.assertEqual(
+                    pp.expand_file(str(template_path)),
+                    pymacros4py.read_file(str(result_file_path)),
+                )
+
+
+class TextTableTest(unittest.TestCase):
+    def test_results_with_text_table(self) -> None:
+        """Template scripts taking their texts from a table produce the same
+        results, also when cached and with re-used imports, and do not contain
+        the texts."""
+        templates = [str(t) for t in pathlib.Path("tests/data/").glob("doc_*.tpl.py")]
+        expected = [pymacros4py.PreProcessor().expand_file(t) for t in templates]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for reuse_imports, script_cache_dir in [
+                (False, None),
+                (True, None),
+                (False, cache_dir),
+                (False, cache_dir),
+            ]:
+                with self.subTest(
+                    reuse_imports=reuse_imports, script_cache_dir=script_cache_dir
+                ):
+                    pp = pymacros4py.PreProcessor(
+                        text_table=True,
+                        reuse_imports=reuse_imports,
+                        script_cache_dir=script_cache_dir,
+                    )
+                    self.assertEqual([pp.expand_file(t) for t in templates], expected)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            pymacros4py.write_file(template_path, "long text\n" * 100)
+            pp = pymacros4py.PreProcessor(text_table=True)
+            self.assertNotIn("long text", pp.template_script(template_path))
+            self.assertEqual(pp.expand_file(template_path), "long text\n" * 100)
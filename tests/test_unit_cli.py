@@ -0,0 +1,117 @@
+import io
+import os
+import json
+import pathlib
+import tempfile
+import unittest
+import contextlib
+from pymacros4py._cli import main, result_file_for
+
+
+class CliTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.dir = pathlib.Path(self.tmp_dir.name)
+        self.data_path = self.dir / "data.txt"
+        self.data_path.write_text("a\n")
+        self.template_path = self.dir / "sub" / "t.tpl.py"
+        self.template_path.parent.mkdir()
+        self.template_path.write_text(
+            f"x = '$$ insert(1 + 1) $$'\n# $$ insert_content({str(self.data_path)!r})\n"
+        )
+        self.result_path = self.dir / "sub" / "t.py"
+
+    def run_main(self, *args: str) -> tuple[int, str]:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            status = main([*args, "-j", "1"])
+        return status, output.getvalue()
+
+    def test_result_file_for(self) -> None:
+        self.assertEqual(result_file_for("d/m.tpl.py"), os.path.join("d", "m.py"))
+        self.assertEqual(result_file_for("Makefile.tpl"), "Makefile")
+        with self.assertRaises(ValueError):
+            result_file_for("m.py")
+
+    def test_expand_and_check(self) -> None:
+        """Globs are expanded, results are written only if they change, and checks
+        fail for results that are not up to date."""
+        pattern = str(self.dir / "**" / "*.tpl.py")
+        self.assertEqual(self.run_main(pattern, "--check")[0], 1)
+        self.assertEqual(
+            self.run_main(pattern), (0, f"{self.result_path}: written\n1 written\n")
+        )
+        self.assertEqual(self.result_path.read_text(), "x = 2\na\n")
+        self.assertEqual(self.run_main(pattern, "-q"), (0, ""))
+        self.assertEqual(self.run_main(pattern, "--check"), (0, "1 unchanged\n"))
+
+        self.data_path.write_text("b\n")
+        status, output = self.run_main(pattern, "--check", "--diff")
+        self.assertEqual(status, 1)
+        self.assertIn("first difference in line 2, column 1", output)
+        self.assertIn("-a\n+b\n", output)
+
+        self.template_path.write_text("# $$ raise ValueError()\n")
+        status, output = self.run_main(pattern)
+        self.assertEqual(status, 1)
+        self.assertIn("ValueError", output)
+        self.assertEqual(self.result_path.read_text(), "x = 2\na\n")
+
+        self.assertEqual(self.run_main(str(self.dir / "*.tpl.py"))[0], 2)
+
+    def test_stamps_and_timings(self) -> None:
+        """With a cache directory, expansions are skipped as long as neither the
+        template, nor a file it has read, nor the result file changes."""
+        manifest_path = self.dir / "manifest.json"
+        manifest_path.write_text(json.dumps({"sub/t.tpl.py": "out.py"}))
+        result_path = self.dir / "out.py"
+        timings_path = self.dir / "timings.json"
+        args = ["-m", str(manifest_path), "--cache-dir", str(self.dir / "cache")]
+
+        def status() -> str:
+            self.assertEqual(
+                self.run_main(*args, "-q", "--timings", str(timings_path))[0], 0
+            )
+            timings = json.loads(timings_path.read_text())
+            [record] = timings["files"]
+            self.assertEqual(record["result"], str(result_path))
+            return record["status"]
+
+        self.assertEqual(status(), "written")
+        self.assertEqual(status(), "skipped")
+        self.data_path.write_text("b\n")
+        self.assertEqual(status(), "written")
+        self.assertEqual(result_path.read_text(), "x = 2\nb\n")
+        self.assertEqual(status(), "skipped")
+        result_path.write_text("changed\n")
+        self.assertEqual(status(), "written")
+        self.assertEqual(result_path.read_text(), "x = 2\nb\n")
+        os.utime(self.template_path)
+        os.utime(result_path)
+        self.assertEqual(status(), "unchanged")
+
+    def test_extra_dependencies(self) -> None:
+        """Files that the macro code reads by its own means are only regarded by
+        the stamps, if they are declared as dependencies."""
+        helper_path = self.dir / "helper.txt"
+        helper_path.write_text("1")
+        self.template_path.write_text(
+            f"x = '$$ insert(open({str(helper_path)!r}).read()) $$'\n"
+        )
+        cache_dir = str(self.dir / "cache")
+        with self.assertRaises(SystemExit):
+            # Dependencies need stamps
+            self.run_main(str(self.template_path), "--depends-on", "x")
+        for depends_on, expected in [
+            ([], "1"),
+            (["--depends-on", str(helper_path)], "2"),
+        ]:
+            with self.subTest(depends_on=depends_on):
+                args = [str(self.template_path), "--cache-dir", cache_dir, *depends_on]
+                helper_path.write_text("1")
+                self.assertEqual(self.run_main(*args)[0], 0)
+                self.assertEqual(self.run_main(*args), (0, "1 skipped\n"))
+                helper_path.write_text("2")
+                self.assertEqual(self.run_main(*args)[0], 0)
+                self.assertEqual(self.result_path.read_text(), f"x = {expected}\n")
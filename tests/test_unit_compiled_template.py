@@ -0,0 +1,90 @@
+import pathlib
+import pickle
+import tempfile
+import unittest
+import unittest.mock
+import pymacros4py
+from pymacros4py._tokenizer import Tokenizer
+
+template = """\
+x = '$$ insert(value) $$'
+# $$ y = value * 2
+y = '$$ insert(y) $$'
+"""
+
+
+class CompiledTemplateTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.template_path = pathlib.Path(self.tmp_dir.name, "t.tpl.py")
+        self.template_path.write_text(template)
+
+    def test_render_with_globals(self) -> None:
+        """Renderings use the given globals, without parsing the template again,
+        and do not change the globals."""
+        compiled = pymacros4py.PreProcessor().compile(self.template_path)
+        self.assertEqual(compiled.template_file, str(self.template_path))
+        globals_dict = {"value": 3}
+        with unittest.mock.patch.object(
+            Tokenizer, "tokenize", side_effect=AssertionError
+        ):
+            self.assertEqual(compiled.render(globals_dict), "x = 3\ny = 6\n")
+            self.assertEqual(compiled.render({"value": "a"}), "x = a\ny = aa\n")
+        self.assertEqual(globals_dict, {"value": 3})
+
+    def test_render_to_file(self) -> None:
+        compiled = pymacros4py.PreProcessor().compile(self.template_path)
+        result_path = pathlib.Path(self.tmp_dir.name, "result.py")
+        compiled.render_to_file(result_path, {"value": 1})
+        self.assertEqual(result_path.read_text(), "x = 1\ny = 2\n")
+        with self.assertRaises(Exception):
+            compiled.render_to_file(result_path, {})
+        self.assertEqual(result_path.read_text(), "x = 1\ny = 2\n")
+
+    def test_pickled(self) -> None:
+        """Unpickled compiled templates render like the original ones."""
+        for options in [False, True]:
+            with self.subTest(options=options):
+                compiled = pymacros4py.PreProcessor(
+                    text_table=options, build_ast=options
+                ).compile(self.template_path)
+                unpickled = pickle.loads(pickle.dumps(compiled))
+                self.assertEqual(unpickled.template_script, compiled.template_script)
+                self.assertEqual(unpickled.render({"value": 5}), "x = 5\ny = 10\n")
+
+    def test_error(self) -> None:
+        """Errors when rendering name the template."""
+        compiled = pymacros4py.PreProcessor().compile(self.template_path)
+        with self.assertRaises(NameError) as cm:
+            compiled.render()
+        if hasattr(cm.exception, "__notes__"):  # pragma: no cover
+            self.assertIn(str(self.template_path), "".join(cm.exception.__notes__))
+
+
+class RenderManyTest(unittest.TestCase):
+    def test_render_many(self) -> None:
+        """Renderings in worker processes give the results of render, in order
+        or as they are completed, and raise errors."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = pathlib.Path(tmp_dir, "t.tpl.py")
+            template_path.write_text(template)
+            pp = pymacros4py.PreProcessor()
+            globals_dicts = [{"value": i} for i in range(6)]
+            expected = [(i, f"x = {i}\ny = {2 * i}\n") for i in range(6)]
+            for jobs in [1, 2]:
+                with self.subTest(jobs=jobs):
+                    self.assertEqual(
+                        list(pp.render_many(template_path, globals_dicts, jobs)),
+                        expected,
+                    )
+                    self.assertEqual(
+                        sorted(
+                            pp.render_many(
+                                template_path, globals_dicts, jobs, ordered=False
+                            )
+                        ),
+                        expected,
+                    )
+                    with self.assertRaises(NameError):
+                        list(pp.render_many(template_path, [{"value": 1}, {}], jobs))
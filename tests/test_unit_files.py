@@ -0,0 +1,197 @@
+import io
+import os
+import sys
+import pathlib
+import subprocess
+import contextlib
+import tempfile
+import unittest
+from typing import Any
+import pymacros4py
+
+
+class WriteIfChangedTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = pathlib.Path(self.tmp_dir.name, "result.py")
+
+    def write_old(self, content: str) -> None:
+        self.path.write_text(content)
+        os.utime(self.path, ns=(0, 0))
+
+    def test_write_file(self) -> None:
+        """Files are only written if their content changes, also if it only
+        becomes shorter or longer."""
+        self.assertTrue(
+            pymacros4py.write_file(self.path, "a\nb\n", only_if_changed=True)
+        )
+        for old, new, changed in [
+            ("a\nb\n", "a\nb\n", False),
+            ("a\nb\n", "a\nc\n", True),
+            ("a\nb\n", "a\n", True),
+            ("a\n", "a\nb\n", True),
+            ("", "", False),
+        ]:
+            with self.subTest(old=old, new=new):
+                self.write_old(old)
+                self.assertEqual(
+                    pymacros4py.write_file(self.path, new, only_if_changed=True),
+                    changed,
+                )
+                self.assertEqual(self.path.read_text(), new)
+                self.assertEqual(os.stat(self.path).st_mtime_ns != 0, changed)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["result.py"])
+
+    def test_encoding(self) -> None:
+        """The content is compared as encoded with the file options."""
+        options = pymacros4py.FileOptions(encoding="utf-16", newline="\r\n")
+        pymacros4py.write_file(self.path, "ä\nö\n", options)
+        os.utime(self.path, ns=(0, 0))
+        self.assertFalse(
+            pymacros4py.write_file(self.path, "ä\nö\n", options, only_if_changed=True)
+        )
+        self.assertTrue(
+            pymacros4py.write_file(self.path, "ä\nö\n", only_if_changed=True)
+        )
+        self.assertEqual(pymacros4py.read_file(self.path), "ä\nö\n")
+
+    def test_expand_file_to_file_if_changed(self) -> None:
+        """Expansions write the result file only if it changes, and not, if they
+        fail."""
+        template_path = pathlib.Path(self.tmp_dir.name, "t.tpl.py")
+        template_path.write_text("x = '$$ insert(1 + 1) $$'\n")
+        pp = pymacros4py.PreProcessor()
+        self.assertTrue(pp.expand_file_to_file_if_changed(template_path, self.path))
+        os.utime(self.path, ns=(0, 0))
+        self.assertFalse(pp.expand_file_to_file_if_changed(template_path, self.path))
+        self.assertEqual(os.stat(self.path).st_mtime_ns, 0)
+
+        template_path.write_text("x = 2\n# $$ raise ValueError()\n")
+        with self.assertRaises(ValueError):
+            pp.expand_file_to_file_if_changed(template_path, self.path)
+        self.assertEqual(os.stat(self.path).st_mtime_ns, 0)
+        self.assertEqual(
+            sorted(os.listdir(self.tmp_dir.name)), ["result.py", "t.tpl.py"]
+        )
+
+
+class CheckTest(unittest.TestCase):
+    def test_check_file_to_file(self) -> None:
+        """Checks report the first difference, and stop the expansion there."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = pathlib.Path(tmp_dir, "t.tpl.py")
+            template_path.write_text(
+                "a = 1\nb = '$$ insert(2) $$'\n# $$ raise ValueError()\n"
+            )
+            result_path = pathlib.Path(tmp_dir, "result.py")
+            pp = pymacros4py.PreProcessor()
+            mismatch = pp.check_file_to_file(template_path, result_path)
+            assert mismatch is not None
+            self.assertFalse(mismatch.result_file_exists)
+
+            result_path.write_text("a = 1\nb = 3\n")
+            mismatch = pp.check_file_to_file(template_path, result_path)
+            self.assertEqual(mismatch, pymacros4py.Mismatch(2, 5, "b = 3", "b = 2"))
+
+            template_path.write_text("a = 1\nb = '$$ insert(2) $$'\n")
+            result_path.write_text("a = 1\nb = 2\n")
+            self.assertIsNone(pp.check_file_to_file(template_path, result_path))
+
+            result_path.write_text("a = 1\nb = 2\nc = 3\n")
+            mismatch = pp.check_file_to_file(template_path, result_path, diff=True)
+            assert mismatch is not None
+            self.assertEqual((mismatch.line, mismatch.column), (3, 1))
+            self.assertEqual(
+                mismatch.diff,
+                "--- current content\n+++ expansion result\n"
+                "@@ -1,3 +1,2 @@\n a = 1\n b = 2\n-c = 3\n",
+            )
+
+    def test_unified_diff(self) -> None:
+        """Line numbers of the hunks refer to the complete texts."""
+        lines = [f"{i}\n" for i in range(100)]
+        changed = lines[:50] + ["x\n"] + lines[51:]
+        self.assertEqual(
+            pymacros4py.unified_diff("".join(lines), "".join(changed), "a", "b"),
+            "--- a\n+++ b\n@@ -48,7 +48,7 @@\n 47\n 48\n 49\n-50\n+x\n 51\n 52\n 53\n",
+        )
+        self.assertEqual(pymacros4py.unified_diff("a\n", "a\n"), "")
+
+
+class RunProcessWithFilesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.log_path = pathlib.Path(tmp_dir.name, "log")
+        # Fails for files named bad_..., and for the files pair_a and pair_b
+        # together
+        script = (
+            "import sys\n"
+            f"open({str(self.log_path)!r}, 'a').write(' '.join(sys.argv[1:]) + '\\n')\n"
+            "bad = [a for a in sys.argv[1:] if a.startswith('bad')]\n"
+            "if {'pair_a', 'pair_b'} <= set(sys.argv): bad.append('pair')\n"
+            "print('cannot handle', *bad)\n"
+            "sys.exit(1 if bad else 0)\n"
+        )
+        self.args = [sys.executable, "-c", script]
+
+    def run_with_files(
+        self, paths: list[str], **kwargs: Any
+    ) -> tuple[subprocess.CalledProcessError, str]:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                pymacros4py.run_process_with_files(self.args, paths, **kwargs)
+        return cm.exception, output.getvalue()
+
+    def test_run_process_with_files(self) -> None:
+        """The command runs for chunks of the files, and failures are reported
+        for the files of the failed runs."""
+        paths = [f"good_{i}" for i in range(5)]
+        pymacros4py.run_process_with_files(self.args, paths, 2, jobs=1)
+        self.assertEqual(
+            self.log_path.read_text(), "good_0 good_1\ngood_2 good_3\ngood_4\n"
+        )
+
+        self.log_path.unlink()
+        error, report = self.run_with_files(["good_0", "bad_1", "good_2"], jobs=1)
+        self.assertEqual(error.output, "cannot handle bad_1\n")
+        self.assertIn('File "good_0", line 0\n  File "bad_1", line 0', report)
+        # Without isolation of failures, the command does not run again
+        self.assertEqual(self.log_path.read_text(), "good_0 bad_1 good_2\n")
+
+    def test_isolate_failures(self) -> None:
+        """Failures are reported for the files that cause them, or, if no file
+        fails alone, for the files of the failed run."""
+        paths = ["good_0", "bad_1", "good_2", "good_3", "bad_2"]
+        error, report = self.run_with_files(paths, jobs=3, isolate_failures=True)
+        self.assertEqual(error.output, "cannot handle bad_1\n")
+        self.assertIn('File "bad_1", line 0', report)
+        self.assertIn('File "bad_2", line 0', report)
+        self.assertIn("cannot handle bad_2", report)
+        self.assertNotIn("good", report)
+        self.assertLess(report.index("bad_1"), report.index("bad_2"))
+
+        error, report = self.run_with_files(
+            ["pair_a", "pair_b"], jobs=1, isolate_failures=True
+        )
+        self.assertEqual(error.output, "cannot handle pair\n")
+        self.assertIn('File "pair_a", line 0\n  File "pair_b", line 0', report)
+        if hasattr(error, "__notes__"):  # pragma: no cover
+            self.assertIn("pair_a, pair_b", "".join(error.__notes__))
+
+    def test_invalid_limits(self) -> None:
+        """Limits below 1 are rejected, also without files."""
+        limits: list[dict[str, Any]] = [
+            dict(jobs=0),
+            dict(jobs=-1),
+            dict(max_files_per_process=0),
+            dict(max_files_per_process=-2),
+        ]
+        for kwargs in limits:
+            for paths in [["good_0"], []]:
+                with self.subTest(**kwargs, paths=paths):
+                    with self.assertRaisesRegex(ValueError, "at least 1"):
+                        pymacros4py.run_process_with_files(self.args, paths, **kwargs)
+        self.assertFalse(self.log_path.exists())
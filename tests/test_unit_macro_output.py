@@ -0,0 +1,138 @@
+import functools
+import unittest
+import unittest.mock
+import pathlib
+import tempfile
+import pymacros4py
+from pymacros4py import _files
+
+# Recursively nested macros. Each one re-indents the output of the inner ones,
+# and the first line of this output continues a line of the enclosing macro.
+nested_template = """\
+# $$ def f(n):
+    '''$$
+        if n > 0:
+            insert(n, ":\\n  ")
+            f(n - 1)
+        else:
+            insert(inner)
+    $$'''
+# $$ :end
+  '''$$
+      f(depth)
+  $$'''
+"""
+
+
+class NestedMacroOutputTest(unittest.TestCase):
+    def expand_nested(self, depth: int, inner: str) -> str:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = pathlib.Path(tmp_dir, "t.tpl.py")
+            template_path.write_text(
+                f"# $$ depth, inner = {depth!r}, {inner!r}\n" + nested_template
+            )
+            return pymacros4py.PreProcessor().expand_file(template_path)
+
+    def test_deeply_nested_macros(self) -> None:
+        """Output passed through many nested macros is re-indented per level."""
+        result = self.expand_nested(100, "a\n  b\n\nc\n")
+        expected = (
+            "  100:\n"
+            + "".join(" " * (4 * (100 - n) + 4) + f"{n}:\n" for n in range(99, 0, -1))
+            + " " * 404
+            + "a\n"
+            + " " * 404
+            + "b\n"
+            + " " * 402
+            + "\n"
+            + " " * 402
+            + "c\n"
+        )
+        self.assertEqual(result, expected)
+
+    def test_unusual_line_breaks(self) -> None:
+        """Lines that join when re-indentation removes whitespace between line
+        breaks are handled like when the output is split again on each level."""
+        for inner, expected in (
+            (
+                "x\r\n  y\r  \nz\n",
+                "  2:\n        1:\n            x\r\n            y\r            \n"
+                "          z\n",
+            ),
+            (
+                "a\n\x0c\n  b\n",
+                "  2:\n        1:\n            a\n          \x0c          \n"
+                "            b\n",
+            ),
+            (
+                "a\r\r\n  \x0c\nb",
+                "  2:\n        1:\n            a\r          \r\n"
+                "            \x0c          \n          b",
+            ),
+        ):
+            with self.subTest(inner=inner):
+                self.assertEqual(self.expand_nested(2, inner), expected)
+
+    def test_indentation_error_in_nested_output(self) -> None:
+        """The first line with an invalid indentation is reported."""
+        with self.assertRaises(RuntimeError) as context:
+            self.expand_nested(5, "  a\n b\n c\n")
+        self.assertIn("\n> b<\n", str(context.exception))
+
+
+# Macros inserting the content of file *content_file*, with and without re-indentation
+content_templates = [
+    "# $$ insert_content(content_file)\n",
+    "    # $$ insert_content(content_file)\n",
+    "  y = '$$ insert('q\\n  '); insert_content(content_file); insert('z') $$'\n",
+    nested_template.replace("insert(inner)", "insert_content(content_file)"),
+]
+
+
+class StreamedContentTest(unittest.TestCase):
+    def test_same_results(self) -> None:
+        """Contents passed on chunk by chunk give the same results as contents
+        read completely."""
+        small_chunks = functools.partial(_files.read_file_chunks, chunk_size=3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            content_path = str(pathlib.Path(tmp_dir, "content.txt"))
+            template_path = pathlib.Path(tmp_dir, "t.tpl.py")
+            for content in [
+                "a\n  b\n\nc\n",
+                "  a\n    b\n  c",
+                "x\r\n  y\r  \nz\n",
+                "a\r\r\n  \x0c\nb",
+            ]:
+                pathlib.Path(content_path).write_bytes(content.encode())
+                for template in content_templates:
+                    template_path.write_text(
+                        f"# $$ content_file, depth = {content_path!r}, 3\n" + template
+                    )
+                    with self.subTest(content=content, template=template):
+                        expected = pymacros4py.PreProcessor().expand_file(template_path)
+                        pp = pymacros4py.PreProcessor(stream_content_bytes=0)
+                        chunks = list[str]()
+                        with unittest.mock.patch(
+                            "pymacros4py._macro_output.read_file_chunks",
+                            small_chunks,
+                        ):
+                            pp.expand_file_to_sink(template_path, chunks.append)
+                        self.assertEqual("".join(chunks), expected)
+
+    def test_changed_file(self) -> None:
+        """A file that changes before its content is passed on is reported."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            content_path = str(pathlib.Path(tmp_dir, "content.txt"))
+            pymacros4py.write_file(content_path, "a\nb\nc\n")
+            template_path = pathlib.Path(tmp_dir, "t.tpl.py")
+            template_path.write_text(
+                "'''$$\n"
+                f"    insert_content({content_path!r})\n"
+                f"    with open({content_path!r}, 'a') as f:\n"
+                "        f.write('changed')\n"
+                "$$'''\n"
+            )
+            pp = pymacros4py.PreProcessor(stream_content_bytes=0)
+            with self.assertRaises(RuntimeError) as context:
+                pp.expand_file(template_path)
+            self.assertIn("has changed", str(context.exception))
@@ -0,0 +1,91 @@
+import os
+import stat
+import pathlib
+import tempfile
+import threading
+import unittest
+import pymacros4py
+
+template = """\
+first
+'''$$
+    for i in range(3):
+        insert(f"  {i}\\n")
+$$'''
+# $$ for i in range(2):
+line '$$ insert(i) $$'
+# $$ :end
+# $$ if fail:
+# $$     raise ValueError("fail")
+# $$ :end
+last
+"""
+
+
+class StreamingExpansionTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.template_path = pathlib.Path(self.tmp_dir.name, "t.tpl.py")
+
+    def write_template(self, fail: bool) -> None:
+        self.template_path.write_text(f"# $$ fail = {fail}\n" + template)
+
+    def test_chunks_form_result(self) -> None:
+        """The chunks passed to the sink and yielded by the iteration form the
+        result."""
+        self.write_template(False)
+        pp = pymacros4py.PreProcessor()
+        result = pp.expand_file(self.template_path)
+        self.assertEqual(result, "first\n0\n1\n2\nline 0\nline 1\nlast\n")
+        chunks = list[str]()
+        pp.expand_file_to_sink(self.template_path, chunks.append)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), result)
+        self.assertEqual("".join(pp.expand_iter(self.template_path)), result)
+
+    def test_chunks_before_error(self) -> None:
+        """Final chunks are passed before the expansion ends."""
+        self.write_template(True)
+        pp = pymacros4py.PreProcessor()
+        chunks = list[str]()
+        with self.assertRaises(Exception):
+            pp.expand_file_to_sink(self.template_path, chunks.append)
+        self.assertEqual("".join(chunks), "first\n0\n1\n2\nline 0\nline 1\n")
+
+        iterator = pp.expand_iter(self.template_path)
+        self.assertEqual(next(iterator), "first\n")
+        with self.assertRaises(Exception):
+            list(iterator)
+
+    def test_iteration_stopped(self) -> None:
+        """Stopping the iteration cancels the expansion."""
+        self.template_path.write_text("# $$ while True:\ntext\n# $$ :end\n")
+        pp = pymacros4py.PreProcessor()
+        threads = threading.active_count()
+        iterator = pp.expand_iter(self.template_path)
+        self.assertEqual(next(iterator), "text\n")
+        self.assertEqual(next(iterator), "text\n")
+        iterator.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_file_unchanged_on_error(self) -> None:
+        """expand_file_to_file replaces the result file only if the expansion
+        succeeds, and keeps its permissions."""
+        result_path = pathlib.Path(self.tmp_dir.name, "result.py")
+        result_path.write_text("old\n")
+        os.chmod(result_path, 0o640)
+        pp = pymacros4py.PreProcessor()
+
+        self.write_template(True)
+        with self.assertRaises(Exception):
+            pp.expand_file_to_file(self.template_path, result_path)
+        self.assertEqual(result_path.read_text(), "old\n")
+
+        self.write_template(False)
+        pp.expand_file_to_file(self.template_path, result_path)
+        self.assertEqual(result_path.read_text(), pp.expand_file(self.template_path))
+        self.assertEqual(stat.S_IMODE(os.stat(result_path).st_mode), 0o640)
+        self.assertEqual(
+            sorted(os.listdir(self.tmp_dir.name)), ["result.py", "t.tpl.py"]
+        )
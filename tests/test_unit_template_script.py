@@ -0,0 +1,163 @@
+import os
+import unittest
+import unittest.mock
+import traceback
+import pathlib
+import tempfile
+import pymacros4py
+
+
+class OptimizedScriptTest(unittest.TestCase):
+    def test_same_results(self) -> None:
+        """Optimized template scripts produce the same results as the standard
+        ones."""
+        templates = [
+            str(t) for t in pathlib.Path("tests/data/").glob("doc_*.tpl.py")
+        ] + ["tests/data/file_generating_unformatted_code.tpl.py"]
+        expected = [pymacros4py.PreProcessor().expand_file(t) for t in templates]
+        for text_table in [False, True]:
+            with self.subTest(text_table=text_table):
+                pp = pymacros4py.PreProcessor(
+                    optimize_scripts=True, text_table=text_table
+                )
+                self.assertEqual([pp.expand_file(t) for t in templates], expected)
+
+    def test_optimizations(self) -> None:
+        """Only macros that can insert something inform the evaluation about
+        their start and end, and texts separated only by other macros are
+        inserted together."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            pymacros4py.write_file(
+                template_path,
+                "# $$ if True:\n"
+                "a\n"
+                "# $$ :end\n"
+                "b\n"
+                "# $$ import os; x: int = 1; y = z = (x, [x], {'x': x}, {1, 'x'})\n"
+                "# $$ def f(v=None): insert(v)\n"
+                "c = '$$ f(x) $$'\n"
+                "# $$ w = [*y]\n",
+            )
+            pp = pymacros4py.PreProcessor(optimize_scripts=True)
+            script = pp.template_script(template_path)
+            self.assertEqual(
+                script.splitlines()[:5],
+                [
+                    "if True:",
+                    "    insert('a\\n')",
+                    "import os; x: int = 1; y = z = (x, [x], {'x': x}, {1, 'x'})",
+                    "def f(v=None): insert(v)",
+                    "insert('b\\nc = ')",
+                ],
+            )
+            self.assertEqual(script.count("_macro_starts"), 2)
+            self.assertEqual(pp.expand_file(template_path), "a\nb\nc = 1\n")
+
+            pymacros4py.write_file(template_path, "a\n# $$ :end\nb\n")
+            with self.assertRaises(RuntimeError):
+                pp.expand_file(template_path)
+
+    def test_hashing_is_not_inert(self) -> None:
+        """Sets and dicts with elements or keys that are not constants can run
+        code of the template, so they separate the texts around them."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            pymacros4py.write_file(
+                template_path,
+                "# $$ class H: __hash__ = lambda self: insert('h\\n') or 0\n"
+                "# $$ h = H()\n"
+                "a\n"
+                "# $$ s = {h}\n"
+                "b\n"
+                "# $$ d = {h: 1}\n"
+                "c\n",
+            )
+            for optimize_scripts in [False, True]:
+                with self.subTest(optimize_scripts=optimize_scripts):
+                    pp = pymacros4py.PreProcessor(optimize_scripts=optimize_scripts)
+                    self.assertEqual(pp.expand_file(template_path), "a\nh\nb\nh\nc\n")
+
+
+compound_template = """\
+# $$ for i in range(4):
+# $$   if i == 0:
+zero
+# $$   elif i == 1:
+one
+# $$   else:
+# $$     try:
+x = '$$ insert(i) $$'
+# $$     except ZeroDivisionError:
+error
+# $$     else:
+ok
+# $$     finally:
+done
+# $$     :end
+# $$   :end
+# $$ else:
+end
+# $$ :end
+"""
+
+
+class ScriptTreeTest(unittest.TestCase):
+    def test_same_results(self) -> None:
+        """Template scripts compiled from syntax trees produce the same results as
+        those compiled from code, also if taken from the script cache."""
+        templates = [str(t) for t in pathlib.Path("tests/data/").glob("doc_*.tpl.py")]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            pymacros4py.write_file(template_path, compound_template)
+            templates.append(template_path)
+            expected = [pymacros4py.PreProcessor().expand_file(t) for t in templates]
+            for optimize in [False, True]:
+                for script_cache_dir in [None, tmp_dir, tmp_dir]:
+                    with self.subTest(
+                        optimize=optimize, script_cache_dir=script_cache_dir
+                    ):
+                        pp = pymacros4py.PreProcessor(
+                            build_ast=True,
+                            optimize_scripts=optimize,
+                            text_table=optimize,
+                            script_cache_dir=script_cache_dir,
+                        )
+                        self.assertEqual(
+                            [pp.expand_file(t) for t in templates], expected
+                        )
+        self.assertEqual(
+            expected[-1], "zero\none\nx = 2\nok\ndone\nx = 3\nok\ndone\nend\n"
+        )
+
+    def test_traceback_shows_template_line(self) -> None:
+        """Tracebacks refer to the template lines, and no script file is
+        written."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.object(tempfile, "tempdir", tmp_dir):
+                template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+                pymacros4py.write_file(
+                    template_path,
+                    "# $$ for i in range(2):\n"
+                    "  ä = '$$ insert(i / (1 - i)) $$'\n"
+                    "# $$ :end\n",
+                )
+                pp = pymacros4py.PreProcessor(build_ast=True)
+                try:
+                    pp.expand_file(template_path)
+                except ZeroDivisionError:
+                    formatted = traceback.format_exc()
+                self.assertIn(f'File "{template_path}", line 2', formatted)
+                self.assertIn("insert(i / (1 - i))", formatted)
+                self.assertIn("\n                   ~~^~~~~~~~~\n", formatted)
+                self.assertEqual(os.listdir(tmp_dir), ["t.tpl.py"])
+
+                pymacros4py.write_file(
+                    template_path, compound_template + "# $$ raise ValueError(i)\n"
+                )
+                try:
+                    pp.expand_file(template_path)
+                except ValueError:
+                    formatted = traceback.format_exc()
+                self.assertIn(f'File "{template_path}", line 20', formatted)
+                self.assertEqual(os.listdir(tmp_dir), ["t.tpl.py"])
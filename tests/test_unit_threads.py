@@ -0,0 +1,48 @@
+import unittest
+import pathlib
+import tempfile
+import concurrent.futures
+import pymacros4py
+
+
+class ConcurrentExpansionTest(unittest.TestCase):
+    def test_single_flight_insert_from(self) -> None:
+        """Threads that concurrently expand templates inserting the same template
+        with one PreProcessor get the results of a single expansion of it."""
+        template_path = "tests/data/testcase_insert_from_with_caching.tpl.py"
+        pp = pymacros4py.PreProcessor()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(pp.expand_file, [template_path] * 32))
+        lines = {line for result in results for line in result.splitlines()}
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(pp.inserted_content_statistics.misses, 1)
+        # The locks of the inserts are not kept after use
+        self.assertEqual(pp._global_evaluation_context._insert_locks, {})
+
+    def test_compile_locks(self) -> None:
+        """The compilation of a template script does not block the evaluation of
+        other template scripts, and compiled scripts are evaluated without
+        locking."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [pathlib.Path(tmp_dir, f"t{i}.tpl.py") for i in range(2)]
+            for i, path in enumerate(paths):
+                path.write_text(f"x = '$$ insert({i}) $$'\n")
+            pp = pymacros4py.PreProcessor()
+            compiled = pp.compile(paths[0])
+            with compiled._template_script.compile_lock:
+                self.assertEqual(compiled.render(), "x = 0\n")
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(pp.expand_file, paths[1]).result(10)
+                self.assertEqual(result, "x = 1\n")
+
+    def test_file_options_per_instance(self) -> None:
+        """Each PreProcessor can have its own file options."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = str(pathlib.Path(tmp_dir, "t.tpl.py"))
+            with open(template_path, "w", encoding="latin-1") as f_out:
+                f_out.write("s = '''$$ insert('ä' * 2) $$'''\n")
+            pp = pymacros4py.PreProcessor(
+                file_options=pymacros4py.FileOptions(encoding="latin-1")
+            )
+            self.assertEqual(pp.expand_file(template_path), "s = ää\n")
+            self.assertIsNone(pymacros4py.file_options.encoding)
@@ -0,0 +1,77 @@
+import unittest
+import pathlib
+import pymacros4py
+
+
+class TokenizerEngineTest(unittest.TestCase):
+    def test_engines_yield_same_tokens(self) -> None:
+        """The marker engine of the tokenizer yields the same tokens as the
+        regex engine, for all test and documentation templates."""
+        regex_tokenizer = pymacros4py.Tokenizer()
+        marker_tokenizer = pymacros4py.Tokenizer(engine="marker")
+        for template_path in pathlib.Path("tests/data/").glob("*.tpl.py"):
+            with self.subTest(template=str(template_path)):
+                template = pymacros4py.read_file(str(template_path))
+                self.assertEqual(
+                    list(regex_tokenizer.tokenize(template)),
+                    list(marker_tokenizer.tokenize(template)),
+                )
+
+    def test_engines_with_syntax_errors(self) -> None:
+        """Both engines report the same tokens for unfinished macro sections and
+        for line block macros followed by text."""
+        regex_tokenizer = pymacros4py.Tokenizer()
+        marker_tokenizer = pymacros4py.Tokenizer(engine="marker")
+        for template in [
+            "x = 1\n  # $$ v = 1\ny = '$$ v $$'\n",
+            "a\n  '$$ x $$' b\n'$$ y $$'\n",
+            "a '$$ x\nb\n",
+            "'''$$\nx = 1\n$$'''\n# $$ insert(x)",
+            "",
+        ]:
+            with self.subTest(template=template):
+                self.assertEqual(
+                    list(regex_tokenizer.tokenize(template)),
+                    list(marker_tokenizer.tokenize(template)),
+                )
+
+    def test_unknown_engine(self) -> None:
+        self.assertRaisesRegex(
+            ValueError, "Unknown tokenizer engine", pymacros4py.Tokenizer, engine="x"
+        )
+
+
+class TokenPositionTest(unittest.TestCase):
+    def test_line_and_column_of_tokens(self) -> None:
+        """The line index of a template gives line and column of the content of
+        its tokens, counted from 1."""
+        template = "x = 1\n  # $$ v = 1\ny = '$$ v $$'\n'''$$\n  w = 2\n$$'''\n"
+        line_index = pymacros4py._tokenizer.LineIndex(template)
+        for engine in ["regex", "marker"]:
+            tokenizer = pymacros4py.Tokenizer(engine=engine)
+            with self.subTest(engine=engine):
+                self.assertEqual(
+                    [
+                        (token_type, *line_index.line_and_column(content_pos))
+                        for token_type, _, _, _, content_pos in tokenizer.tokenize(
+                            template
+                        )
+                    ],
+                    [
+                        ("text", 1, 1),
+                        ("line_block_macro", 2, 8),
+                        ("text", 3, 1),
+                        ("embedded_macro", 3, 9),
+                        ("text", 3, 14),
+                        ("line_block_macro", 5, 3),
+                    ],
+                )
+
+    def test_line_index(self) -> None:
+        line_index = pymacros4py._tokenizer.LineIndex("ab\n\ncd")
+        self.assertEqual(
+            [line_index.line_and_column(pos) for pos in range(6)],
+            [(1, 1), (1, 2), (1, 3), (2, 1), (3, 1), (3, 2)],
+        )
+        self.assertEqual(line_index.line_no(5), 3)
+        self.assertEqual(line_index.line_start(5), 4)